@@ -0,0 +1,189 @@
+import asyncio
+from html import unescape
+from io import BytesIO
+
+import pandas as pd
+
+import setup_configuration as cfg
+from bulk_load_functions import copy_text, merge_statements, title_row_tables
+from connection_functions import count_connection
+from migration_functions import (
+    build_title_attributes,
+    cache_note_texts,
+    get_bulk_pub_fields,
+    note_texts_queries,
+    pub_rows_query,
+    title_attribute_queries,
+    uncached_note_ids,
+)
+
+# The async title loop runs many batches of titles at once on an event
+# loop, with pools of async connections to both databases. The drivers
+# are optional dependencies, only needed with async_titles.
+try:
+    import aiomysql
+    import asyncpg
+except ImportError:
+    aiomysql = None
+    asyncpg = None
+
+
+def check_async_drivers():
+    if aiomysql is None or asyncpg is None:
+        raise Exception(
+            "async_titles needs the aiomysql and asyncpg packages. "
+            "Install them with: pip install .[async]"
+        )
+
+
+# A pool of async_pool_size connections to each database. A snapshot
+# run reads the source from memory, so it only gets the Postgres pool.
+async def create_pools():
+    check_async_drivers()
+    source_pool = None
+    if not cfg.SOURCE_SNAPSHOT:
+        source_pool = await aiomysql.create_pool(
+            minsize=cfg.ASYNC_POOL_SIZE,
+            maxsize=cfg.ASYNC_POOL_SIZE,
+            host=cfg.SOURCE_DB_PARAMS["host"],
+            port=cfg.SOURCE_DB_PARAMS["port"],
+            user=cfg.SOURCE_DB_PARAMS["user"],
+            password=cfg.SOURCE_DB_PARAMS["password"],
+            db=cfg.SOURCE_DB_PARAMS["database"],
+            charset="utf8mb4",
+            autocommit=True,
+            # The default limit would silently truncate long author lists
+            init_command="SET SESSION group_concat_max_len = 1048576",
+        )
+        # aiomysql has no hook for new connections, but a pool with a
+        # fixed size opens all of them up front
+        for _ in range(cfg.ASYNC_POOL_SIZE):
+            count_connection()
+    dest_pool = await asyncpg.create_pool(
+        min_size=cfg.ASYNC_POOL_SIZE,
+        max_size=cfg.ASYNC_POOL_SIZE,
+        init=count_dest_connection,
+        **cfg.DEST_DB_PARAMS,
+    )
+    return source_pool, dest_pool
+
+
+async def count_dest_connection(_):
+    count_connection()
+
+
+async def close_pools(source_pool, dest_pool):
+    if source_pool is not None:
+        source_pool.close()
+        await source_pool.wait_closed()
+    await dest_pool.close()
+
+
+# The rows of a source query, and the names of its columns
+async def fetch_rows(source_pool, sql, params):
+    async with source_pool.acquire() as source_conn:
+        async with source_conn.cursor() as source_cur:
+            await source_cur.execute(sql, params)
+            rows = await source_cur.fetchall()
+            columns = [column[0] for column in source_cur.description]
+    return list(rows), columns
+
+
+# Async version of prefetch_title_batch. The same queries are sent all
+# at once, each on its own connection from the pool, and the results
+# are put together the same way. Returns the batch_data for
+# process_title.
+async def fetch_batch_data(
+    title_requests, note_ids, synopsis_ids, source_pool
+):
+    title_ids = [request[0] for request in title_requests]
+    root_ids = sorted({request[1] for request in title_requests})
+    uncached_ids = uncached_note_ids(note_ids)
+    attribute_queries = title_attribute_queries(title_ids)
+    note_queries = note_texts_queries(sorted(uncached_ids | set(synopsis_ids)))
+
+    results = await asyncio.gather(
+        fetch_rows(source_pool, *pub_rows_query(root_ids)),
+        *[
+            fetch_rows(source_pool, sql, params)
+            for _, sql, params in attribute_queries
+        ],
+        *[
+            fetch_rows(source_pool, sql, params)
+            for sql, params in note_queries
+        ],
+    )
+    pub_rows, pub_columns = results[0]
+    attribute_results = results[1 : len(attribute_queries) + 1]
+    note_results = results[len(attribute_queries) + 1 :]
+
+    # The same frame pd.read_sql would have built from the rows
+    all_pubs = pd.DataFrame.from_records(
+        pub_rows, columns=pub_columns, coerce_float=True
+    )
+    query_results = {
+        name: rows
+        for (name, _, _), (rows, _) in zip(
+            attribute_queries, attribute_results
+        )
+    }
+    texts = {
+        note_id: unescape(text)
+        for rows, _ in note_results
+        for note_id, text in rows
+    }
+    return {
+        "pub_fields": get_bulk_pub_fields(title_requests, all_pubs),
+        "title_attributes": build_title_attributes(title_ids, query_results),
+        # Rendered notes end up in note_cache, where get_note finds them
+        "synopses": cache_note_texts(uncached_ids, synopsis_ids, texts),
+    }
+
+
+# Async version of load_title_rows, in a single transaction
+async def load_title_rows_async(title_rows, dest_pool):
+    async with dest_pool.acquire() as dest_conn:
+        async with dest_conn.transaction():
+            for table, columns, rows, conflict_clause in title_row_tables(
+                title_rows
+            ):
+                if not rows:
+                    continue
+                if conflict_clause is None:
+                    await copy_rows_async(table, columns, rows, dest_conn)
+                    continue
+                staging_table, create_sql, insert_sql = merge_statements(
+                    table, columns, conflict_clause
+                )
+                await dest_conn.execute(create_sql)
+                await copy_rows_async(staging_table, columns, rows, dest_conn)
+                await dest_conn.execute(insert_sql)
+
+
+async def copy_rows_async(table, columns, rows, dest_conn):
+    await dest_conn.copy_to_table(
+        table,
+        source=BytesIO(copy_text(rows).encode("utf-8")),
+        columns=list(columns),
+        format="text",
+    )
+
+
+# Call handle on each item that next_item returns, with up to
+# concurrency of them running at once, until next_item returns None.
+# next_item may block, so it's called in a thread, and only once a
+# slot is free, so items aren't taken before they can be handled.
+async def run_concurrently(next_item, handle, concurrency):
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    while True:
+        await slots.acquire()
+        item = await loop.run_in_executor(None, next_item)
+        if item is None:
+            break
+        task = asyncio.create_task(handle(item))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        task.add_done_callback(lambda _: slots.release())
+    await asyncio.gather(*tasks)
@@ -0,0 +1,196 @@
+from io import StringIO
+
+BOOK_COLUMNS = (
+    "title_id",
+    "title",
+    "year",
+    "authors",
+    "book_type",
+    "isbn",
+    "pages",
+    "editions",
+    "alt_titles",
+    "series_str_1",
+    "series_str_2",
+    "original_lang",
+    "original_title",
+    "original_year",
+    "isfdb_rating",
+    "cold_start_rank",
+    "award_winner",
+    "juvenile",
+    "stand_alone",
+    "cover_image",
+    "wikipedia",
+    "synopsis",
+    "note",
+)
+ISBN_COLUMNS = ("isbn", "title_id", "book_type", "foreign_lang")
+TRANSLATION_COLUMNS = ("title_id", "lowest_title_id", "title", "year", "note")
+MORE_IMAGES_COLUMNS = ("title_id", "image")
+CONTENTS_COLUMNS = ("book_title_id", "content_title_id")
+
+
+# Escape a value for COPY's default text format
+def copy_value(value):
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+# Rows in COPY's default text format
+def copy_text(rows):
+    buffer = StringIO()
+    for row in rows:
+        buffer.write("\t".join(copy_value(value) for value in row) + "\n")
+    return buffer.getvalue()
+
+
+def copy_rows(table, columns, rows, dest_cur):
+    if not rows:
+        return
+    dest_cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN",
+        StringIO(copy_text(rows)),
+    )
+
+
+# COPY can't skip conflicting rows, so rows that may conflict are copied
+# into a temporary staging table and merged from there in one statement
+def merge_rows(table, columns, rows, conflict_clause, dest_cur):
+    if not rows:
+        return
+    staging_table, create_sql, insert_sql = merge_statements(
+        table, columns, conflict_clause
+    )
+    dest_cur.execute(create_sql)
+    copy_rows(staging_table, columns, rows, dest_cur)
+    dest_cur.execute(insert_sql)
+
+
+# The staging table of merge_rows, the statement that creates it, and
+# the statement that merges it into the table
+def merge_statements(table, columns, conflict_clause):
+    staging_table = f"{table}_staging"
+    create_sql = f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging_table}
+        ON COMMIT DELETE ROWS
+        AS SELECT {', '.join(columns)}
+        FROM {table}
+        WITH NO DATA;
+        """
+    insert_sql = f"""
+        INSERT INTO {table} ({', '.join(columns)})
+        SELECT {', '.join(columns)}
+        FROM {staging_table}
+        {conflict_clause};
+        """
+    return staging_table, create_sql, insert_sql
+
+
+# The rows of one title, in the column order of the lists above, are
+# bundled as (book_row, isbn_rows, translation_rows, more_images_rows)
+def load_title_rows(title_rows, dest_cur):
+    for table, columns, rows, conflict_clause in title_row_tables(title_rows):
+        if conflict_clause is None:
+            copy_rows(table, columns, rows, dest_cur)
+        else:
+            merge_rows(table, columns, rows, conflict_clause, dest_cur)
+
+
+# The rows of many titles by table, as (table, columns, rows,
+# conflict_clause) tuples. Tables with a conflict_clause are merged.
+def title_row_tables(title_rows):
+    return [
+        ("books", BOOK_COLUMNS, [rows[0] for rows in title_rows], None),
+        (
+            "isbns",
+            ISBN_COLUMNS,
+            [row for rows in title_rows for row in rows[1]],
+            None,
+        ),
+        (
+            "translations",
+            TRANSLATION_COLUMNS,
+            [row for rows in title_rows for row in rows[2]],
+            None,
+        ),
+        (
+            "more_images",
+            MORE_IMAGES_COLUMNS,
+            [row for rows in title_rows for row in rows[3]],
+            """
+            ON CONFLICT
+            ON CONSTRAINT more_images_title_id_image_key
+            DO NOTHING
+            """,
+        ),
+    ]
+
+
+# Row by row equivalent of load_title_rows for a single title. This is
+# used to isolate the problem title when a batch fails to load.
+def insert_title_rows(rows, dest_cur):
+    book_row, isbn_rows, translation_rows, more_images_rows = rows
+
+    dest_cur.execute(
+        """
+        INSERT INTO books
+        (title_id, title, year, authors, book_type,
+        isbn, pages, editions, alt_titles,
+        series_str_1, series_str_2,
+        original_lang, original_title, original_year,
+        isfdb_rating, cold_start_rank, award_winner,
+        juvenile, stand_alone, cover_image, wikipedia,
+        synopsis, note)
+        VALUES (%s, %s, %s, %s, %s,
+                %s, %s, %s, %s,
+                %s, %s,
+                %s, %s, %s,
+                %s, %s, %s,
+                %s, %s, %s, %s,
+                %s, %s);
+        """,
+        book_row,
+    )
+
+    for isbn_row in isbn_rows:
+        dest_cur.execute(
+            """
+            INSERT INTO isbns
+            (isbn, title_id, book_type, foreign_lang)
+            VALUES (%s, %s, %s, %s);
+            """,
+            isbn_row,
+        )
+
+    for translation_row in translation_rows:
+        dest_cur.execute(
+            """
+            INSERT INTO translations
+            (title_id, lowest_title_id, title, year, note)
+            VALUES (%s, %s, %s, %s, %s);
+            """,
+            translation_row,
+        )
+
+    for more_images_row in more_images_rows:
+        dest_cur.execute(
+            """
+            INSERT INTO more_images
+            (title_id, image)
+            VALUES (%s, %s)
+            ON CONFLICT
+            ON CONSTRAINT more_images_title_id_image_key
+            DO NOTHING;
+            """,
+            more_images_row,
+        )
@@ -0,0 +1,211 @@
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Source tables are stored column by column on disk, so they can be read
+# back with memory maps instead of being queried from MySQL. Each table
+# is a directory with a schema.json and, for every column, a file of
+# null flags and either a file of fixed width values, or a file of text
+# offsets and a file of the UTF-8 text they point into.
+
+# The source tables the migration reads
+SOURCE_TABLES = (
+    "titles",
+    "pubs",
+    "pub_content",
+    "authors",
+    "canonical_author",
+    "series",
+    "notes",
+    "webpages",
+    "awards",
+    "title_awards",
+    "languages",
+)
+
+INT_TYPES = ("tinyint", "smallint", "mediumint", "int", "integer", "bigint")
+FLOAT_TYPES = ("float", "double", "decimal", "real")
+VALUE_DTYPES = {"int": np.int64, "float": np.float64}
+
+# Rows are buffered and written to disk this many at a time
+WRITE_CHUNK_SIZE = 100000
+
+
+# Columns are stored as "int", "float" or "text". Anything that isn't a
+# number, including dates, is kept as the text MySQL would return.
+def column_kind(sql_type):
+    sql_type = sql_type.lower()
+    if sql_type in INT_TYPES:
+        return "int"
+    if sql_type in FLOAT_TYPES:
+        return "float"
+    return "text"
+
+
+def column_path(table_dir, name, suffix):
+    return Path(table_dir, f"{name}.{suffix}")
+
+
+# Write rows, an iterable of tuples in the order of columns, a list of
+# (name, kind) pairs, to a table directory. Rows are written a chunk at a
+# time, so the table never has to fit in memory. Returns the row count.
+def write_table(table_dir, columns, rows):
+    os.makedirs(table_dir, exist_ok=True)
+    files = {}
+    text_ends = {}
+    for name, kind in columns:
+        files[name, "nulls"] = open(
+            column_path(table_dir, name, "nulls"), "wb"
+        )
+        if kind == "text":
+            files[name, "offsets"] = open(
+                column_path(table_dir, name, "offsets"), "wb"
+            )
+            files[name, "data"] = open(
+                column_path(table_dir, name, "data"), "wb"
+            )
+            np.zeros(1, dtype=np.int64).tofile(files[name, "offsets"])
+            text_ends[name] = 0
+        else:
+            files[name, "values"] = open(
+                column_path(table_dir, name, "values"), "wb"
+            )
+
+    row_count = 0
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == WRITE_CHUNK_SIZE:
+                write_chunk(files, text_ends, columns, chunk)
+                row_count += len(chunk)
+                chunk = []
+        write_chunk(files, text_ends, columns, chunk)
+        row_count += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    with open(Path(table_dir, "schema.json"), "w") as f:
+        json.dump(
+            {
+                "columns": [[name, kind] for name, kind in columns],
+                "rows": row_count,
+            },
+            f,
+        )
+    return row_count
+
+
+def write_chunk(files, text_ends, columns, chunk):
+    for ii, (name, kind) in enumerate(columns):
+        values = [row[ii] for row in chunk]
+        nulls = np.fromiter(
+            (value is None for value in values), dtype=np.bool_
+        )
+        nulls.tofile(files[name, "nulls"])
+        if kind == "text":
+            encoded = [
+                b"" if value is None else encode_text(value)
+                for value in values
+            ]
+            ends = np.cumsum(
+                np.fromiter(map(len, encoded), dtype=np.int64), dtype=np.int64
+            )
+            (ends + text_ends[name]).tofile(files[name, "offsets"])
+            if len(ends):
+                text_ends[name] += int(ends[-1])
+            files[name, "data"].write(b"".join(encoded))
+        else:
+            dtype = VALUE_DTYPES[kind]
+            convert = int if kind == "int" else float
+            np.fromiter(
+                (0 if value is None else convert(value) for value in values),
+                dtype=dtype,
+                count=len(values),
+            ).tofile(files[name, "values"])
+
+
+# Text is stored as UTF-8. Bytes that aren't valid UTF-8, or strings
+# with lone surrogates, raise an error here rather than failing to load
+# into Postgres later.
+def encode_text(value):
+    if isinstance(value, (bytes, bytearray)):
+        bytes(value).decode("utf-8")
+        return bytes(value)
+    return str(value).encode("utf-8")
+
+
+def decode_text(data):
+    return data.decode("utf-8")
+
+
+def read_schema(table_dir):
+    with open(Path(table_dir, "schema.json")) as f:
+        schema = json.load(f)
+    return [tuple(column) for column in schema["columns"]], schema["rows"]
+
+
+def memmap_file(path, dtype, count):
+    if count == 0:
+        # mmap can't map an empty file
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+# Memory map the files of one column. Returns (nulls, values) for
+# numbers, and (nulls, offsets, data) for text.
+def map_column(table_dir, name, kind, row_count):
+    nulls = memmap_file(
+        column_path(table_dir, name, "nulls"), np.bool_, row_count
+    )
+    if kind != "text":
+        return nulls, memmap_file(
+            column_path(table_dir, name, "values"),
+            VALUE_DTYPES[kind],
+            row_count,
+        )
+    offsets = memmap_file(
+        column_path(table_dir, name, "offsets"), np.int64, row_count + 1
+    )
+    data = memmap_file(
+        column_path(table_dir, name, "data"), np.uint8, int(offsets[-1])
+    )
+    return nulls, offsets, data
+
+
+# Read one column into an array: nullable Int64 for ints, float64 with
+# NaN for nulls, and an object array of str or None for text
+def read_column(table_dir, name, kind, row_count):
+    mapped = map_column(table_dir, name, kind, row_count)
+    nulls = np.asarray(mapped[0])
+    if kind == "int":
+        return pd.arrays.IntegerArray(np.array(mapped[1]), nulls.copy())
+    if kind == "float":
+        return np.where(nulls, np.nan, mapped[1])
+    _, offsets, data = mapped
+    data = data.tobytes()
+    offsets = offsets.tolist()
+    values = np.empty(row_count, dtype=object)
+    for ii, is_null in enumerate(nulls.tolist()):
+        if not is_null:
+            values[ii] = decode_text(data[offsets[ii] : offsets[ii + 1]])
+    return values
+
+
+# Read some or all of a table's columns into a DataFrame
+def read_table(table_dir, columns=None):
+    table_columns, row_count = read_schema(table_dir)
+    kinds = dict(table_columns)
+    if columns is None:
+        columns = [name for name, _ in table_columns]
+    return pd.DataFrame(
+        {
+            name: read_column(table_dir, name, kinds[name], row_count)
+            for name in columns
+        },
+        columns=columns,
+    )
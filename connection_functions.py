@@ -0,0 +1,114 @@
+import mysql.connector
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_UNKNOWN
+from sqlalchemy import create_engine, event
+
+import setup_configuration as cfg
+
+# Each pool worker keeps one long-lived connection to each database
+# instead of connecting once per task. These are set by init_worker in
+# the worker process and are replaced whenever a health check fails.
+source_conn = None
+dest_conn = None
+alchemy_engine = None
+connections_opened = None
+
+
+def init_worker(connection_counter):
+    # Pool initializer. The counter is a shared multiprocessing Value
+    # used to report how many connections the whole run opened.
+    global alchemy_engine, connections_opened
+    connections_opened = connection_counter
+
+    # Engines must not be shared across a fork, so each worker builds
+    # its own with a single pooled connection that is pinged on checkout
+    alchemy_engine = create_engine(
+        cfg.SOURCE_DB_ALCHEMY_CONN_STRING,
+        pool_size=1,
+        max_overflow=0,
+        pool_pre_ping=True,
+    )
+    event.listen(alchemy_engine, "connect", count_connection)
+
+
+def count_connection(*_):
+    if connections_opened is None:
+        return
+    with connections_opened.get_lock():
+        connections_opened.value += 1
+
+
+def get_source_conn():
+    global source_conn
+    if source_conn is not None:
+        try:
+            # is_connected pings the server, which is far cheaper than
+            # the handshake and authentication of a new connection
+            if source_conn.is_connected():
+                return source_conn
+        except mysql.connector.Error:
+            pass
+        reset_source_conn()
+
+    source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+    count_connection()
+    return source_conn
+
+
+def get_dest_conn():
+    global dest_conn
+    if dest_conn is not None:
+        if (
+            not dest_conn.closed
+            and dest_conn.get_transaction_status()
+            != TRANSACTION_STATUS_UNKNOWN
+        ):
+            return dest_conn
+        reset_dest_conn()
+
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    count_connection()
+    return dest_conn
+
+
+def get_alchemy_engine():
+    global alchemy_engine
+    if alchemy_engine is None:
+        # Called outside of a pool worker, e.g. in the parent process
+        alchemy_engine = create_engine(
+            cfg.SOURCE_DB_ALCHEMY_CONN_STRING, pool_pre_ping=True
+        )
+        event.listen(alchemy_engine, "connect", count_connection)
+    return alchemy_engine
+
+
+def reset_source_conn():
+    global source_conn
+    try:
+        source_conn.close()
+    except (AttributeError, mysql.connector.Error):
+        pass
+    source_conn = None
+
+
+def reset_dest_conn():
+    global dest_conn
+    try:
+        dest_conn.close()
+    except (AttributeError, psycopg2.Error):
+        pass
+    dest_conn = None
+
+
+def is_connection_error(exception):
+    # Errors that mean the connection itself is unusable, as opposed to
+    # a problem with the data or the query
+    return isinstance(
+        exception,
+        (
+            mysql.connector.errors.InterfaceError,
+            mysql.connector.errors.OperationalError,
+            psycopg2.InterfaceError,
+            psycopg2.OperationalError,
+        ),
+    )
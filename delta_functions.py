@@ -0,0 +1,363 @@
+import hashlib
+
+import setup_configuration as cfg
+import snapshot_functions as snapshot
+from bulk_load_functions import ISBN_COLUMNS, copy_rows
+from migration_functions import (
+    filter_contents,
+    get_contents,
+    get_series_ancestors,
+    get_series_dict,
+)
+
+# A delta run only rebuilds the books whose source data changed since
+# the last run. Every source title gets a fingerprint of what the
+# migration reads about it: its own row and notes, its authors, pubs,
+# web pages, awards and series. The fingerprints the tables were built
+# from are kept in title_fingerprints, along with the root_id of each
+# title's work (its title_parent, or itself), since a book is built from
+# every title of its work.
+
+FINGERPRINT_COLUMNS = ("title_id", "root_id", "fingerprint")
+
+
+# Each query returns (title_id, digest) rows for one kind of source data
+def fingerprint_queries():
+    return [
+        (
+            "authors",
+            """
+            SELECT ca.title_id,
+                MD5(GROUP_CONCAT(
+                    CONCAT_WS(',', ca.author_id, QUOTE(ca.ca_status),
+                        QUOTE(a.author_canonical))
+                    ORDER BY ca.author_id, ca.ca_status
+                    SEPARATOR ';'
+                ))
+            FROM canonical_author AS ca
+            JOIN authors AS a
+            ON a.author_id = ca.author_id
+            GROUP BY ca.title_id;
+            """,
+        ),
+        (
+            "pubs",
+            """
+            SELECT c.title_id,
+                MD5(GROUP_CONCAT(
+                    CONCAT_WS(',', p.pub_id, QUOTE(p.pub_year),
+                        QUOTE(p.pub_pages), QUOTE(p.pub_ptype),
+                        QUOTE(p.pub_ctype), QUOTE(p.pub_isbn),
+                        QUOTE(p.pub_frontimage))
+                    ORDER BY p.pub_id
+                    SEPARATOR ';'
+                ))
+            FROM pub_content AS c
+            JOIN pubs AS p
+            ON p.pub_id = c.pub_id
+            GROUP BY c.title_id;
+            """,
+        ),
+        (
+            "webpages",
+            """
+            SELECT title_id,
+                MD5(GROUP_CONCAT(url ORDER BY url SEPARATOR ';'))
+            FROM webpages
+            WHERE title_id IS NOT NULL
+            GROUP BY title_id;
+            """,
+        ),
+        (
+            "awards",
+            """
+            SELECT ta.title_id,
+                MD5(GROUP_CONCAT(
+                    CONCAT_WS(',', ta.award_id, QUOTE(a.award_level))
+                    ORDER BY ta.award_id
+                    SEPARATOR ';'
+                ))
+            FROM title_awards AS ta
+            JOIN awards AS a
+            ON a.award_id = ta.award_id
+            GROUP BY ta.title_id;
+            """,
+        ),
+    ]
+
+
+# Fingerprint every title in the source, as a dict from title_id to
+# (root_id, fingerprint). With a None source_cur, the snapshot is
+# fingerprinted instead.
+def get_title_fingerprints(source_cur):
+    if source_cur is None:
+        title_rows = snapshot.fingerprint_title_rows()
+        part_rows = snapshot.fingerprint_part_rows()
+    else:
+        title_rows, part_rows = query_fingerprint_rows(source_cur)
+
+    root_ids = {}
+    parts = {}
+    series_ids = {}
+    for title_id, parent_id, series_id, digest in title_rows:
+        root_ids[title_id] = parent_id if parent_id else title_id
+        parts[title_id] = [f"title:{digest}"]
+        if series_id:
+            series_ids[title_id] = series_id
+
+    for name, rows in part_rows:
+        for title_id, digest in rows:
+            if title_id in parts:
+                parts[title_id].append(f"{name}:{digest}")
+
+    # Series strings include the titles of every ancestor series, so a
+    # renamed series changes the fingerprint of the titles below it
+    series_dict = get_series_dict(source_cur)
+    for title_id, series_id in series_ids.items():
+        if series_id in series_dict:
+            series_titles = (series_dict[series_id][0],)
+            series_titles += get_series_ancestors(series_id, series_dict)
+            parts[title_id].append(f"series:{series_titles!r}")
+
+    return {
+        title_id: (
+            root_ids[title_id],
+            hashlib.md5("|".join(title_parts).encode()).hexdigest(),
+        )
+        for title_id, title_parts in parts.items()
+    }
+
+
+def query_fingerprint_rows(source_cur):
+    # The default limit would silently truncate the concatenated rows
+    source_cur.execute("SET SESSION group_concat_max_len = 67108864;")
+    source_cur.execute(
+        """
+        SELECT t.title_id, t.title_parent, t.series_id,
+            MD5(CONCAT_WS(',', QUOTE(t.title_title),
+                QUOTE(t.title_synopsis), QUOTE(t.note_id),
+                QUOTE(t.series_id), QUOTE(t.title_seriesnum),
+                QUOTE(t.title_copyright), QUOTE(t.title_ttype),
+                QUOTE(t.title_parent), QUOTE(t.title_rating),
+                QUOTE(t.title_seriesnum_2), QUOTE(t.title_jvn),
+                QUOTE(t.title_language), QUOTE(t.title_storylen),
+                QUOTE(t.title_non_genre), QUOTE(t.title_graphic),
+                QUOTE(n.note_note), QUOTE(s.note_note)))
+        FROM titles AS t
+        LEFT JOIN notes AS n
+        ON n.note_id = t.note_id
+        LEFT JOIN notes AS s
+        ON s.note_id = t.title_synopsis;
+        """
+    )
+    title_rows = source_cur.fetchall()
+    part_rows = []
+    for name, sql in fingerprint_queries():
+        source_cur.execute(sql)
+        part_rows.append((name, source_cur.fetchall()))
+    return title_rows, part_rows
+
+
+def store_title_fingerprints(fingerprints, dest_cur):
+    dest_cur.execute("TRUNCATE title_fingerprints;")
+    copy_rows(
+        "title_fingerprints",
+        FINGERPRINT_COLUMNS,
+        [
+            (title_id, root_id, fingerprint)
+            for title_id, (root_id, fingerprint) in sorted(
+                fingerprints.items()
+            )
+        ],
+        dest_cur,
+    )
+
+
+def get_stored_fingerprints(dest_cur):
+    dest_cur.execute(
+        """
+        SELECT title_id, root_id, fingerprint
+        FROM title_fingerprints;
+        """
+    )
+    return {
+        title_id: (root_id, fingerprint)
+        for title_id, root_id, fingerprint in dest_cur.fetchall()
+    }
+
+
+# Titles that were added, removed, moved to another work, or changed
+def find_changed_titles(old_fingerprints, new_fingerprints):
+    return {
+        title_id
+        for title_id in old_fingerprints.keys() | new_fingerprints.keys()
+        if old_fingerprints.get(title_id) != new_fingerprints.get(title_id)
+    }
+
+
+# The works the titles belonged to in any of the fingerprint dicts. A
+# title that isn't in any of them is taken to be its own work.
+def get_work_roots(title_ids, *fingerprint_dicts):
+    roots = set()
+    for title_id in title_ids:
+        title_roots = {
+            fingerprints[title_id][0]
+            for fingerprints in fingerprint_dicts
+            if title_id in fingerprints
+        }
+        roots |= title_roots or {title_id}
+    return roots
+
+
+# The title_ids of each work's titles, in any of the fingerprint dicts
+def index_work_titles(*fingerprint_dicts):
+    work_titles = {}
+    for fingerprints in fingerprint_dicts:
+        for title_id, (root_id, _) in fingerprints.items():
+            work_titles.setdefault(root_id, set()).add(title_id)
+    return work_titles
+
+
+# The isbns table is deduplicated in place, so the isbn rows it had
+# before deduplication are kept in raw_isbns. A delta run uses them to
+# find every book whose deduplication depends on the books it rebuilds.
+def record_raw_isbns(isbn_rows, dest_cur):
+    dest_cur.execute("TRUNCATE raw_isbns;")
+    copy_rows("raw_isbns", ISBN_COLUMNS, isbn_rows, dest_cur)
+
+
+def get_raw_isbns(title_ids, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT isbn, title_id, book_type, foreign_lang
+        FROM raw_isbns
+        WHERE title_id = ANY(%s);
+        """,
+        (sorted(title_ids),),
+    )
+    return dest_cur.fetchall()
+
+
+def get_raw_claimants(isbns, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT DISTINCT title_id
+        FROM raw_isbns
+        WHERE isbn = ANY(%s);
+        """,
+        (sorted(isbns),),
+    )
+    return {row[0] for row in dest_cur.fetchall()}
+
+
+# The book each merged book finally ended up in, by loser_id
+def get_merged_books(dest_cur):
+    dest_cur.execute(
+        """
+        SELECT loser_id, winner_id
+        FROM merged_books;
+        """
+    )
+    return dict(dest_cur.fetchall())
+
+
+# The types the books had before any of them were merged. Merged books
+# aren't in the books table anymore, but their isbn rows have their type.
+def get_premerge_book_types(merged_books, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT title_id, book_type
+        FROM books
+        WHERE NOT virtual;
+        """
+    )
+    book_types = dict(dest_cur.fetchall())
+    dest_cur.execute(
+        """
+        SELECT DISTINCT title_id, book_type
+        FROM raw_isbns
+        WHERE title_id = ANY(%s);
+        """,
+        (sorted(merged_books),),
+    )
+    book_types.update(dest_cur.fetchall())
+    return book_types
+
+
+# Books with any of the title_ids among their contents, according to
+# the contents table
+def get_dest_containers(title_ids, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT DISTINCT book_title_id
+        FROM contents
+        WHERE content_title_id = ANY(%s);
+        """,
+        (sorted(title_ids),),
+    )
+    return {row[0] for row in dest_cur.fetchall()}
+
+
+# Titles whose pubs include any of the title_ids, and the works of their
+# cfg.MY_LANG variants, which is where get_contents looks for contents
+def get_source_containers(title_ids, source_cur, chunk_size=1000):
+    if source_cur is None:
+        rows = snapshot.container_rows(title_ids)
+    else:
+        rows = query_container_rows(title_ids, source_cur, chunk_size)
+    containers = set()
+    for title_id, parent_id, language in rows:
+        containers.add(title_id)
+        if parent_id and language == cfg.MY_LANG:
+            containers.add(parent_id)
+    return containers
+
+
+def query_container_rows(title_ids, source_cur, chunk_size):
+    title_ids = sorted(title_ids)
+    rows = []
+    for ii in range(0, len(title_ids), chunk_size):
+        chunk = title_ids[ii : ii + chunk_size]
+        in_list = ", ".join(["%s"] * len(chunk))
+        source_cur.execute(
+            f"""
+            SELECT DISTINCT c1.title_id, t1.title_parent, t1.title_language
+            FROM pub_content AS c2
+            JOIN pub_content AS c1
+            ON c1.pub_id = c2.pub_id
+                JOIN titles AS t1
+                ON t1.title_id = c1.title_id
+            WHERE c2.title_id IN ({in_list});
+            """,
+            tuple(chunk),
+        )
+        rows.extend(source_cur.fetchall())
+    return rows
+
+
+# Work out the contents of books the way the contents stage and the ISBN
+# deduplication would have. A book's contents are its own and those of
+# every book merged into it, found with book_types from before the
+# merges, and then pointed at the books that the contents were merged
+# into, if any.
+def get_book_contents(book_ids, merged_books, book_types, source_cur):
+    merged_into = {}
+    for loser_id, winner_id in merged_books.items():
+        merged_into.setdefault(winner_id, []).append(loser_id)
+
+    content_rows = []
+    for book_id in sorted(book_ids):
+        for title_id in [book_id] + sorted(merged_into.get(book_id, [])):
+            content_rows.extend(get_contents(title_id, title_id, source_cur))
+
+    contents = set()
+    for book_title_id, content_title_id in filter_contents(
+        content_rows, book_types
+    ):
+        book_title_id = merged_books.get(book_title_id, book_title_id)
+        content_title_id = merged_books.get(
+            content_title_id, content_title_id
+        )
+        if book_title_id != content_title_id:
+            contents.add((book_title_id, content_title_id))
+    return sorted(contents)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+# Read the tables the migration uses straight out of an ISFDB MySQL
+# backup (a mysqldump .sql file, optionally inside a .gz or .zip) and
+# store them with columnar_store, without restoring the backup into
+# MySQL first. The dump is read a line at a time, and each extended
+# INSERT line is split into rows with a single regular expression.
+#
+# Usage: python dump_parser.py BACKUP SNAPSHOT_DIR
+
+import codecs
+import gzip
+import re
+import sys
+import zipfile
+from datetime import datetime
+from pathlib import Path
+
+from columnar_store import SOURCE_TABLES, column_kind, write_table
+
+CREATE_TABLE_REGEX = re.compile(r"CREATE TABLE `([^`]+)`")
+TABLE_CHARSET_REGEX = re.compile(r"\).* CHARSET=(\w+)")
+SET_NAMES_REGEX = re.compile(r"(?:/\*!\d+ )?SET NAMES (\w+)")
+COLUMN_DEF_REGEX = re.compile(r"\s*`([^`]+)`\s+(\w+)")
+INSERT_REGEX = re.compile(r"INSERT INTO `([^`]+)`(?: \(([^)]*)\))? VALUES ")
+
+# The values of an INSERT statement. Strings come first so nothing
+# inside them is taken for another token, and hex literals come before
+# numbers. Anything else, like commas or a _binary prefix, is skipped.
+VALUE_TOKEN_REGEX = re.compile(
+    r"'((?:[^'\\]|\\.|'')*)'"
+    r"|(NULL)"
+    r"|0x([0-9A-Fa-f]*)"
+    r"|(-?[0-9][0-9.eE+-]*)"
+    r"|([()])",
+    re.DOTALL,
+)
+ESCAPE_REGEX = re.compile(r"\\(.)|''", re.DOTALL)
+MYSQL_ESCAPES = {
+    "0": "\0",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "t": "\t",
+    "Z": "\x1a",
+}
+
+
+# The dump is in the character set of its SET NAMES, which mysqldump
+# converts every table to. With SET NAMES binary, or none at all, each
+# table is in the character set it was created with. MySQL's latin1 is
+# cp1252, with the five bytes cp1252 leaves out kept as the control
+# characters with the same numbers.
+MYSQL_CODECS = {
+    "utf8": "utf-8",
+    "utf8mb3": "utf-8",
+    "utf8mb4": "utf-8",
+    "ascii": "ascii",
+}
+MYSQL_LATIN1 = "".join(
+    bytes([byte]).decode("cp1252", errors="ignore") or chr(byte)
+    for byte in range(256)
+)
+
+
+# Bytes that aren't valid in the character set raise an error, rather
+# than being stored as something that can't be loaded later
+def decode_mysql(data, charset):
+    try:
+        if charset == "latin1":
+            return codecs.charmap_decode(data, "strict", MYSQL_LATIN1)[0]
+        return data.decode(MYSQL_CODECS.get(charset, charset))
+    except UnicodeDecodeError as e:
+        raise Exception(f"The dump has text that isn't valid {charset}") from e
+    except LookupError as e:
+        raise Exception(f"Unsupported character set: {charset}") from e
+
+
+def unescape_mysql(text):
+    if "\\" not in text and "''" not in text:
+        return text
+    return ESCAPE_REGEX.sub(unescape_match, text)
+
+
+def unescape_match(match):
+    if match.group(1) is None:
+        # A quote doubled inside the string
+        return "'"
+    return MYSQL_ESCAPES.get(match.group(1), match.group(1))
+
+
+# Split the values of an INSERT statement into row tuples
+def parse_values(values_sql):
+    row = None
+    for match in VALUE_TOKEN_REGEX.finditer(values_sql):
+        string, null, hex_digits, number, paren = match.groups()
+        if paren == "(":
+            row = []
+        elif paren == ")":
+            yield tuple(row)
+        elif string is not None:
+            row.append(unescape_mysql(string))
+        elif null is not None:
+            row.append(None)
+        elif hex_digits is not None:
+            row.append(bytes.fromhex(hex_digits))
+        elif "." in number or "e" in number or "E" in number:
+            row.append(float(number))
+        else:
+            row.append(int(number))
+
+
+# Open a backup, whether it's a plain .sql file or compressed. The
+# lines are read as bytes, and decoded by iter_dump_tables.
+def open_dump(path):
+    path = Path(path)
+    if path.suffix == ".gz":
+        binary = gzip.open(path, "rb")
+    elif path.suffix == ".zip":
+        archive = zipfile.ZipFile(path)
+        sql_names = [n for n in archive.namelist() if n.endswith(".sql")]
+        binary = archive.open(sql_names[0])
+    else:
+        binary = open(path, "rb")
+    return binary
+
+
+# Yield (table, columns, rows) for each of the tables in the dump, where
+# columns is a list of (name, kind) pairs and rows is a generator of the
+# table's rows. The rows must be read before moving on to the next
+# table, since both are read from the same stream.
+def iter_dump_tables(dump_file, tables=SOURCE_TABLES):
+    lines = iter(dump_file)
+    pending = []
+    dump_charset = None
+    table_charset = None
+
+    def next_line():
+        nonlocal dump_charset, table_charset
+        if pending:
+            return pending.pop()
+        line = next(lines, None)
+        if line is None:
+            return None
+        line = decode_mysql(line, dump_charset or table_charset or "utf8")
+        set_names = SET_NAMES_REGEX.match(line)
+        if set_names:
+            dump_charset = set_names.group(1).lower()
+            if dump_charset == "binary":
+                dump_charset = None
+        # The charset of every table is kept track of, including the
+        # ones that are skipped, since their rows are still decoded
+        charset = TABLE_CHARSET_REGEX.match(line)
+        if charset:
+            table_charset = charset.group(1).lower()
+        return line
+
+    def table_rows(table, column_names):
+        while True:
+            line = next_line()
+            if line is None:
+                return
+            if line.startswith(("CREATE TABLE", "DROP TABLE", "UNLOCK")):
+                pending.append(line)
+                return
+            insert = INSERT_REGEX.match(line)
+            if not insert or insert.group(1) != table:
+                continue
+            rows = parse_values(line[insert.end() :])
+            if insert.group(2) is None:
+                yield from rows
+                continue
+            # Put the values of an INSERT with a column list in the
+            # order of the table's columns
+            positions = [
+                name.strip(" `") for name in insert.group(2).split(",")
+            ]
+            for row in rows:
+                values = dict(zip(positions, row))
+                yield tuple(values.get(name) for name in column_names)
+
+    while True:
+        line = next_line()
+        if line is None:
+            return
+        create = CREATE_TABLE_REGEX.match(line)
+        if not create or create.group(1) not in tables:
+            continue
+        table = create.group(1)
+        columns = []
+        while True:
+            line = next_line()
+            if line is None or line.startswith(")"):
+                break
+            column_def = COLUMN_DEF_REGEX.match(line)
+            if column_def:
+                name, sql_type = column_def.groups()
+                columns.append((name, column_kind(sql_type)))
+        rows = table_rows(table, [name for name, _ in columns])
+        yield table, columns, rows
+        # Skip whatever the caller didn't read
+        for _ in rows:
+            pass
+
+
+# Store every table the migration uses from the backup in snapshot_dir,
+# one directory per table. Returns the row count of each table.
+def convert_dump(dump_path, snapshot_dir, tables=SOURCE_TABLES):
+    row_counts = {}
+    with open_dump(dump_path) as dump_file:
+        for table, columns, rows in iter_dump_tables(dump_file, tables):
+            start = datetime.now()
+            row_counts[table] = write_table(
+                Path(snapshot_dir, table), columns, rows
+            )
+            print(
+                f"{table}: {row_counts[table]} rows "
+                + f"in {datetime.now() - start}"
+            )
+    missing = set(tables) - set(row_counts)
+    if missing:
+        raise Exception(
+            "The dump doesn't have these tables: " + ", ".join(sorted(missing))
+        )
+    return row_counts
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python dump_parser.py BACKUP SNAPSHOT_DIR")
+        sys.exit(1)
+    start = datetime.now()
+    convert_dump(sys.argv[1], sys.argv[2])
+    print(f"Total time: {datetime.now() - start}")
@@ -1,4 +1,11 @@
+import logging
+
+import numpy as np
+
 import setup_configuration as cfg
+from bulk_load_functions import ISBN_COLUMNS, copy_rows
+
+logger = logging.getLogger(__name__)
 
 
 def get_all_isbn_tuples(dest_cur):
@@ -23,6 +30,69 @@ def get_duplicate_isbns(dest_cur):
     return dest_cur.fetchall()
 
 
+# Split the duplicate ISBNs into groups that can be deduplicated
+# independently of each other. Two ISBNs are in the same group when they
+# are connected through the books that claim them, or through contents
+# linking those books, since deduplicating one ISBN can move or delete
+# the other's claimants. Each group is a list of ISBNs in sorted order,
+# and the groups are ordered largest first.
+def get_duplicate_isbn_components(dest_cur):
+    duplicate_isbns = [row[0] for row in get_duplicate_isbns(dest_cur)]
+    dest_cur.execute(
+        """
+        SELECT isbn, title_id
+        FROM isbns
+        WHERE isbn = ANY(%s)
+        AND title_id != %s;
+        """,
+        (duplicate_isbns, cfg.INCONSISTENT_ISBN_VIRTUAL_TITLE),
+    )
+    claims = dest_cur.fetchall()
+    dest_cur.execute(
+        """
+        SELECT book_title_id, content_title_id
+        FROM contents
+        WHERE book_title_id = ANY(%s)
+        AND content_title_id = ANY(%s);
+        """,
+        ([claim[1] for claim in claims],) * 2,
+    )
+    contents = dest_cur.fetchall()
+
+    parents = {("isbn", isbn): ("isbn", isbn) for isbn in duplicate_isbns}
+    for isbn, title_id in claims:
+        union_nodes(parents, ("isbn", isbn), ("title", title_id))
+    for book_title_id, content_title_id in contents:
+        union_nodes(
+            parents, ("title", book_title_id), ("title", content_title_id)
+        )
+
+    components = {}
+    for isbn in sorted(duplicate_isbns):
+        root = find_root(parents, ("isbn", isbn))
+        components.setdefault(root, []).append(isbn)
+    return sorted(
+        components.values(), key=lambda isbns: (-len(isbns), isbns[0])
+    )
+
+
+# Union-find over a dict of parent pointers, with path halving
+def find_root(parents, node):
+    parents.setdefault(node, node)
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+def union_nodes(parents, a, b):
+    a_root = find_root(parents, a)
+    b_root = find_root(parents, b)
+    if a_root != b_root:
+        # Keep the smaller root so the result doesn't depend on order
+        parents[max(a_root, b_root)] = min(a_root, b_root)
+
+
 def insert_virtual_books(dest_cur):
     ambigous_isbn_note = (
         "You have arrived at this page because the "
@@ -72,6 +142,413 @@ def isbn13_to_10(isbn13):
     return isbn13[3:12] + str(cd)
 
 
+# Convert a whole list of ISBNs at once. Each ISBN-10 becomes an ISBN-13
+# and each ISBN-13 starting with 978 becomes an ISBN-10, the same as
+# isbn10_to_13 and isbn13_to_10. Returns the converted ISBNs (None where
+# there is no equivalent or the ISBN can't be converted), a mask of the
+# ISBNs that couldn't be converted, and a mask of the ISBNs whose own
+# check digit is wrong.
+def convert_isbns(isbns):
+    lengths = np.array([len(isbn) for isbn in isbns], dtype=np.int64)
+    is_10 = lengths == 10
+    is_13 = lengths == 13
+
+    # One row of unicode code points per ISBN, padded with zeros
+    codes = (
+        np.array(isbns, dtype="U13")
+        .view(np.uint32)
+        .reshape(len(isbns), 13)
+        .astype(np.int64)
+    )
+    digits = codes - ord("0")
+    is_digit = (digits >= 0) & (digits <= 9)
+    digits = np.where(is_digit, digits, 0)
+
+    # ISBN-10 to 13: "978", the first nine digits, and a new check digit
+    convertible_10 = is_10 & is_digit[:, :9].all(axis=1)
+    cd_13 = (
+        10
+        - (
+            38
+            + 3 * digits[:, 0:9:2].sum(axis=1)
+            + digits[:, 1:9:2].sum(axis=1)
+        )
+        % 10
+    ) % 10
+    isbn_13s = np.concatenate(
+        [
+            np.broadcast_to(
+                np.array([ord(c) for c in "978"]), (len(isbns), 3)
+            ),
+            codes[:, :9],
+            (cd_13 + ord("0"))[:, np.newaxis],
+        ],
+        axis=1,
+    )
+
+    # ISBN-13 to 10: the nine digits after "978", and a new check digit
+    is_978 = is_13 & (codes[:, :3] == [ord(c) for c in "978"]).all(axis=1)
+    convertible_13 = is_978 & is_digit[:, 3:12].all(axis=1)
+    cd_10 = (11 - (digits[:, 3:12] * np.arange(10, 1, -1)).sum(axis=1)) % 11
+    isbn_10s = np.concatenate(
+        [
+            codes[:, 3:12],
+            np.where(cd_10 == 10, ord("X"), cd_10 + ord("0"))[:, np.newaxis],
+        ],
+        axis=1,
+    )
+
+    # Validate the check digit each ISBN already has
+    check_10 = np.where(
+        is_digit[:, 9], digits[:, 9], np.where(codes[:, 9] == ord("X"), 10, -1)
+    )
+    sum_10 = (digits[:, :9] * np.arange(10, 1, -1)).sum(axis=1) + check_10
+    valid_10 = (
+        is_digit[:, :9].all(axis=1) & (check_10 >= 0) & (sum_10 % 11 == 0)
+    )
+    sum_13 = (digits * np.tile([1, 3], 7)[:13]).sum(axis=1)
+    valid_13 = is_digit.all(axis=1) & (sum_13 % 10 == 0)
+    bad_check_digit = (is_10 & ~valid_10) | (is_13 & ~valid_13)
+
+    new_13s = isbn_13s.astype(np.uint32).view("U13").ravel().tolist()
+    new_10s = isbn_10s.astype(np.uint32).view("U10").ravel().tolist()
+    new_isbns = [None] * len(isbns)
+    errors = np.zeros(len(isbns), dtype=bool)
+    for ii in np.flatnonzero(convertible_10):
+        new_isbns[ii] = new_13s[ii]
+    for ii in np.flatnonzero(convertible_13):
+        new_isbns[ii] = new_10s[ii]
+
+    # Anything the arrays couldn't handle, like non-ASCII digits, gets
+    # the scalar functions, which will raise if it really is invalid
+    for ii in np.flatnonzero(
+        ((is_10 & ~convertible_10) | (is_978 & ~convertible_13))
+        | ~(is_10 | is_13)
+    ):
+        try:
+            if is_10[ii]:
+                new_isbns[ii] = isbn10_to_13(isbns[ii])
+            elif is_13[ii]:
+                new_isbns[ii] = isbn13_to_10(isbns[ii])
+            else:
+                errors[ii] = True
+        except ValueError:
+            errors[ii] = True
+    return new_isbns, errors, bad_check_digit
+
+
+def deduplicate_isbn(isbn, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT b.title_id, b.title, b.authors, b.year, b.pages,
+            b.alt_titles, b.cover_image,
+            i.book_type, i.foreign_lang
+        FROM books AS b
+        JOIN isbns AS i
+        ON b.title_id = i.title_id
+        WHERE i.isbn = %s
+        ORDER BY
+            CASE
+                WHEN i.book_type = 'NOVEL' THEN 1
+                WHEN i.book_type = 'NOVELLA' THEN 2
+                WHEN i.book_type = 'OMNIBUS' THEN 3
+                WHEN i.book_type = 'ANTHOLOGY' THEN 4
+                WHEN i.book_type = 'COLLECTION' THEN 5
+            END,
+            b.year DESC, b.pages DESC, b.title_id DESC;
+        """,
+        (isbn,),
+    )
+    isbn_claimants = dest_cur.fetchall()
+
+    resolution = choose_isbn_resolution(isbn, isbn_claimants)
+    if resolution == "delete":
+        delete_isbn(isbn, dest_cur)
+    elif resolution == "merge":
+        winner_takes_all(isbn_claimants, dest_cur)
+
+
+# Decide how to resolve an ISBN claimed by the books in isbn_claimants,
+# in the order deduplicate_isbn selects them. Returns "delete", "merge"
+# for winner_takes_all, or None if there's nothing left to do.
+def choose_isbn_resolution(isbn, isbn_claimants):
+    if len(isbn_claimants) == 0:
+        e_str = (
+            str(isbn) + ": all records " + "for this ISBN were already deleted"
+        )
+    elif len(isbn_claimants) == 1:
+        # This title was already deduped
+        return None
+    else:
+        e_str = None
+
+    if e_str:
+        raise Exception(e_str)
+
+    # There are two ways to resolve duplicate ISBNs:
+    # delete the ISBN from both titles (most common), or
+    # "winner takes all", which is reserved for cases where
+    # the book is more or less just a new edition with extra
+    # material and the book entries can be merged. The rest
+    # of the logic in this method tries to determine this.
+    (
+        _,
+        a_title,
+        a_authors,
+        _,
+        _,
+        _,
+        _,
+        a_book_type,
+        a_foreign_lang,
+    ) = isbn_claimants[0]
+
+    (
+        _,
+        b_title,
+        b_authors,
+        _,
+        _,
+        _,
+        _,
+        b_book_type,
+        b_foreign_lang,
+    ) = isbn_claimants[1]
+
+    # The tuple of book types is a key variable in determining
+    # which case this is, since certain changes
+    # (novel to collection) are typical of extra material
+    # being added to the new edition of a book, while others
+    # (novella to omnibus) aren't possible without making it
+    # a substantially different book.
+    a_b_book_types = (a_book_type, b_book_type)
+
+    if (
+        len(isbn_claimants) > 2
+        or a_foreign_lang
+        or b_foreign_lang
+        or a_b_book_types in [("NOVELLA", "OMNIBUS"), ("NOVEL", "NOVELLA")]
+    ):
+        # Cases of more than two titles sharing an ISBN are
+        # pactically always multi-volume series that are
+        # sold under a common ISBN, which than is not useful
+        # for identifying the book. It should be deleted.
+        # Likewise, any case of foreign isbns causing
+        # duplication are too likely to cause errors with
+        # winner-take-all, and cases of book type
+        # transformation considered impossible are also deleted
+
+        return "delete"
+
+    else:
+        if a_b_book_types in [
+            ("NOVEL", "ANTHOLOGY"),
+            ("NOVEL", "COLLECTION"),
+            ("NOVEL", "OMNIBUS"),
+            ("NOVELLA", "ANTHOLOGY"),
+            ("NOVELLA", "COLLECTION"),
+        ]:
+            # Book transformations that are technically possible
+            # by adding or removing small amount of material
+            # are considered for winner-takes-all only on an
+            # exact title match
+
+            titles_match = a_title.lower() == b_title.lower()
+
+        else:
+            # The most likely cases of book transformation,
+            # included those were a and b are the same type,
+            # have a less strict name match requirement. This
+            # is allow cases like "Ghost Stories", and
+            # "Ghost Stories: now with two bonus stories".
+
+            a_simple_title = simplify_title(a_title)
+            b_simple_title = simplify_title(b_title)
+            titles_match = (
+                a_simple_title in b_simple_title
+                or b_simple_title in a_simple_title
+            )
+
+        if not titles_match:
+            return "delete"
+        else:
+            # The final requirement for winner-takes-all is
+            # for the books to have the same author(s), or
+            # to have some authors in common to account for
+            # cases of stories being added or removed from
+            # some editions.
+            a_author_set = set(a_authors.lower().split(", "))
+            b_author_set = set(b_authors.lower().split(", "))
+            authors_in_common = a_author_set.intersection(b_author_set)
+            if not authors_in_common:
+                return "delete"
+            else:
+                return "merge"
+
+
+ISBN_BOOK_TYPE_RANKS = {
+    "NOVEL": 1,
+    "NOVELLA": 2,
+    "OMNIBUS": 3,
+    "ANTHOLOGY": 4,
+    "COLLECTION": 5,
+}
+
+
+# Sort key matching the ORDER BY in deduplicate_isbn. Postgres sorts
+# NULLs last in ascending order and first in descending order.
+def claimant_order(claimant):
+    title_id, _, _, year, pages, _, _, book_type, _ = claimant
+    rank = ISBN_BOOK_TYPE_RANKS.get(book_type)
+    return (
+        rank is None,
+        rank or 0,
+        year is not None,
+        -(year or 0),
+        pages is not None,
+        -(pages or 0),
+        -title_id,
+    )
+
+
+# Index (isbn, title_id, book_type, foreign_lang) rows by isbn and by
+# title_id. Like the isbns table, only the first row for each isbn and
+# title_id is kept.
+def index_isbn_claims(isbn_rows):
+    claims = {}
+    title_isbns = {}
+    for isbn, title_id, book_type, foreign_lang in isbn_rows:
+        isbn_claims = claims.setdefault(isbn, {})
+        if title_id not in isbn_claims:
+            isbn_claims[title_id] = (book_type, foreign_lang)
+            title_isbns.setdefault(title_id, set()).add(isbn)
+    return claims, title_isbns
+
+
+def get_claimant_books(isbn_rows, dest_cur):
+    # The fields deduplicate_isbn uses from the books claiming a
+    # duplicate isbn, by title_id
+    claims, _ = index_isbn_claims(isbn_rows)
+    claimant_ids = {
+        title_id
+        for isbn_claims in claims.values()
+        if len(isbn_claims) > 1
+        for title_id in isbn_claims
+    }
+    dest_cur.execute(
+        """
+        SELECT title_id, title, authors, year, pages,
+            alt_titles, cover_image
+        FROM books
+        WHERE title_id = ANY(%s);
+        """,
+        (sorted(claimant_ids),),
+    )
+    return {row[0]: row[1:] for row in dest_cur.fetchall()}
+
+
+# Work out the deduplication of every duplicate isbn in memory, with the
+# same decisions and the same effect on the isbns table as running
+# deduplicate_isbn on each of them in sorted order. isbn_rows are all
+# the rows the isbns table would have before deduplication, and books
+# comes from get_claimant_books. Returns the plan, a list of
+# (resolution, isbn, isbn_claimants) steps, the rows the isbns table
+# should be left with, and the number of isbns deduplicated and errored.
+def plan_isbn_deduplication(isbn_rows, books):
+    claims, title_isbns = index_isbn_claims(isbn_rows)
+    virtual_id = cfg.INCONSISTENT_ISBN_VIRTUAL_TITLE
+    duplicate_isbns = sorted(
+        isbn for isbn, isbn_claims in claims.items() if len(isbn_claims) > 1
+    )
+
+    plan = []
+    isbns_deduped = 0
+    isbns_errored = 0
+    for isbn in duplicate_isbns:
+        try:
+            isbn_claimants = sorted(
+                [
+                    (title_id, *books[title_id], book_type, foreign_lang)
+                    for title_id, (book_type, foreign_lang) in claims[
+                        isbn
+                    ].items()
+                ],
+                key=claimant_order,
+            )
+            resolution = choose_isbn_resolution(isbn, isbn_claimants)
+            if resolution == "delete" and virtual_id in claims[isbn]:
+                # delete_isbn's insert would violate the unique constraint
+                raise Exception(
+                    f"{isbn}: already claimed by the virtual title"
+                )
+        except Exception:
+            logger.exception(f"\n{isbn}\tFailed to dedulpicate")
+            isbns_errored += 1
+            continue
+
+        if resolution == "delete":
+            for title_id in claims[isbn]:
+                title_isbns[title_id].discard(isbn)
+            claims[isbn] = {virtual_id: ("NOVEL", False)}
+            title_isbns.setdefault(virtual_id, set()).add(isbn)
+        elif resolution == "merge":
+            # The winner gets copies of the losers' isbns, without their
+            # foreign_lang, and the losers' own rows go with their books
+            winner_id = isbn_claimants[0][0]
+            for claimant in isbn_claimants[1:]:
+                for loser_isbn in title_isbns.pop(claimant[0], set()):
+                    book_type, _ = claims[loser_isbn].pop(claimant[0])
+                    if winner_id not in claims[loser_isbn]:
+                        claims[loser_isbn][winner_id] = (book_type, False)
+                        title_isbns[winner_id].add(loser_isbn)
+
+        if resolution is not None:
+            plan.append((resolution, isbn, isbn_claimants))
+        isbns_deduped += 1
+
+    final_isbn_rows = [
+        (isbn, title_id, book_type, foreign_lang)
+        for isbn, isbn_claims in claims.items()
+        for title_id, (book_type, foreign_lang) in isbn_claims.items()
+    ]
+    return plan, final_isbn_rows, isbns_deduped, isbns_errored
+
+
+# Write the result of plan_isbn_deduplication. All the merges are done
+# together by merge_books, and the isbns table is replaced with the
+# planned rows in one go. Without replace_isbns, the planned rows are
+# added to the table instead, for callers that already deleted the rows
+# they replace. Returns the number of rows each step affected.
+def apply_isbn_deduplication_plan(
+    plan, final_isbn_rows, dest_cur, replace_isbns=True
+):
+    row_counts = merge_books(
+        [
+            (isbn_claimants[0][0], claimant[0], claimant[6])
+            for resolution, _, isbn_claimants in plan
+            if resolution == "merge"
+            for claimant in isbn_claimants[1:]
+        ],
+        dest_cur,
+        transfer_isbns=False,
+    )
+
+    dest_cur.execute(
+        """
+        UPDATE books
+        SET isbn = NULL
+        WHERE isbn = ANY(%s);
+        """,
+        ([isbn for resolution, isbn, _ in plan if resolution == "delete"],),
+    )
+    row_counts["cleared_book_isbns"] = dest_cur.rowcount
+    if replace_isbns:
+        dest_cur.execute("TRUNCATE isbns;")
+    copy_rows("isbns", ISBN_COLUMNS, final_isbn_rows, dest_cur)
+    row_counts["planned_isbns"] = len(final_isbn_rows)
+    return row_counts
+
+
 def delete_isbn(isbn, dest_cur):
 
     dest_cur.execute(
@@ -109,111 +586,202 @@ def winner_takes_all(isbn_claimants, dest_cur):
     # already having the item are expected and can be ignored.
 
     winner_id = isbn_claimants[0][0]
+    # TODO add losers' titles as alternate titles
+    return merge_books(
+        [
+            (winner_id, claimant[0], claimant[6])
+            for claimant in isbn_claimants[1:]
+        ],
+        dest_cur,
+    )
 
-    for claimant in isbn_claimants[1:]:
 
-        (
-            claimant_id,
-            claimant_title,
-            _,
-            _,
-            _,
-            claimant_alt_titles,
-            claimant_cover_image,
-            _,
-            _,
-        ) = claimant
-
-        dest_cur.execute(
-            """
-            INSERT INTO contents (book_title_id, content_title_id)
-            SELECT %s, content_title_id
-            FROM contents
-            WHERE (
-                book_title_id = %s
-                AND content_title_id != %s
-            )
-            ON CONFLICT DO NOTHING;
-            """,
-            (winner_id, claimant_id, winner_id),
+# Order the merges the way merge_books applies them. Each merge is
+# (winner_id, loser_id, loser_cover_image), and a winner may later lose
+# to another book. Returns a merge_map row for each loser: the book it
+# finally ends up in, the order its rows reach that book, and the cover
+# image to add to it, if any.
+def build_merge_map(merges, titles_with_images):
+    parents = {}
+    children = {}
+    for winner_id, loser_id, cover_image in merges:
+        parents[loser_id] = winner_id
+        children.setdefault(winner_id, []).append((loser_id, cover_image))
+
+    # Merged one at a time, a loser's rows go to its winner after that
+    # winner's own rows and those of earlier losers, along with
+    # everything the loser had already inherited. That's a preorder walk
+    # of the tree of merges under each final winner.
+    merge_map = []
+    for root_id in children:
+        if root_id in parents:
+            continue
+        stack = [(root_id, None)]
+        while stack:
+            book_id, cover_image = stack.pop()
+            book_children = children.get(book_id, [])
+            stack.extend(reversed(book_children))
+            if book_id == root_id:
+                continue
+            merge_map.append([book_id, root_id, len(merge_map), cover_image])
+
+    # A loser's cover is only added if it had any images when it was
+    # merged, i.e. if any book merged into it, or itself, had images
+    has_images = {}
+    for row in reversed(merge_map):
+        has_images[row[0]] = row[0] in titles_with_images or any(
+            has_images[child_id] for child_id, _ in children.get(row[0], [])
         )
+    for row in merge_map:
+        if not has_images[row[0]]:
+            row[3] = None
+    return [tuple(row) for row in merge_map]
+
+
+# Merge many losing books into their winners at once, with the same
+# result as merging them one at a time in the order given. Each merge
+# is (winner_id, loser_id, loser_cover_image). The isbns can be left
+# out when the caller writes the isbns table itself. Returns the number
+# of rows each step affected.
+def merge_books(merges, dest_cur, transfer_isbns=True):
+    if not merges:
+        return {}
+    dest_cur.execute(
+        """
+        SELECT DISTINCT title_id
+        FROM more_images
+        WHERE title_id = ANY(%s);
+        """,
+        ([merge[1] for merge in merges],),
+    )
+    titles_with_images = {row[0] for row in dest_cur.fetchall()}
+
+    dest_cur.execute(
+        """
+        CREATE TEMP TABLE IF NOT EXISTS merge_map (
+            loser_id        integer PRIMARY KEY,
+            winner_id       integer NOT NULL,
+            transfer_order  integer NOT NULL,
+            cover_image     text
+        ) ON COMMIT DELETE ROWS;
+        TRUNCATE merge_map;
+        """
+    )
+    copy_rows(
+        "merge_map",
+        ("loser_id", "winner_id", "transfer_order", "cover_image"),
+        build_merge_map(merges, titles_with_images),
+        dest_cur,
+    )
 
-        dest_cur.execute(
+    steps = [
+        (
+            "contents",
             """
             INSERT INTO contents (book_title_id, content_title_id)
-            SELECT book_title_id, %s
-            FROM contents
-            WHERE (
-                content_title_id = %s
-                AND book_title_id != %s
-            )
+            SELECT DISTINCT
+                COALESCE(b.winner_id, c.book_title_id),
+                COALESCE(w.winner_id, c.content_title_id)
+            FROM contents AS c
+            LEFT JOIN merge_map AS b
+            ON b.loser_id = c.book_title_id
+            LEFT JOIN merge_map AS w
+            ON w.loser_id = c.content_title_id
+            WHERE (b.loser_id IS NOT NULL OR w.loser_id IS NOT NULL)
+            AND COALESCE(b.winner_id, c.book_title_id)
+                != COALESCE(w.winner_id, c.content_title_id)
             ON CONFLICT DO NOTHING;
             """,
-            (winner_id, claimant_id, winner_id),
-        )
-
-        dest_cur.execute(
+        ),
+        (
+            "isbns",
             """
             INSERT INTO isbns (isbn, title_id, book_type)
-            SELECT isbn, %s, book_type
-            FROM isbns
-            WHERE title_id = %s
+            SELECT i.isbn, m.winner_id, i.book_type
+            FROM isbns AS i
+            JOIN merge_map AS m
+            ON m.loser_id = i.title_id
+            ORDER BY m.transfer_order
             ON CONFLICT DO NOTHING;
             """,
-            (winner_id, claimant_id),
-        )
-
-        dest_cur.execute(
+        ),
+        (
+            "translations",
             """
-            UPDATE translations
-            SET lowest_title_id = %s
-            WHERE lowest_title_id = %s;
+            UPDATE translations AS t
+            SET lowest_title_id = m.winner_id
+            FROM merge_map AS m
+            WHERE t.lowest_title_id = m.loser_id;
             """,
-            (winner_id, claimant_id),
-        )
-
-        dest_cur.execute(
+        ),
+        (
+            "more_images",
             """
             INSERT INTO more_images (title_id, image)
-            SELECT %s, image
-            FROM more_images
-            WHERE title_id = %s
+            SELECT m.winner_id, mi.image
+            FROM more_images AS mi
+            JOIN merge_map AS m
+            ON m.loser_id = mi.title_id
             ON CONFLICT DO NOTHING;
             """,
-            (winner_id, claimant_id),
-        )
-
-        if claimant_cover_image:
-            dest_cur.execute(
-                """
-                INSERT INTO more_images (title_id, image)
-                SELECT %s, %s
-                FROM more_images
-                WHERE title_id = %s
-                ON CONFLICT DO NOTHING;
-                """,
-                (winner_id, claimant_cover_image, claimant_id),
-            )
-
-        # Delete the losing book.
-        # Deletes will cascade to linked tables.
-        dest_cur.execute(
+        ),
+        (
+            "cover_images",
+            """
+            INSERT INTO more_images (title_id, image)
+            SELECT winner_id, cover_image
+            FROM merge_map
+            WHERE cover_image IS NOT NULL
+            ORDER BY transfer_order
+            ON CONFLICT DO NOTHING;
+            """,
+        ),
+        (
+            # Keep a record of the book each loser finally ended up in,
+            # including the losers merged into this call's losers before
+            "merged_books",
+            """
+            UPDATE merged_books AS mb
+            SET winner_id = m.winner_id
+            FROM merge_map AS m
+            WHERE mb.winner_id = m.loser_id;
+            INSERT INTO merged_books (loser_id, winner_id)
+            SELECT loser_id, winner_id
+            FROM merge_map
+            ON CONFLICT (loser_id) DO UPDATE
+            SET winner_id = EXCLUDED.winner_id;
+            """,
+        ),
+        (
+            # Deletes will cascade to linked tables
+            "deleted_books",
             """
             DELETE FROM books
-            WHERE title_id = %s;
+            WHERE title_id IN (
+                SELECT loser_id
+                FROM merge_map
+            );
             """,
-            (claimant_id,),
-        )
-
-    # TODO add losers' titles as alternate titles
-    dest_cur.execute(
-        """
-        UPDATE books
-        SET inconsistent = TRUE
-        WHERE title_id = %s
-        """,
-        (winner_id,),
-    )
+        ),
+        (
+            "inconsistent_books",
+            """
+            UPDATE books
+            SET inconsistent = TRUE
+            WHERE title_id IN (
+                SELECT winner_id
+                FROM merge_map
+            );
+            """,
+        ),
+    ]
+    row_counts = {}
+    for name, sql in steps:
+        if name == "isbns" and not transfer_isbns:
+            continue
+        dest_cur.execute(sql)
+        row_counts[name] = dest_cur.rowcount
+    return row_counts
 
 
 def simplify_title(title):
@@ -1,3 +1,4 @@
+import logging
 import os
 import re
 import shutil
@@ -5,8 +6,15 @@ import subprocess
 from html import unescape
 
 import pandas as pd
+from psycopg2.sql import SQL, Identifier
 
 import setup_configuration as cfg
+import snapshot_functions as snapshot
+
+# Functions that take a source cursor or connection read the source
+# snapshot instead when they are given None
+
+logger = logging.getLogger(__name__)
 
 
 def setup_custom_stop_words():
@@ -87,18 +95,20 @@ def create_custom_text_search_config(language_name, dest_cur):
         )
 
     dest_cur.execute(
-        """
-        CREATE TEXT SEARCH CONFIGURATION public.isfdb_title_tsc
-            ( COPY = %s );
+        SQL(
+            """
+            CREATE TEXT SEARCH CONFIGURATION {schema}.isfdb_title_tsc
+                ( COPY = %s );
 
-        ALTER TEXT SEARCH CONFIGURATION public.isfdb_title_tsc
-            DROP MAPPING FOR email, url, url_path, sfloat, float;
+            ALTER TEXT SEARCH CONFIGURATION {schema}.isfdb_title_tsc
+                DROP MAPPING FOR email, url, url_path, sfloat, float;
 
-        ALTER TEXT SEARCH CONFIGURATION public.isfdb_title_tsc
-            ALTER MAPPING FOR asciiword, asciihword, hword_asciipart,
-            word, hword, hword_part
-            WITH isfdb_title_dict;
-        """,
+            ALTER TEXT SEARCH CONFIGURATION {schema}.isfdb_title_tsc
+                ALTER MAPPING FOR asciiword, asciihword, hword_asciipart,
+                word, hword, hword_part
+                WITH isfdb_title_dict;
+            """
+        ).format(schema=Identifier(cfg.DEST_SCHEMA)),
         (language_name,),
     )
     return language_name
@@ -143,10 +153,11 @@ def create_ttype_enum(dest_cur):
 def prepare_books_tables(dest_cur):
 
     print("Creating tables...")
+    unlogged = "UNLOGGED " if cfg.UNLOGGED_LOAD else ""
     dest_cur.execute(
-        """
+        f"""
 
-        CREATE TABLE books (
+        CREATE {unlogged}TABLE books (
             title_id            integer NOT NULL,
             title               text NOT NULL CHECK (title <> ''),
             year                integer default NULL,
@@ -172,87 +183,272 @@ def prepare_books_tables(dest_cur):
             wikipedia           text default NULL CHECK (wikipedia <> ''),
             synopsis            text default NULL,
             note                text default NULL,
-            general_search      tsvector default NULL,
+            general_search      {general_search_column()},
             PRIMARY KEY (title_id)
         );
 
-        CREATE TABLE isbns (
+        CREATE {unlogged}TABLE isbns (
             id          serial PRIMARY KEY,
             isbn        varchar(13) NOT NULL CHECK (isbn <> ''),
-            title_id    integer NOT NULL
-                REFERENCES books (title_id) ON DELETE CASCADE,
+            title_id    integer NOT NULL,
             book_type   ttype NOT NULL,
-            foreign_lang     boolean default FALSE,
-            UNIQUE (isbn, title_id)
+            foreign_lang     boolean default FALSE
         );
 
-        CREATE TABLE translations (
+        CREATE {unlogged}TABLE translations (
             title_id            integer NOT NULL,
-            lowest_title_id     integer NOT NULL
-                REFERENCES books (title_id) ON DELETE CASCADE,
+            lowest_title_id     integer NOT NULL,
             title               text NOT NULL CHECK (title <> ''),
             year                integer default NULL,
             note                text default NULL,
-            PRIMARY KEY (title_id),
-            UNIQUE (title_id, lowest_title_id)
-
+            PRIMARY KEY (title_id)
         );
 
-        CREATE TABLE contents (
+        CREATE {unlogged}TABLE contents (
             id                  serial PRIMARY KEY,
-            book_title_id       integer NOT NULL
-                REFERENCES books (title_id) ON DELETE CASCADE,
+            book_title_id       integer NOT NULL,
             content_title_id    integer NOT NULL
-                REFERENCES books (title_id) ON DELETE CASCADE
                 CONSTRAINT content_of_self
-                    CHECK (content_title_id != book_title_id),
-            UNIQUE (book_title_id, content_title_id)
+                    CHECK (content_title_id != book_title_id)
         );
 
-        CREATE TABLE more_images (
+        CREATE {unlogged}TABLE more_images (
             id          serial PRIMARY KEY,
-            title_id    integer NOT NULL
-                REFERENCES books (title_id) ON DELETE CASCADE,
+            title_id    integer NOT NULL,
             image       text default NULL CHECK (image <> ''),
             UNIQUE (title_id, image)
         )
         """
     )
+    # With unlogged_load, these are added once the books and contents
+    # are loaded, by the constraints stage
+    if not cfg.UNLOGGED_LOAD:
+        add_deferred_constraints(dest_cur)
+
+    # Bookkeeping for delta runs: a fingerprint of the source data of
+    # every title the tables were built from, the isbns as they were
+    # before deduplication, and the books that were merged into others
+    dest_cur.execute(
+        """
+        CREATE TABLE title_fingerprints (
+            title_id        integer NOT NULL,
+            root_id         integer NOT NULL,
+            fingerprint     text NOT NULL,
+            PRIMARY KEY (title_id)
+        );
+
+        CREATE TABLE raw_isbns (
+            isbn            varchar(13) NOT NULL,
+            title_id        integer NOT NULL,
+            book_type       ttype NOT NULL,
+            foreign_lang    boolean default FALSE
+        );
+        CREATE INDEX raw_isbns_isbn_idx ON raw_isbns (isbn);
+        CREATE INDEX raw_isbns_title_id_idx ON raw_isbns (title_id);
+
+        CREATE TABLE merged_books (
+            loser_id        integer NOT NULL,
+            winner_id       integer NOT NULL,
+            PRIMARY KEY (loser_id)
+        );
+        """
+    )
 
 
-def populate_search_columns(dest_cur):
+# The constraints of the book tables that the loads don't rely on, as
+# (table, name, definition). They're named the way Postgres would name
+# them if they were declared with the tables. The loads do rely on the
+# primary keys, and on more_images_title_id_image_key to skip repeated
+# images, so those are always declared with the tables, along with the
+# CHECKs, which cost next to nothing. Everything after the contents
+# stage relies on the rest, like the cascading deletes of merged books.
+DEFERRED_CONSTRAINTS = [
+    (
+        "isbns",
+        "isbns_title_id_fkey",
+        "FOREIGN KEY (title_id) REFERENCES books (title_id) "
+        "ON DELETE CASCADE",
+    ),
+    ("isbns", "isbns_isbn_title_id_key", "UNIQUE (isbn, title_id)"),
+    (
+        "translations",
+        "translations_lowest_title_id_fkey",
+        "FOREIGN KEY (lowest_title_id) REFERENCES books (title_id) "
+        "ON DELETE CASCADE",
+    ),
+    (
+        "translations",
+        "translations_title_id_lowest_title_id_key",
+        "UNIQUE (title_id, lowest_title_id)",
+    ),
+    (
+        "contents",
+        "contents_book_title_id_fkey",
+        "FOREIGN KEY (book_title_id) REFERENCES books (title_id) "
+        "ON DELETE CASCADE",
+    ),
+    (
+        "contents",
+        "contents_content_title_id_fkey",
+        "FOREIGN KEY (content_title_id) REFERENCES books (title_id) "
+        "ON DELETE CASCADE",
+    ),
+    (
+        "contents",
+        "contents_book_title_id_content_title_id_key",
+        "UNIQUE (book_title_id, content_title_id)",
+    ),
+    (
+        "more_images",
+        "more_images_title_id_fkey",
+        "FOREIGN KEY (title_id) REFERENCES books (title_id) "
+        "ON DELETE CASCADE",
+    ),
+]
+
+
+# Add the deferred constraints, replacing any that are already there.
+# All the constraints of a table are added with one ALTER TABLE, so the
+# table is only locked once.
+def add_deferred_constraints(dest_cur):
+    tables = {}
+    for table, name, definition in DEFERRED_CONSTRAINTS:
+        tables.setdefault(table, []).append((name, definition))
+    for table, constraints in tables.items():
+        actions = [
+            f"DROP CONSTRAINT IF EXISTS {name}" for name, _ in constraints
+        ] + [
+            f"ADD CONSTRAINT {name} {definition}"
+            for name, definition in constraints
+        ]
+        dest_cur.execute(f"ALTER TABLE {table} " + ", ".join(actions) + ";")
+
+
+# The tables created UNLOGGED with unlogged_load. A logged table can't
+# reference an unlogged one, so books comes first.
+UNLOGGED_TABLES = ["books", "isbns", "translations", "contents", "more_images"]
+
+
+# SET LOGGED rewrites each table into the WAL. It does nothing to a
+# table that is already logged.
+def set_tables_logged(dest_cur):
+    for table in UNLOGGED_TABLES:
+        dest_cur.execute(f"ALTER TABLE {table} SET LOGGED;")
+
+
+# The extensions the search columns use. They are also created where
+# they're used, but creating them up front keeps stages that run at the
+# same time from racing to create the same one. They go in public,
+# which every schema build shares. unaccent is only STABLE, since its
+# dictionary could change, so it can't be used in a generated column.
+# immutable_unaccent names the dictionary, which is as immutable as the
+# column needs.
+def create_search_extensions(dest_cur):
     dest_cur.execute(
         """
-        CREATE EXTENSION IF NOT EXISTS unaccent;
+        CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA public;
+        CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public;
+        CREATE EXTENSION IF NOT EXISTS fuzzystrmatch WITH SCHEMA public;
+
+        CREATE OR REPLACE FUNCTION immutable_unaccent(text)
+            RETURNS text
+            LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+            AS $$
+                SELECT public.unaccent('public.unaccent'::regdictionary, $1)
+            $$;
+        """
+    )
+
+
+# The search vector of a book, from the columns of its row
+GENERAL_SEARCH_SQL = """
+    setweight(to_tsvector('isfdb_title_tsc',
+        immutable_unaccent(title)), 'A') ||
+    setweight(to_tsvector('isfdb_title_tsc',
+        immutable_unaccent(coalesce(authors, ' '))), 'B') ||
+    setweight(to_tsvector('isfdb_title_tsc',
+        immutable_unaccent(coalesce(alt_titles, ' '))), 'C') ||
+    setweight(to_tsvector(
+        'isfdb_title_tsc',
+        immutable_unaccent(coalesce(
+            substring(series_str_1 from 'the (.*) series.'), ' '
+        ) )
+    ), 'D')
+    """
+
+
+# With cfg.SEARCH_VECTOR_AT_LOAD, general_search is a generated column,
+# computed once as each book is inserted. Otherwise it's filled in after
+# the books are loaded, by update_general_search.
+def general_search_generated():
+    return cfg.CREATE_SEARCH_INDEXES and cfg.SEARCH_VECTOR_AT_LOAD
+
+
+def general_search_column():
+    if general_search_generated():
+        return f"tsvector GENERATED ALWAYS AS ({GENERAL_SEARCH_SQL}) STORED"
+    return "tsvector default NULL"
+
+
+# The indexes the search uses, as (name, definition) pairs for
+# create_index. The trigram indexes need the pg_trgm extension.
+SEARCH_INDEXES = [
+    ("books_general_search_idx", "ON books USING GIN ( general_search )"),
+    ("books_title_trgm_idx", "ON books USING GIST (title gist_trgm_ops)"),
+    ("books_authors_trgm_idx", "ON books USING GIST (authors gist_trgm_ops)"),
+    (
+        "books_alt_titles_trgm_idx",
+        "ON books USING GIST (alt_titles gist_trgm_ops)",
+    ),
+]
+
+
+# Fill in the search vectors of all books, of the books in title_ids,
+# or of the books in id_range, a (first_id, last_id) pair. A generated
+# general_search is always up to date already.
+def update_general_search(dest_cur, title_ids=None, id_range=None):
+    if general_search_generated():
+        return
+    sql = f"""
         UPDATE books
-        set general_search = (
-            setweight(to_tsvector('isfdb_title_tsc',
-                unaccent(title)), 'A') ||
-            setweight(to_tsvector('isfdb_title_tsc',
-                unaccent(coalesce(authors, ' '))), 'B') ||
-            setweight(to_tsvector('isfdb_title_tsc',
-                unaccent(coalesce(alt_titles, ' '))), 'C') ||
-            setweight(to_tsvector(
-                'isfdb_title_tsc',
-                unaccent(coalesce(
-                    substring(series_str_1 from 'the (.*) series.'), ' '
-                ) )
-            ), 'D')
-        );
-        CREATE INDEX ON books USING GIN ( general_search );
+        SET general_search = ({GENERAL_SEARCH_SQL})
+        """
+    if title_ids is not None:
+        dest_cur.execute(
+            sql + "WHERE title_id = ANY(%s);", (sorted(title_ids),)
+        )
+    elif id_range is not None:
+        dest_cur.execute(
+            sql + "WHERE title_id BETWEEN %s AND %s;", tuple(id_range)
+        )
+    else:
+        dest_cur.execute(sql + ";")
 
-        CREATE EXTENSION IF NOT EXISTS pg_trgm;
 
-        CREATE INDEX ON books
-            USING GIST (title gist_trgm_ops);
-        CREATE INDEX ON books
-            USING GIST (authors gist_trgm_ops);
-        CREATE INDEX ON books
-            USING GIST (alt_titles gist_trgm_ops);
+# Split the books into n_ranges ranges of title_ids with about the same
+# number of books, as (first_id, last_id) pairs
+def get_title_id_ranges(n_ranges, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT MIN(title_id), MAX(title_id)
+        FROM (
+            SELECT title_id, NTILE(%s) OVER (ORDER BY title_id) AS part
+            FROM books
+        ) AS parts
+        GROUP BY part
+        ORDER BY part;
+        """,
+        (n_ranges,),
+    )
+    return dest_cur.fetchall()
+
 
+def create_words_table(dest_cur):
+    dest_cur.execute(
+        """
         DROP TABLE IF EXISTS words;
 
-        CREATE EXTENSION IF NOT EXISTS fuzzystrmatch;
+        CREATE EXTENSION IF NOT EXISTS fuzzystrmatch WITH SCHEMA public;
         CREATE TABLE words AS
             SELECT word, ndoc, nentry
             FROM ts_stat(
@@ -280,34 +476,65 @@ def populate_search_columns(dest_cur):
     )
 
 
-def index_book_tables(dest_cur):
-    dest_cur.execute(
-        """
-        CREATE INDEX ON books(title);
-        CREATE INDEX ON books(year);
-        CREATE INDEX ON books(authors);
-        CREATE INDEX ON books(book_type);
-        CREATE INDEX ON books(original_lang);
-        CREATE INDEX ON books(isfdb_rating);
-        CREATE INDEX ON books(award_winner);
-        CREATE INDEX ON books(juvenile);
-        CREATE INDEX ON books(stand_alone);
-        CREATE INDEX ON books(virtual);
+# The indexes of the book tables, as (name, definition) pairs for
+# create_index
+BOOK_TABLE_INDEXES = [
+    ("books_title_idx", "ON books(title)"),
+    ("books_year_idx", "ON books(year)"),
+    ("books_authors_idx", "ON books(authors)"),
+    ("books_book_type_idx", "ON books(book_type)"),
+    ("books_original_lang_idx", "ON books(original_lang)"),
+    ("books_isfdb_rating_idx", "ON books(isfdb_rating)"),
+    ("books_award_winner_idx", "ON books(award_winner)"),
+    ("books_juvenile_idx", "ON books(juvenile)"),
+    ("books_stand_alone_idx", "ON books(stand_alone)"),
+    ("books_virtual_idx", "ON books(virtual)"),
+    ("isbns_isbn_idx", "ON isbns using hash (isbn)"),
+    ("isbns_title_id_idx", "ON isbns using hash (title_id)"),
+    (
+        "translations_lowest_title_id_idx",
+        "ON translations using hash (lowest_title_id)",
+    ),
+    ("contents_book_title_id_idx", "ON contents using hash (book_title_id)"),
+    (
+        "contents_content_title_id_idx",
+        "ON contents using hash (content_title_id)",
+    ),
+    ("more_images_title_id_idx", "ON more_images using hash (title_id)"),
+]
 
-        CREATE INDEX ON isbns using hash (isbn);
-        CREATE INDEX ON isbns using hash (title_id);
 
-        CREATE INDEX ON translations using hash (lowest_title_id);
+# Indexes are named so that they can be built again on the same tables
+def create_index(name, definition, dest_cur):
+    dest_cur.execute(f"CREATE INDEX IF NOT EXISTS {name} {definition};")
 
-        CREATE INDEX ON contents using hash (book_title_id);
-        CREATE INDEX ON contents using hash (content_title_id);
 
-        CREATE INDEX ON more_images using hash (title_id);
+# Session settings for building indexes. Each build can use up to
+# maintenance_work_mem, and max_parallel_maintenance_workers more
+# processes to build a B-tree.
+def set_index_build_settings(dest_cur):
+    dest_cur.execute(
         """
+        SET maintenance_work_mem = %s;
+        SET max_parallel_maintenance_workers = %s;
+        """,
+        (cfg.INDEX_MAINTENANCE_WORK_MEM, cfg.INDEX_PARALLEL_WORKERS),
+    )
+
+
+def get_index_size(name, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT pg_relation_size(%s::regclass);
+        """,
+        (name,),
     )
+    return dest_cur.fetchone()[0]
 
 
 def get_language_dict(source_cur):
+    if source_cur is None:
+        return dict(snapshot.language_rows())
     source_cur.execute(
         """
         SELECT lang_id, lang_name
@@ -322,30 +549,190 @@ def get_language_dict(source_cur):
 # and which aren't non-genre, graphic novels, or by an excluded author
 def get_all_titles(source_cur, limit=None):
     print("main title table query...")
-    sql = f"""
-        SELECT title_id, title_title, title_synopsis, note_id, series_id,
-            title_seriesnum, YEAR(title_copyright) as year, title_ttype,
-            title_parent, title_rating, title_seriesnum_2, title_jvn
-        FROM titles
+    if source_cur is None:
+        return snapshot.all_title_rows(limit)
+    source_cur.execute(all_titles_query(limit))
+    return source_cur.fetchall()
+
+
+def count_all_titles(source_cur, limit=None):
+    if source_cur is None:
+        return len(snapshot.all_title_rows(limit))
+    source_cur.execute(
+        f"""
+        SELECT COUNT(*)
+        FROM ({all_titles_query(limit)}) AS candidate_titles;
+        """
+    )
+    return source_cur.fetchone()[0]
+
+
+# Yield the results of the main title query in lists of up to batch_size
+# titles as the server sends them, rather than reading them all into
+# memory first. Nothing else can use source_conn until the last batch
+# has been read.
+def stream_all_titles(source_conn, batch_size, limit=None):
+    source_cur = source_conn.cursor(buffered=False)
+    # Rows are only read as fast as the workers finish batches, so give
+    # the server more time than the default to wait on the client
+    source_cur.execute("SET SESSION net_write_timeout = 3600;")
+    source_cur.execute(all_titles_query(limit))
+    while True:
+        titles = source_cur.fetchmany(batch_size)
+        if not titles:
+            break
+        yield titles
+    source_cur.close()
+
+
+# root_ids limits the query to the works with these title_ids, i.e. the
+# titles with one of them as their title_id or title_parent
+def all_titles_query(limit=None, root_ids=None):
+    sql = """
+        SELECT t.title_id, t.title_title, t.title_synopsis, t.note_id,
+            t.series_id, t.title_seriesnum, YEAR(t.title_copyright) as year,
+            t.title_ttype, t.title_parent, t.title_rating,
+            t.title_seriesnum_2, t.title_jvn
+        FROM titles AS t
+        """
+
+    if cfg.PREFILTER_TITLES:
+        # Rank each translation against the others of the same work
+        # the same way get_original_fields does, so that only the most
+        # recent one is returned
+        sql += f"""
+        LEFT JOIN titles AS original
+        ON original.title_id = t.title_parent
+        LEFT JOIN (
+            SELECT title_id,
+                ROW_NUMBER() OVER (
+                    PARTITION BY title_parent
+                    ORDER BY YEAR(title_copyright) DESC, title_id DESC
+                ) AS translation_rank
+            FROM titles
+            WHERE title_language = {cfg.MY_LANG}
+            AND (
+                (title_ttype = 'SHORTFICTION' AND title_storylen = 'novella')
+                OR title_ttype IN
+                ('ANTHOLOGY', 'COLLECTION', 'NOVEL', 'OMNIBUS')
+            )
+            AND title_non_genre != 'Yes'
+            AND title_graphic != 'Yes'
+            AND title_parent != 0
+        ) AS tr
+        ON tr.title_id = t.title_id
+        """
+
+    sql += f"""
         WHERE (
-            (title_ttype = 'SHORTFICTION' AND title_storylen = 'novella')
-            OR title_ttype IN ('ANTHOLOGY', 'COLLECTION', 'NOVEL', 'OMNIBUS')
+            (t.title_ttype = 'SHORTFICTION' AND t.title_storylen = 'novella')
+            OR t.title_ttype IN ('ANTHOLOGY', 'COLLECTION', 'NOVEL', 'OMNIBUS')
         )
-        AND title_language = {cfg.ENGLISH}
-        AND title_non_genre != 'Yes'
-        AND title_graphic != 'Yes'
-        AND title_id NOT IN (
+        AND t.title_language = {cfg.ENGLISH}
+        AND t.title_non_genre != 'Yes'
+        AND t.title_graphic != 'Yes'
+        AND t.title_id NOT IN (
             SELECT title_id
             FROM  canonical_author
             WHERE author_id in ({cfg.EXCLUDED_AUTHORS})
         )
-        AND title_id NOT IN ({cfg.EXCLUDED_TITLE_IDS})
+        AND t.title_id NOT IN ({cfg.EXCLUDED_TITLE_IDS})
+        """
+
+    if cfg.PREFILTER_TITLES:
+        # Leave out the titles that process_title would skip anyway:
+        # unpublished titles, variant titles of a cfg.MY_LANG work, and
+        # all but the most recent translation of a foreign work
+        sql += f"""
+        AND (
+            YEAR(t.title_copyright) IS NULL
+            OR YEAR(t.title_copyright) != 8888
+        )
+        AND (
+            t.title_parent = 0
+            OR (
+                original.title_language != {cfg.MY_LANG}
+                AND tr.translation_rank = 1
+            )
+        )
+        """
+
+    if root_ids is not None:
+        in_list = ", ".join(str(int(root_id)) for root_id in root_ids)
+        sql += f"""
+        AND (t.title_id IN ({in_list}) OR t.title_parent IN ({in_list}))
         """
 
     if limit:
         sql += "\nLIMIT " + str(limit)
+    return sql
+
+
+# The titles of the main title query that belong to the works in
+# root_ids, queried a chunk of works at a time. A title whose title_id
+# and title_parent are in different chunks is found by both, so titles
+# are kept by title_id, and returned in title_id order.
+def get_titles_for_roots(root_ids, source_cur, chunk_size=1000):
+    if source_cur is None:
+        return snapshot.all_title_rows(root_ids=root_ids)
+    root_ids = sorted(root_ids)
+    titles = {}
+    for ii in range(0, len(root_ids), chunk_size):
+        source_cur.execute(
+            all_titles_query(root_ids=root_ids[ii : ii + chunk_size])
+        )
+        for title in source_cur.fetchall():
+            titles[title[0]] = title
+    return [titles[title_id] for title_id in sorted(titles)]
+
+
+# Get everything get_original_fields looks up for all translated works
+# at once, keyed by the title_id of the original. Each value is the
+# original's title, year, and language, and its cfg.MY_LANG
+# translations, most recent first.
+def get_translation_groups(source_cur):
+    if source_cur is None:
+        rows = snapshot.translation_rows()
+    else:
+        rows = query_translation_rows(source_cur)
+    translation_groups = {}
+    for row in rows:
+        parent_id = row[0]
+        if parent_id not in translation_groups:
+            translation_groups[parent_id] = (row[5], row[6], row[7], [])
+        translation_groups[parent_id][3].append(row[1:5])
+    return translation_groups
+
 
-    source_cur.execute(sql)
+def query_translation_rows(source_cur):
+    source_cur.execute(
+        """
+        SELECT translation.title_parent, translation.title_id,
+            translation.title_title as translation_title,
+            YEAR(translation.title_copyright) as translation_year,
+            translation.note_id, original.title_title,
+            YEAR(original.title_copyright) as original_year,
+            original.title_language
+        FROM titles as translation
+        JOIN titles as original
+        ON original.title_id = translation.title_parent
+        WHERE translation.title_language = %s
+        AND original.title_language != %s
+        AND (
+            (
+                translation.title_ttype = 'SHORTFICTION'
+                AND translation.title_storylen = 'novella'
+            )
+            OR translation.title_ttype IN
+            ('ANTHOLOGY', 'COLLECTION', 'NOVEL', 'OMNIBUS')
+        )
+        AND translation.title_non_genre != 'Yes'
+        AND translation.title_graphic != 'Yes'
+        ORDER BY translation.title_parent, translation_year DESC,
+            translation.title_id DESC;
+        """,
+        (cfg.MY_LANG, cfg.MY_LANG),
+    )
     return source_cur.fetchall()
 
 
@@ -371,10 +758,6 @@ def get_original_fields(title_id, parent_id, source_cur, language_dict):
     if original_lang == cfg.MY_LANG:
         return False
 
-    original_lang = language_dict[original_lang]
-    if original_year in (0, 8888):
-        original_year = None
-
     # The title is a translation of a foreign language work into cfg.MY_LANG.
     # Get all the cfg.MY_LANG translations
     source_cur.execute(
@@ -396,12 +779,38 @@ def get_original_fields(title_id, parent_id, source_cur, language_dict):
     )
     preferred_translations = source_cur.fetchall()
 
+    return build_original_fields(
+        title_id,
+        original_title,
+        original_year,
+        original_lang,
+        preferred_translations,
+        source_cur,
+        language_dict,
+    )
+
+
+# The part of get_original_fields that doesn't need to query the titles
+# table, so that it can also be used with get_translation_groups
+def build_original_fields(
+    title_id,
+    original_title,
+    original_year,
+    original_lang,
+    preferred_translations,
+    source_cur,
+    language_dict,
+):
+    original_lang = language_dict[original_lang]
+    if original_year in (0, 8888):
+        original_year = None
+
     # Wait to process this work if we aren't on the most recent translation
     if title_id != preferred_translations[0][0]:
         return False
 
     # now sort oldest to newest
-    preferred_translations.reverse()
+    preferred_translations = preferred_translations[::-1]
 
     translations = []
 
@@ -430,7 +839,15 @@ def get_original_fields(title_id, parent_id, source_cur, language_dict):
 
 
 def get_pub_fields(title_id, root_id, ttype, source_alch_conn):
-    all_pubs = pd.read_sql(
+    if source_alch_conn is None:
+        all_pubs = snapshot.pub_rows([root_id]).drop(columns="root_id")
+    else:
+        all_pubs = query_pub_rows(root_id, source_alch_conn)
+    return choose_pub_fields(title_id, ttype, all_pubs)
+
+
+def query_pub_rows(root_id, source_alch_conn):
+    return pd.read_sql(
         """
         SELECT t.title_id, t.title_language, p.pub_id,
             YEAR(p.pub_year) as p_year, p.pub_pages, p.pub_ptype,
@@ -441,11 +858,15 @@ def get_pub_fields(title_id, root_id, ttype, source_alch_conn):
             JOIN titles as t
             ON t.title_id = c.title_id
             WHERE t.title_id = %s
-            OR t.title_parent = %s;""",
+            OR t.title_parent = %s
+            ORDER BY p.pub_id, t.title_id;""",
         source_alch_conn,
         params=(root_id, root_id),
     )
 
+
+# Choose the publication fields of a title from the pubs of its work
+def choose_pub_fields(title_id, ttype, all_pubs):
     all_books = all_pubs[
         (all_pubs.pub_ctype == "NOVEL")
         | (all_pubs.pub_ctype == "CHAPBOOK")
@@ -503,7 +924,7 @@ def get_pub_fields(title_id, root_id, ttype, source_alch_conn):
         lambda ctype: "NOVELLA" if ctype == "CHAPBOOK" else ctype
     )
     all_isbns = (
-        all_isbns.sort_values(by="title_language")
+        all_isbns.sort_values(by="title_language", kind="stable")
         .drop_duplicates(subset=["pub_isbn"], keep="first")
         .to_records(index=False)
         .tolist()
@@ -542,14 +963,9 @@ def get_pub_fields(title_id, root_id, ttype, source_alch_conn):
         # One incorret entry has the page count set the ISBN. Skip thise one.
         if edition.pub_pages == edition.pub_isbn:
             continue
-        # Might be in a format like: "vii+125+[10]" or "125+[10]"
-        # try the second and then the first positions before giving up
-        for ii in (1, 0):
-            try:
-                pages = int(edition.pub_pages.split("+")[ii])
-                break
-            except (AttributeError, IndexError, ValueError):
-                pass
+        edition_pages = parse_pages(edition.pub_pages)
+        if edition_pages is not None:
+            pages = edition_pages
         if pages:
             break
 
@@ -574,31 +990,9 @@ def get_pub_fields(title_id, root_id, ttype, source_alch_conn):
     )
 
     if preferred_covers:
-        # change non-ssl amazon domains to the ssl amazon domain
-        for ii in range(len(preferred_covers)):
-            protocol, _, domain, remainder = preferred_covers[ii].split("/", 3)
-            try:
-                if domain.split(".")[-2] == "images-amazon":
-                    preferred_covers[ii] = (
-                        "https://images-na.ssl-images-amazon.com/" + remainder
-                    )
-                    continue
-            except IndexError:
-                pass
-            if domain in [
-                "images.amazon.com",
-                "images-eu.amazon.com",
-                "img.amazon.ca",
-            ]:
-
-                preferred_covers[ii] = (
-                    "https://images-na.ssl-images-amazon.com/" + remainder
-                )
-                continue
-
-            if protocol.lower() == "http:":
-                preferred_covers[ii] = "https" + preferred_covers[ii][4:]
-
+        preferred_covers = [
+            secure_cover_url(cover) for cover in preferred_covers
+        ]
         cover_image = preferred_covers[0]
         more_images = preferred_covers[1:]
 
@@ -630,6 +1024,255 @@ def get_pub_fields(title_id, root_id, ttype, source_alch_conn):
     )
 
 
+# The pubs of many titles at once, in the row order that get_pub_fields
+# sees for each title. Rows are keyed by root_id, the title_id or
+# title_parent that get_pub_fields would have been called with.
+def pub_rows_query(root_ids):
+    in_list = ", ".join(["%s"] * len(root_ids))
+    sql = f"""
+        SELECT r.root_id, t.title_id, t.title_language, p.pub_id,
+            YEAR(p.pub_year) as p_year, p.pub_pages, p.pub_ptype,
+            p.pub_ctype, p.pub_isbn, p.pub_frontimage
+        FROM (
+            SELECT title_id, title_id AS root_id
+            FROM titles
+            WHERE title_id IN ({in_list})
+            UNION ALL
+            SELECT title_id, title_parent AS root_id
+            FROM titles
+            WHERE title_parent IN ({in_list})
+            AND title_parent != title_id
+        ) AS r
+        JOIN titles as t
+        ON t.title_id = r.title_id
+            JOIN pub_content as c
+            ON c.title_id = t.title_id
+                JOIN pubs as p
+                ON p.pub_id = c.pub_id
+        ORDER BY r.root_id, p.pub_id, t.title_id;"""
+    return sql, tuple(root_ids) * 2
+
+
+def get_pub_rows(root_ids, source_alch_conn):
+    if source_alch_conn is None:
+        return snapshot.pub_rows(root_ids)
+    sql, params = pub_rows_query(root_ids)
+    return pd.read_sql(sql, source_alch_conn, params=params)
+
+
+# Set-based version of get_pub_fields. title_requests is a list of
+# (title_id, root_id, ttype) tuples, all_pubs is the result of
+# get_pub_rows for their root_ids. Returns a dict from title_id to what
+# get_pub_fields would have returned for it. Titles that would make
+# get_pub_fields raise an exception are left out, so callers can fall
+# back to the per-title function to get the same error.
+def get_bulk_pub_fields(title_requests, all_pubs):
+    requests = pd.DataFrame(
+        title_requests, columns=["request_id", "root_id", "ttype"]
+    )
+    requests["edition_ctype"] = requests.ttype.where(
+        requests.ttype != "NOVELLA", "CHAPBOOK"
+    )
+    all_pubs = all_pubs.assign(row_order=range(all_pubs.shape[0]))
+
+    all_books = all_pubs[
+        all_pubs.pub_ctype.isin(
+            ["NOVEL", "CHAPBOOK", "ANTHOLOGY", "COLLECTION", "OMNIBUS"]
+        )
+    ]
+    # if not available as book in cfg.MY_LANG, don't include this title
+    available_roots = set(
+        all_books[all_books.title_language == cfg.MY_LANG].root_id
+    )
+
+    # Every edition of every requested title, in the same order as the
+    # per-title all_editions frames
+    all_editions = (
+        requests[["request_id", "root_id", "edition_ctype"]]
+        .merge(
+            all_books,
+            left_on=["root_id", "edition_ctype"],
+            right_on=["root_id", "pub_ctype"],
+        )
+        .sort_values(by=["request_id", "row_order"], kind="stable")
+        .reset_index(drop=True)
+    )
+    en_editions = all_editions[all_editions.title_language == cfg.MY_LANG]
+    edition_counts = en_editions.groupby("request_id").size()
+
+    # map all remaining ISBNs to this title_id in the isbn table
+    all_isbns = all_editions[all_editions.pub_isbn != ""].dropna(
+        subset=["pub_isbn"]
+    )
+    all_isbns = all_isbns.assign(
+        foreign_lang=all_isbns.title_language != cfg.ENGLISH,
+        pub_ctype=all_isbns.pub_ctype.where(
+            all_isbns.pub_ctype != "CHAPBOOK", "NOVELLA"
+        ),
+    )
+    all_isbns = all_isbns.sort_values(
+        by=["request_id", "foreign_lang"], kind="stable"
+    ).drop_duplicates(subset=["request_id", "pub_isbn"], keep="first")
+    isbns_by_request = {}
+    for request_id, pub_isbn, pub_ctype, foreign_lang in zip(
+        all_isbns.request_id.tolist(),
+        all_isbns.pub_isbn.tolist(),
+        all_isbns.pub_ctype.tolist(),
+        all_isbns.foreign_lang.tolist(),
+    ):
+        isbns_by_request.setdefault(request_id, []).append(
+            (pub_isbn, pub_ctype, foreign_lang)
+        )
+
+    # Same ordering as preferred_pubs in get_pub_fields: the requested
+    # title_id first, then by publication type, then newest first.
+    en_editions = en_editions.assign(
+        title_rank=(en_editions.title_id != en_editions.request_id) + 1,
+        ptype_rank=en_editions.pub_ptype.map(
+            lambda ptype: {"tp": 1, "hc": 2, "pb": 3, "ebook": 4}.get(
+                ptype, 5
+            )
+        ),
+        neg_year=-en_editions.p_year,
+        neg_pub_id=-en_editions.pub_id,
+    ).sort_values(
+        by=["request_id", "title_rank", "ptype_rank", "neg_year", "neg_pub_id"]
+    )
+
+    # Use the first edition with a page count that parses as non-zero.
+    # Like get_pub_fields, fall back to zero if that was all there was.
+    # One incorret entry has the page count set the ISBN. Skip thise one.
+    parsed_pages = pd.Series(
+        [
+            None if pub_pages == pub_isbn else parse_pages(pub_pages)
+            for pub_pages, pub_isbn in zip(
+                en_editions.pub_pages.tolist(), en_editions.pub_isbn.tolist()
+            )
+        ],
+        index=en_editions.index,
+        dtype=object,
+    )
+    page_editions = en_editions.assign(pages=parsed_pages)[
+        parsed_pages.notna()
+    ]
+    first_pages = (
+        page_editions[page_editions.pages != 0]
+        .drop_duplicates(subset=["request_id"])
+        .set_index("request_id")
+        .pages.to_dict()
+    )
+    zero_pages = set(page_editions[page_editions.pages == 0].request_id)
+
+    # only keep external image links if they are from amazon or isfdb
+    preferred_covers = en_editions[
+        (
+            (en_editions.pub_frontimage.notnull())
+            & (en_editions.pub_frontimage != "")
+            & (
+                (en_editions.pub_frontimage.str.contains("amazon.com"))
+                | (en_editions.pub_frontimage.str.contains("amazon.ca"))
+                | (en_editions.pub_frontimage.str.contains("isfdb.org"))
+            )
+        )
+    ].drop_duplicates(subset=["request_id", "pub_frontimage"])
+    covers_by_request = {}
+    for request_id, cover in zip(
+        preferred_covers.request_id.tolist(),
+        preferred_covers.pub_frontimage.tolist(),
+    ):
+        covers_by_request.setdefault(request_id, []).append(cover)
+
+    # Kept identical to the preferred_isbns selection in get_pub_fields
+    preferred_isbns = (
+        en_editions[
+            (
+                (en_editions.pub_isbn.notnull())
+                & (en_editions.pub_isbn != "")
+                & (en_editions.pub_ptype.str.contains("audio") is False)
+            )
+        ]
+        .drop_duplicates(subset=["request_id"])
+        .set_index("request_id")
+        .pub_isbn.to_dict()
+    )
+
+    pub_fields = {}
+    for title_id, root_id, _ in title_requests:
+        if root_id not in available_roots:
+            pub_fields[title_id] = False
+            continue
+
+        editions = int(edition_counts.get(title_id, 0))
+        if not editions:
+            # This title (probably a novella) was never published on
+            # its own.
+            pub_fields[title_id] = (False, editions, None, None, None, [], [])
+            continue
+
+        if title_id in first_pages:
+            pages = first_pages[title_id]
+        elif title_id in zero_pages:
+            pages = 0
+        else:
+            pages = None
+
+        try:
+            covers = [
+                secure_cover_url(cover)
+                for cover in covers_by_request.get(title_id, [])
+            ]
+        except ValueError:
+            continue
+        if covers:
+            cover_image = covers[0]
+            more_images = covers[1:]
+        else:
+            cover_image = None
+            more_images = []
+
+        pub_fields[title_id] = (
+            True,
+            editions,
+            pages,
+            cover_image,
+            preferred_isbns.get(title_id),
+            isbns_by_request.get(title_id, []),
+            more_images,
+        )
+    return pub_fields
+
+
+# Might be in a format like: "vii+125+[10]" or "125+[10]"
+# try the second and then the first positions before giving up
+def parse_pages(pub_pages):
+    for ii in (1, 0):
+        try:
+            return int(pub_pages.split("+")[ii])
+        except (AttributeError, IndexError, ValueError):
+            pass
+    return None
+
+
+# change non-ssl amazon domains to the ssl amazon domain
+def secure_cover_url(cover_url):
+    protocol, _, domain, remainder = cover_url.split("/", 3)
+    try:
+        if domain.split(".")[-2] == "images-amazon":
+            return "https://images-na.ssl-images-amazon.com/" + remainder
+    except IndexError:
+        pass
+    if domain in [
+        "images.amazon.com",
+        "images-eu.amazon.com",
+        "img.amazon.ca",
+    ]:
+        return "https://images-na.ssl-images-amazon.com/" + remainder
+
+    if protocol.lower() == "http:":
+        return "https" + cover_url[4:]
+    return cover_url
+
+
 def get_alternate_titles(title_id, title, source_cur):
     source_cur.execute(
         """
@@ -643,11 +1286,18 @@ def get_alternate_titles(title_id, title, source_cur):
     """,
         (title_id, cfg.MY_LANG, title),
     )
-    title_set = {r[0] for r in source_cur.fetchall()} - set(title) - set([""])
+    return format_alternate_titles(
+        [r[0] for r in source_cur.fetchall()], title
+    )
+
+
+def format_alternate_titles(alternate_titles, title):
+    title_set = set(alternate_titles) - set(title) - set([""])
 
     if not title_set:
         return None
-    alt_titles = unescape("; ".join(list(title_set)))
+    # Sort them so the order doesn't depend on string hashing
+    alt_titles = unescape("; ".join(sorted(title_set)))
 
     # if alt_titles is too long, it is probably an
     # injudicious application of alternate titles and shouldn't be used
@@ -666,7 +1316,8 @@ def get_authors(title_id, source_cur):
             SELECT author_id
             FROM canonical_author
             WHERE title_id = %s
-        );""",
+        )
+        ORDER BY author_id;""",
         (title_id,),
     )
     authors_results = source_cur.fetchall()
@@ -687,12 +1338,15 @@ def get_wikipedia_link(title_id, source_cur):
         """,
         (title_id,),
     )
-    wiki_links = source_cur.fetchall()
+    return choose_wikipedia_link([r[0] for r in source_cur.fetchall()])
+
+
+def choose_wikipedia_link(wiki_links):
     # If there isn't exactly one wikipedia link,
     # we can't guess which is the general link
     if len(wiki_links) != 1:
         return None
-    wiki_link = wiki_links[0][0]
+    wiki_link = wiki_links[0]
     if wiki_link[:5].lower() == "http:":
         wiki_link = "https" + wiki_link[4:]
     return wiki_link
@@ -717,8 +1371,122 @@ def get_award_winner(title_id, source_cur):
     return bool(award_result)
 
 
+# Set-based versions of get_authors, get_wikipedia_link,
+# get_award_winner and get_alternate_titles for many titles at once.
+# Each query returns (title_id, value) rows.
+def title_attribute_queries(title_ids):
+    in_list = ", ".join(["%s"] * len(title_ids))
+    title_ids = tuple(title_ids)
+    return [
+        (
+            "authors",
+            f"""
+            SELECT ca.title_id,
+                GROUP_CONCAT(
+                    a.author_canonical
+                    ORDER BY a.author_id
+                    SEPARATOR ', '
+                )
+            FROM (
+                SELECT DISTINCT title_id, author_id
+                FROM canonical_author
+                WHERE title_id IN ({in_list})
+            ) AS ca
+            JOIN authors AS a
+            ON a.author_id = ca.author_id
+            GROUP BY ca.title_id;
+            """,
+            title_ids,
+        ),
+        (
+            "wikipedia",
+            f"""
+            SELECT title_id, url
+            FROM webpages
+            WHERE title_id IN ({in_list})
+            AND url LIKE %s;
+            """,
+            title_ids + ("%en.wikipedia.org%",),
+        ),
+        (
+            "award_winner",
+            f"""
+            SELECT DISTINCT ta.title_id, TRUE
+            FROM title_awards AS ta
+            WHERE ta.title_id IN ({in_list})
+            AND EXISTS (
+                SELECT award_id
+                FROM awards AS a
+                WHERE a.award_id = ta.award_id
+                AND a.award_level = 1
+            );
+            """,
+            title_ids,
+        ),
+        (
+            "alt_titles",
+            f"""
+            SELECT DISTINCT v.title_parent, v.title_title
+            FROM titles AS v
+            JOIN titles AS t
+            ON t.title_id = v.title_parent
+            WHERE v.title_parent IN ({in_list})
+            AND v.title_language = %s
+            AND v.title_title != t.title_title
+            AND v.title_title NOT REGEXP
+                'part [[:digit:]]+ of |boxed set|abridged|complete novel';
+            """,
+            title_ids + (cfg.MY_LANG,),
+        ),
+    ]
+
+
+# Turn the rows of title_attribute_queries into maps with an entry for
+# every title_id, holding what the per-title functions would return.
+# Alternate titles are left as lists for format_alternate_titles, which
+# also needs the title itself.
+def build_title_attributes(title_ids, query_results):
+    attributes = {
+        "authors": dict.fromkeys(title_ids),
+        "wikipedia": {},
+        "award_winner": dict.fromkeys(title_ids, False),
+        "alt_titles": {title_id: [] for title_id in title_ids},
+    }
+    for title_id, authors in query_results["authors"]:
+        attributes["authors"][title_id] = unescape(authors)
+
+    wiki_links = {title_id: [] for title_id in title_ids}
+    for title_id, url in query_results["wikipedia"]:
+        wiki_links[title_id].append(url)
+    for title_id, links in wiki_links.items():
+        attributes["wikipedia"][title_id] = choose_wikipedia_link(links)
+
+    for title_id, _ in query_results["award_winner"]:
+        attributes["award_winner"][title_id] = True
+
+    for title_id, alt_title in query_results["alt_titles"]:
+        attributes["alt_titles"][title_id].append(alt_title)
+    return attributes
+
+
+def get_title_attributes(title_ids, source_cur):
+    if source_cur is None:
+        return build_title_attributes(
+            title_ids, snapshot.title_attribute_rows(title_ids)
+        )
+    # The default limit would silently truncate long author lists
+    source_cur.execute("SET SESSION group_concat_max_len = 1048576;")
+    query_results = {}
+    for name, sql, params in title_attribute_queries(title_ids):
+        source_cur.execute(sql, params)
+        query_results[name] = source_cur.fetchall()
+    return build_title_attributes(title_ids, query_results)
+
+
 def get_synopsis(synopsis_id, source_cur):
     # TODO: cleanup html tags in synopsis
+    if source_cur is None:
+        return get_note_texts([synopsis_id], source_cur)[synopsis_id]
     source_cur.execute(
         """
         SELECT note_note
@@ -745,8 +1513,81 @@ note_regex_subs = [
     (re.compile(r"{{(.*?)}}"), r" "),
 ]
 
+# Templates with an argument that render_note replaces with a prefix
+note_template_prefixes = [
+    ("Tr|", "Translated by "),
+    ("tr|", "translated by "),
+    ("Narrator|", "Narrated by "),
+    ("narrator|", "narrated by "),
+]
+incomplete_regex, incomplete_text = note_regex_subs[4]
+
+
+def substitute_note_templates(note):
+    for regex, replacement in note_regex_subs:
+        note = regex.sub(replacement, note)
+    return note
+
+
+# Gives the same result as substitute_note_templates, but replaces each
+# {{...}} template in a single pass over the note. The regexes can also
+# match across templates, e.g. a template without an argument and a "|"
+# later on the same line, or nested braces. Notes like that are rare, so
+# they are simply handed to the regexes.
+def render_note(note):
+    pieces = []
+    position = 0
+    while True:
+        start = note.find("{{", position)
+        if start == -1:
+            pieces.append(note[position:])
+            return "".join(pieces)
+        end = note.find("}}", start + 2)
+        if end == -1:
+            return substitute_note_templates(note)
+        template = note[start + 2 : end]
+        if "{" in template or "}" in template or "\n" in template:
+            return substitute_note_templates(note)
+
+        pieces.append(note[position:start])
+        position = end + 2
+        for template_prefix, text_prefix in note_template_prefixes:
+            if template.startswith(template_prefix):
+                pieces.append(text_prefix + template[len(template_prefix) :])
+                break
+        else:
+            if incomplete_regex.fullmatch(note[start:position]):
+                pieces.append(incomplete_text)
+            elif "|" in template:
+                pieces.append(template.split("|", 1)[1])
+            else:
+                line_end = note.find("\n", position)
+                if line_end == -1:
+                    line_end = len(note)
+                if "|" in note[position:line_end]:
+                    return substitute_note_templates(note)
+                pieces.append(" ")
+
+
+# Rendered notes by note_id. Notes are shared between titles, e.g. the
+# notes of translations are used again for every title of the group.
+note_cache = {}
+NOTE_CACHE_SIZE = 200000
+
+
+def cache_note(note_id, note):
+    if len(note_cache) >= NOTE_CACHE_SIZE:
+        note_cache.clear()
+    note_cache[note_id] = note
+
 
 def get_note(note_id, source_cur):
+    if note_id in note_cache:
+        return note_cache[note_id]
+    if source_cur is None:
+        note = render_note(get_note_texts([note_id], source_cur)[note_id])
+        cache_note(note_id, note)
+        return note
     source_cur.execute(
         """
         SELECT note_note
@@ -756,28 +1597,140 @@ def get_note(note_id, source_cur):
         """,
         (note_id,),
     )
-    note = unescape(source_cur.fetchone()[0])
-    for regex, replacement in note_regex_subs:
-        note = regex.sub(replacement, note)
+    note = render_note(unescape(source_cur.fetchone()[0]))
+    cache_note(note_id, note)
     return note
 
 
+# Unescaped text of many notes, fetched in chunks of note_ids
+def get_note_texts(note_ids, source_cur, chunk_size=5000):
+    note_ids = sorted(set(note_ids))
+    texts = {}
+    if source_cur is None:
+        for note_id, text in snapshot.note_rows(note_ids):
+            texts[note_id] = unescape(text)
+        return texts
+    for sql, params in note_texts_queries(note_ids, chunk_size):
+        source_cur.execute(sql, params)
+        for note_id, text in source_cur.fetchall():
+            texts[note_id] = unescape(text)
+    return texts
+
+
+def note_texts_queries(note_ids, chunk_size=5000):
+    queries = []
+    for ii in range(0, len(note_ids), chunk_size):
+        chunk = note_ids[ii : ii + chunk_size]
+        in_list = ", ".join(["%s"] * len(chunk))
+        queries.append(
+            (
+                f"""
+                SELECT note_id, note_note
+                FROM notes
+                WHERE note_id IN ({in_list});
+                """,
+                tuple(chunk),
+            )
+        )
+    return queries
+
+
+# Fetch the notes and synopses of a batch of titles together. Notes are
+# rendered into note_cache, where get_note will find them, and the
+# synopses are returned by note_id. Ids missing from the notes table are
+# left out, so get_note and get_synopsis handle them as before.
+def prefetch_notes(note_ids, synopsis_ids, source_cur):
+    uncached_ids = uncached_note_ids(note_ids)
+    texts = get_note_texts(uncached_ids | set(synopsis_ids), source_cur)
+    return cache_note_texts(uncached_ids, synopsis_ids, texts)
+
+
+def uncached_note_ids(note_ids):
+    return {note_id for note_id in note_ids if note_id not in note_cache}
+
+
+# The part of prefetch_notes after the texts are fetched
+def cache_note_texts(uncached_ids, synopsis_ids, texts):
+    for note_id in uncached_ids:
+        if note_id in texts:
+            cache_note(note_id, render_note(texts[note_id]))
+    return {
+        synopsis_id: texts[synopsis_id]
+        for synopsis_id in synopsis_ids
+        if synopsis_id in texts
+    }
+
+
+def get_series_dict(source_cur):
+    if source_cur is None:
+        rows = snapshot.series_rows()
+    else:
+        source_cur.execute(
+            """
+            SELECT series_id, series_title, series_parent
+            FROM series;
+            """
+        )
+        rows = source_cur.fetchall()
+    return {
+        series_id: (series_title, series_parent)
+        for series_id, series_title, series_parent in rows
+    }
+
+
+# Titles of each series' ancestors, nearest parent first, by series_id.
+# Filled in as series are resolved, so titles in the same series or in
+# sibling series reuse the ancestors that were already worked out.
+series_ancestors = {}
+
+
+def get_series_ancestors(series_id, series_dict):
+    # Walk up the parents until reaching the top of the hierarchy or a
+    # series that has already been resolved
+    chain = []
+    current = series_id
+    while current not in series_ancestors:
+        series_parent = series_dict[current][1]
+        if not series_parent:
+            series_ancestors[current] = ()
+            break
+        if series_parent in chain or series_parent == current:
+            # The source data has a loop of parent series. Cut the loop
+            # here instead of walking around it forever.
+            logger.warning(f"Series {series_id} has a loop of parents")
+            series_ancestors[current] = ()
+            break
+        chain.append(current)
+        current = series_parent
+
+    # Work back down the chain, memoizing each series on the way
+    ancestors = series_ancestors[current]
+    for child_id in reversed(chain):
+        parent_title = series_dict[series_dict[child_id][1]][0]
+        ancestors = (parent_title,) + ancestors
+        series_ancestors[child_id] = ancestors
+    return series_ancestors[series_id]
+
+
 def get_series_strings(
-    series_id, seriesnum, seriesnum_2, parent_id, source_cur
+    series_id, seriesnum, seriesnum_2, parent_id, source_cur, series_dict=None
 ):
 
     if not series_id:
         if parent_id == 0:
             return (None, None)
-        source_cur.execute(
-            """
-            SELECT series_id, title_seriesnum, title_seriesnum_2
-            FROM titles
-            WHERE title_id = %s
-            """,
-            (parent_id,),
-        )
-        series_data = source_cur.fetchone()
+        if source_cur is None:
+            series_data = snapshot.title_series_row(parent_id)
+        else:
+            source_cur.execute(
+                """
+                SELECT series_id, title_seriesnum, title_seriesnum_2
+                FROM titles
+                WHERE title_id = %s
+                """,
+                (parent_id,),
+            )
+            series_data = source_cur.fetchone()
         if not series_data:
             return (None, None)
         series_data = series_id, seriesnum, seriesnum_2
@@ -785,28 +1738,33 @@ def get_series_strings(
             0, series_id, seriesnum, seriesnum_2, source_cur
         )
 
-    source_cur.execute(
-        """
-        SELECT series_title, series_parent
-        FROM series
-        WHERE series_id = %s
-        """,
-        (series_id,),
-    )
-    series_title, series_parent = source_cur.fetchone()
-
-    parent_series = []
-    while series_parent:
+    if series_dict is not None:
+        # Use the series table that was loaded up front
+        series_title = series_dict[series_id][0]
+        parent_series = list(get_series_ancestors(series_id, series_dict))
+    else:
         source_cur.execute(
             """
             SELECT series_title, series_parent
             FROM series
             WHERE series_id = %s
             """,
-            (series_parent,),
+            (series_id,),
         )
-        parent_title, series_parent = source_cur.fetchone()
-        parent_series.append(parent_title)
+        series_title, series_parent = source_cur.fetchone()
+
+        parent_series = []
+        while series_parent:
+            source_cur.execute(
+                """
+                SELECT series_title, series_parent
+                FROM series
+                WHERE series_id = %s
+                """,
+                (series_parent,),
+            )
+            parent_title, series_parent = source_cur.fetchone()
+            parent_series.append(parent_title)
 
     series_str_1 = "Part"
     if seriesnum:
@@ -828,29 +1786,37 @@ def get_series_strings(
     return unescape(series_str_1), unescape(series_str_2)
 
 
-def get_contents(title_id, ttype, source_cur):
-    # Use the pub_content table to find all titles contained in the book
+# Find the contents of every book with a title_id from first_id to
+# last_id, as (book_title_id, pub_ctype, content_title_id) rows. A book's
+# publications are found through the book's own title_id or through any
+# of its cfg.MY_LANG variants. The rows still need to be checked
+# against the books that were loaded, by filter_contents.
+def get_contents(first_id, last_id, source_cur):
+    if source_cur is None:
+        return snapshot.content_rows(first_id, last_id)
     source_cur.execute(
         """
-        SELECT DISTINCT t2.title_id
-        FROM titles AS t2
-        JOIN pub_content AS c2
-        ON t2.title_id = c2.title_id
-            JOIN pubs AS p
+        SELECT DISTINCT v.book_title_id, p.pub_ctype, t2.title_id
+        FROM (
+            SELECT c1.pub_id, c1.title_id AS book_title_id
+            FROM pub_content AS c1
+            WHERE c1.title_id BETWEEN %s AND %s
+            UNION
+            SELECT c1.pub_id, t1.title_parent AS book_title_id
+            FROM pub_content AS c1
+            JOIN titles AS t1
+            ON t1.title_id = c1.title_id
+            WHERE t1.title_parent BETWEEN %s AND %s
+            AND t1.title_parent != 0
+            AND t1.title_language = %s
+        ) AS v
+        JOIN pubs AS p
+        ON p.pub_id = v.pub_id
+            JOIN pub_content AS c2
             ON c2.pub_id = p.pub_id
-                JOIN pub_content AS c1
-                ON p.pub_id = c1.pub_id
-                    JOIN (
-                        SELECT %s AS title_id
-                        UNION
-                        SELECT title_id
-                        FROM titles
-                        WHERE title_parent = %s
-                        AND title_language = %s
-                    ) AS t1
-                    ON t1.title_id = c1.title_id
-                WHERE p.pub_ctype = %s
-        AND (
+                JOIN titles AS t2
+                ON t2.title_id = c2.title_id
+        WHERE (
             (
                 t2.title_ttype = 'SHORTFICTION'
                 AND
@@ -859,21 +1825,42 @@ def get_contents(title_id, ttype, source_cur):
             OR t2.title_ttype IN
             ('NOVEL', 'COLLECTION', 'ANTHOLOGY', 'OMNIBUS')
         )
-        AND t2.title_id != %s;
+        AND t2.title_id != v.book_title_id;
         """,
-        (title_id, title_id, cfg.MY_LANG, ttype, title_id),
+        (first_id, last_id, first_id, last_id, cfg.MY_LANG),
     )
     return source_cur.fetchall()
 
 
+# Keep the (book_title_id, content_title_id) pairs where the book was
+# loaded with the same type as the publication, and the content was
+# loaded too. book_types maps the title_id of every loaded book to its
+# book_type.
+def filter_contents(content_rows, book_types):
+    contents = set()
+    for book_title_id, pub_ctype, content_title_id in content_rows:
+        if (
+            pub_ctype != "NOVELLA"
+            and book_types.get(book_title_id) == pub_ctype
+            and content_title_id in book_types
+        ):
+            contents.add((book_title_id, content_title_id))
+    return sorted(contents)
+
+
 def constrain_vacuum_analyze(dest_cur):
     dest_cur.execute(
         """
         ALTER TABLE isbns
+        DROP CONSTRAINT IF EXISTS injective_isbn_to_title_id;
+        ALTER TABLE isbns
         ADD CONSTRAINT injective_isbn_to_title_id UNIQUE (isbn);
         """
     )
 
+    if cfg.UNLOGGED_LOAD:
+        set_tables_logged(dest_cur)
+
     dest_cur.execute(
         """
         VACUUM;
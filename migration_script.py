@@ -1,54 +1,169 @@
 #!/usr/bin/env python3
 
+import argparse
+import asyncio
 import logging
+import os
+import socket
 import subprocess
 import sys
-from datetime import datetime
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from html import unescape
 from math import ceil
-from multiprocessing import Pool, Value, cpu_count
+from multiprocessing import Pool, Process, Queue, Value, cpu_count
+from multiprocessing.connection import wait
+from queue import Full
+from threading import Event, Semaphore, Thread
 
 import mysql.connector
 import psycopg2
-from sqlalchemy import create_engine
 
 import setup_configuration as cfg
+from async_functions import (
+    check_async_drivers,
+    close_pools,
+    create_pools,
+    fetch_batch_data,
+    load_title_rows_async,
+    run_concurrently,
+)
+from bulk_load_functions import (
+    CONTENTS_COLUMNS,
+    ISBN_COLUMNS,
+    copy_rows,
+    insert_title_rows,
+    load_title_rows,
+    merge_rows,
+)
 from cold_start import cold_start_ranks
+from connection_functions import (
+    get_alchemy_engine,
+    get_dest_conn,
+    get_source_conn,
+    init_worker,
+    is_connection_error,
+    reset_dest_conn,
+    reset_source_conn,
+)
+from delta_functions import (
+    find_changed_titles,
+    get_book_contents,
+    get_dest_containers,
+    get_merged_books,
+    get_premerge_book_types,
+    get_raw_claimants,
+    get_raw_isbns,
+    get_source_containers,
+    get_stored_fingerprints,
+    get_title_fingerprints,
+    get_work_roots,
+    index_work_titles,
+    record_raw_isbns,
+    store_title_fingerprints,
+)
 from isbn_deduplication_functions import (
-    delete_isbn,
+    apply_isbn_deduplication_plan,
+    convert_isbns,
+    deduplicate_isbn,
     get_all_isbn_tuples,
-    get_duplicate_isbns,
+    get_claimant_books,
+    get_duplicate_isbn_components,
     insert_virtual_books,
-    isbn10_to_13,
-    isbn13_to_10,
-    simplify_title,
-    winner_takes_all,
+    plan_isbn_deduplication,
 )
 from migration_functions import (
+    BOOK_TABLE_INDEXES,
+    SEARCH_INDEXES,
+    add_deferred_constraints,
+    build_original_fields,
     constrain_vacuum_analyze,
+    count_all_titles,
     create_custom_text_search_config,
+    create_index,
+    create_search_extensions,
     create_ttype_enum,
+    create_words_table,
+    filter_contents,
+    format_alternate_titles,
+    general_search_generated,
     get_all_titles,
     get_alternate_titles,
     get_authors,
     get_award_winner,
+    get_bulk_pub_fields,
     get_contents,
+    get_index_size,
     get_language_dict,
     get_note,
     get_original_fields,
     get_pub_fields,
+    get_pub_rows,
+    get_series_dict,
     get_series_strings,
     get_synopsis,
+    get_title_attributes,
+    get_title_id_ranges,
+    get_titles_for_roots,
+    get_translation_groups,
     get_wikipedia_link,
-    index_book_tables,
-    populate_search_columns,
+    prefetch_notes,
     prepare_books_tables,
     safe_drop_tables,
+    set_index_build_settings,
     setup_custom_stop_words,
+    stream_all_titles,
+    update_general_search,
+)
+from run_state_functions import (
+    create_run_state_table,
+    finish_stage,
+    get_last_run,
+    get_matching_stage_times,
+    get_stage_times,
+    new_run_id,
+    start_stage,
+)
+from schema_functions import (
+    build_schema_name,
+    building_schema,
+    create_build_schema,
+    create_schema,
+    create_schema_builds_table,
+    drop_build,
+    get_old_builds,
+    get_previous_build,
+    get_serving_build,
+    switch_build,
+    use_schema,
+)
+from snapshot_functions import (
+    extract_snapshot,
+    find_snapshot,
+    load_snapshot,
+    snapshot_complete,
+)
+from stage_graph_functions import report_stage_timings, stage_dependencies
+from work_queue_functions import (
+    claim_title_batch,
+    close_title_queue,
+    count_title_batches,
+    create_title_batches_table,
+    enqueue_title_batch,
+    finish_title_batch,
+    get_queue_run,
+    get_worker_totals,
+    open_title_queue,
+    title_queue_finished,
 )
 
 
-def process_title(title_data):
+def process_title(title_data, batch_data=None):
+    # batch_data holds anything prefetch_title_batch looked up ahead of
+    # time for the whole batch. Anything missing is queried per title.
+    if batch_data is None:
+        batch_data = {}
 
     if cfg.PROGRESS_BAR:
         with i.get_lock():
@@ -81,10 +196,13 @@ def process_title(title_data):
 
     rank = cold_start_ranks.get(title_id, None)
 
-    source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+    source_cur = None
     try:
-
-        source_cur = source_conn.cursor()
+        # A buffered cursor makes sure no unread results are left on the
+        # worker's connection for the next title. With a snapshot, the
+        # source functions are given None and read the snapshot instead.
+        if not cfg.SOURCE_SNAPSHOT:
+            source_cur = get_source_conn().cursor(buffered=True)
 
         #       ORIGINAL DATA
         # For titles translated into my_lang, get bibliographic data about
@@ -92,9 +210,20 @@ def process_title(title_data):
         if parent_id != 0:
             # This title may be a translation.
 
-            original_fields = get_original_fields(
-                title_id, parent_id, source_cur, language_dict
-            )
+            if translation_groups is None:
+                original_fields = get_original_fields(
+                    title_id, parent_id, source_cur, language_dict
+                )
+            elif parent_id in translation_groups:
+                original_fields = build_original_fields(
+                    title_id,
+                    *translation_groups[parent_id],
+                    source_cur,
+                    language_dict,
+                )
+            else:
+                # get_all_titles already left out variant titles
+                original_fields = False
 
             if not original_fields:
                 # This is either just a variant title of an English
@@ -128,11 +257,16 @@ def process_title(title_data):
         #       PUBLICATION DATA
         # Choose representative publications to get a cover, page number, etc.
         # Get all covers and isbns to link to this title in their own tables.
-        with alchemyEngine.connect() as source_alch_conn:
-            pub_fields = get_pub_fields(
-                title_id, root_id, ttype, source_alch_conn
-            )
-        source_alch_conn.close()
+        if title_id in batch_data.get("pub_fields", {}):
+            pub_fields = batch_data["pub_fields"][title_id]
+        elif cfg.SOURCE_SNAPSHOT:
+            pub_fields = get_pub_fields(title_id, root_id, ttype, None)
+        else:
+            with get_alchemy_engine().connect() as source_alch_conn:
+                pub_fields = get_pub_fields(
+                    title_id, root_id, ttype, source_alch_conn
+                )
+            source_alch_conn.close()
 
         if not pub_fields:
             # this title isn't available in book form
@@ -155,21 +289,44 @@ def process_title(title_data):
         ) = pub_fields
 
         #       ETC
-        authors = get_authors(title_id, source_cur)
-        wikipedia = get_wikipedia_link(title_id, source_cur)
-        award_winner = get_award_winner(title_id, source_cur)
+        attributes = batch_data.get("title_attributes")
+        if cfg.SOURCE_SNAPSHOT and not (
+            attributes and title_id in attributes["authors"]
+        ):
+            # The snapshot is only read a batch of titles at a time
+            attributes = get_title_attributes([title_id], source_cur)
+        if attributes and title_id in attributes["authors"]:
+            authors = attributes["authors"][title_id]
+            wikipedia = attributes["wikipedia"][title_id]
+            award_winner = attributes["award_winner"][title_id]
+        else:
+            attributes = None
+            authors = get_authors(title_id, source_cur)
+            wikipedia = get_wikipedia_link(title_id, source_cur)
+            award_winner = get_award_winner(title_id, source_cur)
 
         # Unless this is a translation, check for alternate English titles
-        if original_lang == language_dict[my_lang]:
-            alt_titles = get_alternate_titles(title_id, title, source_cur)
-        else:
+        if original_lang != language_dict[my_lang]:
             alt_titles = None
+        elif attributes:
+            alt_titles = format_alternate_titles(
+                attributes["alt_titles"][title_id], title
+            )
+        else:
+            alt_titles = get_alternate_titles(title_id, title, source_cur)
 
         series_str_1, series_str_2 = get_series_strings(
-            series_id, seriesnum, seriesnum_2, parent_id, source_cur
+            series_id,
+            seriesnum,
+            seriesnum_2,
+            parent_id,
+            source_cur,
+            series_dict,
         )
 
-        if synopsis_id:
+        if synopsis_id in batch_data.get("synopses", {}):
+            synopsis = batch_data["synopses"][synopsis_id]
+        elif synopsis_id:
             synopsis = get_synopsis(synopsis_id, source_cur)
         else:
             synopsis = None
@@ -190,660 +347,1607 @@ def process_title(title_data):
         if original_lang != "English":
             title_id = lowest_title_id
 
-    except:
+    except Exception as e:
         logger.exception(
             f"\n{title_data[0]}\t{title_data[1]}\tSource db error"
         )
+        if is_connection_error(e):
+            # The next title will reconnect
+            reset_source_conn()
         with titles_errored.get_lock():
             titles_errored.value += 1
         return
     finally:
-        source_conn.close()
+        if source_cur is not None:
+            try:
+                source_cur.close()
+            except mysql.connector.Error:
+                pass
 
-    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
-    try:
-        with dest_conn:
-            with dest_conn.cursor() as dest_cur:
+    book_row = (
+        title_id,
+        unescape(title),
+        year,
+        authors,
+        ttype,
+        isbn,
+        pages,
+        editions,
+        alt_titles,
+        series_str_1,
+        series_str_2,
+        original_lang,
+        original_title,
+        original_year,
+        rating,
+        rank,
+        award_winner,
+        juvenile,
+        stand_alone,
+        cover_image,
+        wikipedia,
+        synopsis,
+        note,
+    )
+    isbn_rows = [
+        (book_isbn, title_id, book_ttype, foreign_lang)
+        for book_isbn, book_ttype, foreign_lang in all_isbns
+    ]
+    translation_rows = [
+        (translation_id, title_id, translation_title, tr_year, tr_note)
+        for translation_id, translation_title, tr_year, tr_note in translations
+    ]
+    more_images_rows = [(title_id, image) for image in more_images]
 
-                dest_cur.execute(
-                    """
-                    INSERT INTO books
-                    (title_id, title, year, authors, book_type,
-                    isbn, pages, editions, alt_titles,
-                    series_str_1, series_str_2,
-                    original_lang, original_title, original_year,
-                    isfdb_rating, cold_start_rank, award_winner,
-                    juvenile, stand_alone, cover_image, wikipedia,
-                    synopsis, note)
-                    VALUES (%s, %s, %s, %s, %s,
-                            %s, %s, %s, %s,
-                            %s, %s,
-                            %s, %s, %s,
-                            %s, %s, %s,
-                            %s, %s, %s, %s,
-                            %s, %s);
-                """,
-                    (
-                        title_id,
-                        unescape(title),
-                        year,
-                        authors,
-                        ttype,
-                        isbn,
-                        pages,
-                        editions,
-                        alt_titles,
-                        series_str_1,
-                        series_str_2,
-                        original_lang,
-                        original_title,
-                        original_year,
-                        rating,
-                        rank,
-                        award_winner,
-                        juvenile,
-                        stand_alone,
-                        cover_image,
-                        wikipedia,
-                        synopsis,
-                        note,
-                    ),
-                )
+    return book_row, isbn_rows, translation_rows, more_images_rows
 
-                for book_isbn, book_ttype, foreign_lang in all_isbns:
-                    dest_cur.execute(
-                        """
-                        INSERT INTO isbns
-                        (isbn, title_id, book_type, foreign_lang)
-                        VALUES (%s, %s, %s, %s);
-                        """,
-                        (book_isbn, title_id, book_ttype, foreign_lang),
-                    )
 
-                for (
-                    translation_id,
-                    translation_title,
-                    tr_year,
-                    note,
-                ) in translations:
-
-                    dest_cur.execute(
-                        """
-                        INSERT INTO translations
-                        (title_id, lowest_title_id, title, year, note)
-                        VALUES (%s, %s, %s, %s, %s);
-                        """,
-                        (
-                            translation_id,
-                            title_id,
-                            translation_title,
-                            tr_year,
-                            note,
-                        ),
-                    )
+def prefetch_title_batch(title_batch):
+    # Look up source data for a whole batch of titles with a few
+    # set-based queries, instead of a few queries for every title
+    batch_data = {}
+    if not cfg.BULK_EXTRACTION and not cfg.SOURCE_SNAPSHOT:
+        return batch_data
 
-                for image in more_images:
-                    dest_cur.execute(
-                        """
-                        INSERT INTO more_images
-                        (title_id, image)
-                        VALUES (%s, %s)
-                        ON CONFLICT
-                        ON CONSTRAINT more_images_title_id_image_key
-                        DO NOTHING;
-                    """,
-                        (title_id, image),
-                    )
+    title_requests = title_batch_requests(title_batch)
+    if not title_requests:
+        return batch_data
 
-    except:
-        logger.exception(
-            f"\n{title_data[0]}\t{title_data[1]}\tDestination db error"
+    root_ids = sorted({request[1] for request in title_requests})
+    source_cur = None
+    try:
+        if cfg.SOURCE_SNAPSHOT:
+            all_pubs = get_pub_rows(root_ids, None)
+        else:
+            with get_alchemy_engine().connect() as source_alch_conn:
+                all_pubs = get_pub_rows(root_ids, source_alch_conn)
+        batch_data["pub_fields"] = get_bulk_pub_fields(
+            title_requests, all_pubs
         )
-        with titles_errored.get_lock():
-            titles_errored.value += 1
-        return
-    finally:
-        dest_conn.close()
 
-    with titles_added.get_lock():
-        titles_added.value += 1
-    return
+        if not cfg.SOURCE_SNAPSHOT:
+            source_cur = get_source_conn().cursor(buffered=True)
+        batch_data["title_attributes"] = get_title_attributes(
+            [request[0] for request in title_requests], source_cur
+        )
 
+        # Rendered notes end up in note_cache, where get_note finds them
+        batch_data["synopses"] = prefetch_notes(
+            batch_note_ids(title_batch),
+            batch_synopsis_ids(title_batch),
+            source_cur,
+        )
+    except Exception as e:
+        # Whatever is missing will be looked up title by title
+        logger.exception(
+            f"\nBatch starting at {title_batch[0][0]}\tPrefetch error"
+        )
+        if is_connection_error(e):
+            reset_source_conn()
+    finally:
+        if source_cur is not None:
+            try:
+                source_cur.close()
+            except mysql.connector.Error:
+                pass
+    return batch_data
+
+
+# The (title_id, root_id, ttype) of each title in the batch that could
+# make it into the books
+def title_batch_requests(title_batch):
+    title_requests = []
+    for title_data in title_batch:
+        title_id, year, ttype, parent_id = (
+            title_data[0],
+            title_data[6],
+            title_data[7],
+            title_data[8],
+        )
+        if year == 8888:
+            continue
+        if ttype == "SHORTFICTION":
+            ttype = "NOVELLA"
+        root_id = parent_id if parent_id != 0 else title_id
+        title_requests.append((title_id, root_id, ttype))
+    return title_requests
+
+
+def batch_note_ids(title_batch):
+    note_ids = set()
+    for title_data in title_batch:
+        title_id, note_id, parent_id = (
+            title_data[0],
+            title_data[3],
+            title_data[8],
+        )
+        if note_id:
+            note_ids.add(note_id)
+        # Only the newest translation of a group builds its translations
+        if (
+            translation_groups is not None
+            and parent_id in translation_groups
+            and translation_groups[parent_id][3][0][0] == title_id
+        ):
+            for tr in translation_groups[parent_id][3]:
+                if tr[3]:
+                    note_ids.add(tr[3])
+    return note_ids
+
+
+def batch_synopsis_ids(title_batch):
+    return {title_data[2] for title_data in title_batch if title_data[2]}
+
+
+# The rows of each title in the batch that makes it into the books, as
+# (title_data, rows) pairs
+def build_title_batch(title_batch, batch_data=None):
+    if batch_data is None:
+        batch_data = prefetch_title_batch(title_batch)
+    title_rows = []
+    for title_data in title_batch:
+        rows = process_title(title_data, batch_data)
+        if rows:
+            title_rows.append((title_data, rows))
+    return title_rows
+
+
+def process_title_batch(title_batch):
+    load_title_batch(build_title_batch(title_batch))
+
+
+def load_title_batch(title_rows):
+    # Buffer the rows of a batch of titles and load them with COPY,
+    # rather than making a round trip for every row of every title
+    if not title_rows:
+        return
 
-def get_books_for_contents():
-    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
     try:
+        dest_conn = get_dest_conn()
         with dest_conn:
             with dest_conn.cursor() as dest_cur:
-                dest_cur.execute(
-                    """
-                    SELECT title_id, book_type
-                    FROM books
-                    WHERE book_type != 'NOVELLA';
-                    """
-                )
-                volumes = dest_cur.fetchall()
-    except:
-        logger.exception("Destination db error in get_books_for_contents")
-        return False
-    finally:
-        dest_conn.close()
-    return volumes
-
-
-def populate_contents_for_volume(volume):
-    title_id, ttype = volume
-    source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
-    try:
-        source_cur = source_conn.cursor()
-        contents = get_contents(title_id, ttype, source_cur)
-    except:
-        logger.exception(
-            f"\n{title_id}\tSource db error in populate_contents_for_volume"
+                load_title_rows([rows for _, rows in title_rows], dest_cur)
+    except Exception as e:
+        logger.warning(
+            f"Batch load of {len(title_rows)} titles failed. "
+            "Loading them one at a time instead.",
+            exc_info=True,
         )
+        if is_connection_error(e):
+            reset_dest_conn()
+    else:
+        with titles_added.get_lock():
+            titles_added.value += len(title_rows)
         return
-    finally:
-        source_conn.close()
 
-    for content in contents:
-        dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    # Load titles in separate transactions so one bad title doesn't
+    # discard the rest of the batch
+    for title_data, rows in title_rows:
         try:
+            dest_conn = get_dest_conn()
             with dest_conn:
                 with dest_conn.cursor() as dest_cur:
-                    dest_cur.execute(
-                        """
-                        INSERT INTO contents
-                        (book_title_id, content_title_id)
-                        VALUES (%s, %s);
-                        """,
-                        (title_id, content),
-                    )
-        except psycopg2.errors.ForeignKeyViolation:
-            # Attempts to insert contents not tracked in the books table
-            # will fail. These can be safely ignored.
-            pass
-
-        except:
+                    insert_title_rows(rows, dest_cur)
+        except Exception as e:
             logger.exception(
-                f"\n{title_id}\tDestination db error in "
-                "populate_contents_for_volume"
+                f"\n{title_data[0]}\t{title_data[1]}\tDestination db error"
             )
-        finally:
-            dest_conn.close()
-    return
+            if is_connection_error(e):
+                reset_dest_conn()
+            with titles_errored.get_lock():
+                titles_errored.value += 1
+        else:
+            with titles_added.get_lock():
+                titles_added.value += 1
 
 
-def create_isbn_10_and_13(isbn_tuple):
+def load_book_rows(book_rows, dest_cur):
+    # Load the books in the caller's transaction, together, or one at a
+    # time if that fails, leaving out the ones that can't be loaded.
+    # Returns how many books couldn't be loaded.
+    dest_cur.execute("SAVEPOINT book_rows;")
     try:
-        isbn, title_id, book_type, foreign_lang = isbn_tuple
-
-        if cfg.PROGRESS_BAR:
-            with i.get_lock():
-                i.value += 1
-                if i.value % two_percent_increment == 0:
-                    print("#", end="", flush=True)
+        load_title_rows(book_rows, dest_cur)
+    except psycopg2.Error:
+        logger.warning(
+            "Loading the books together failed. "
+            "Loading them one at a time instead.",
+            exc_info=True,
+        )
+        dest_cur.execute("ROLLBACK TO SAVEPOINT book_rows;")
+    else:
+        return 0
 
-        if len(isbn) == 13:
-            if isbn[:3] != "978":
-                # newer isbn 13s don't have an isbn 10 equivilent
-                new_isbn = None
-            else:
-                new_isbn = isbn13_to_10(isbn)
-                if len(new_isbn) != 10:
-                    raise Exception(f"Invalid ISBN conversion for: {isbn}")
-        elif len(isbn) == 10:
-            new_isbn = isbn10_to_13(isbn)
-            if len(new_isbn) != 13:
-                raise Exception(f"Invalid ISBN conversion for: {isbn}")
-        else:
-            raise Exception(
-                f"ISBN for {title_id} has incorrect number of characters: "
-                f"{isbn}"
+    books_errored = 0
+    for rows in book_rows:
+        dest_cur.execute("SAVEPOINT book_rows;")
+        try:
+            insert_title_rows(rows, dest_cur)
+        except psycopg2.Error:
+            logger.exception(f"\n{rows[0][0]}\tDestination db error")
+            dest_cur.execute("ROLLBACK TO SAVEPOINT book_rows;")
+            books_errored += 1
+    return books_errored
+
+
+#       TITLE PIPELINE
+# Instead of each pool worker extracting and then loading its batches,
+# extractor processes build the rows of the batches and hand them to
+# loader processes through a bounded queue. The parent feeds the
+# extractors through another bounded queue, and samples how full both
+# are while the titles are processed.
+
+
+def extract_titles(title_queue, rows_queue):
+    # Extractor process. A None batch means there are no more titles.
+    init_worker(connections_opened)
+    while True:
+        title_batch = title_queue.get()
+        if title_batch is None:
+            break
+        try:
+            title_rows = build_title_batch(title_batch)
+        except Exception:
+            logger.exception(
+                f"\nBatch starting at {title_batch[0][0]}\tExtraction error"
             )
+            with titles_errored.get_lock():
+                titles_errored.value += len(title_batch)
+            continue
+        if title_rows:
+            rows_queue.put(title_rows)
+
+
+def load_titles(rows_queue):
+    # Loader process. None means the extractors are done.
+    init_worker(connections_opened)
+    while True:
+        title_rows = rows_queue.get()
+        if title_rows is None:
+            break
+        load_title_batch(title_rows)
+
+
+def sample_queue_depths(queues, depths, stop, interval=1):
+    while not stop.wait(interval):
+        for name, queue in queues.items():
+            depths[name].append(queue.qsize())
+
+
+def report_queue_depths(depths):
+    # A queue that is usually full is waiting on the processes reading
+    # it, and one that is usually empty is waiting on the ones filling it
+    print(f"Queue depths, out of {cfg.PIPELINE_QUEUE_SIZE} batches:")
+    for name, samples in depths.items():
+        if not samples:
+            continue
+        full = sum(depth >= cfg.PIPELINE_QUEUE_SIZE for depth in samples)
+        empty = sum(depth == 0 for depth in samples)
+        depth_str = (
+            f"  {name}: mean {sum(samples) / len(samples):.1f}, "
+            + f"max {max(samples)}, "
+            + f"full {100 * full / len(samples):.0f}% of the time, "
+            + f"empty {100 * empty / len(samples):.0f}% of the time"
+        )
+        print(depth_str)
+        logger.info(depth_str)
+
+
+def run_title_pipeline(titles):
+    # Process the titles with extractor and loader processes. With
+    # titles set to None, they're streamed from the source instead.
+    title_queue = Queue(cfg.PIPELINE_QUEUE_SIZE)
+    rows_queue = Queue(cfg.PIPELINE_QUEUE_SIZE)
+    extractors = [
+        Process(target=extract_titles, args=(title_queue, rows_queue))
+        for _ in range(cfg.PIPELINE_EXTRACTORS)
+    ]
+    loaders = [
+        Process(target=load_titles, args=(rows_queue,))
+        for _ in range(cfg.PIPELINE_LOADERS)
+    ]
+    for process in extractors + loaders:
+        process.start()
+    print(
+        f"Pipeline of {len(extractors)} extractors "
+        + f"and {len(loaders)} loaders"
+    )
+
+    depths = {"extractor queue": [], "loader queue": []}
+    stop_sampling = Event()
+    sampler = Thread(
+        target=sample_queue_depths,
+        args=(
+            {"extractor queue": title_queue, "loader queue": rows_queue},
+            depths,
+            stop_sampling,
+        ),
+    )
+    sampler.start()
+    try:
+        # If all the extractors, or all the loaders, have exited, the
+        # queues will never be emptied, so that fails the stage instead
+        stages = {"extractors": extractors, "loaders": loaders}
+        feed_title_queue(titles, title_queue, stages)
+        for _ in extractors:
+            put_while_running(title_queue, None, stages)
+        join_while_running(extractors, {"loaders": loaders})
+        for _ in loaders:
+            put_while_running(rows_queue, None, {"loaders": loaders})
+        join_while_running(loaders, {})
+    finally:
+        stop_title_processes(extractors + loaders)
+        stop_sampling.set()
+        sampler.join()
+    check_exit_codes(extractors + loaders)
+    return depths
 
-        if new_isbn:
-            dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
-            with dest_conn:
-                with dest_conn.cursor() as dest_cur:
-                    dest_cur.execute(
-                        """
-                        INSERT INTO isbns
-                        (isbn, title_id, book_type, foreign_lang)
-                        VALUES(%s, %s, %s, %s)
-                        ON CONFLICT DO NOTHING;
-                        """,
-                        (new_isbn, title_id, book_type, foreign_lang),
-                    )
 
-        with isbns_processed.get_lock():
-            isbns_processed.value += 1
-    except:
-        logger.exception(f"\n{isbn_tuple[0]}\tFailed to process")
-        with isbns_errored.get_lock():
-            isbns_errored.value += 1
-        return
-    finally:
+# Put item on a bounded queue, waiting while it's full as long as some
+# process of each stage in stages, {name: processes}, is still running
+def put_while_running(queue, item, stages):
+    while True:
         try:
-            dest_conn.close()
-        except (NameError, psycopg2.InterfaceError):
-            pass
+            queue.put(item, timeout=1)
+            return
+        except Full:
+            check_running(stages)
 
 
-def deduplicate_isbn(duplicate_isbn):
-    logger.info(str(duplicate_isbn))
+def join_while_running(processes, stages):
+    for process in processes:
+        process.join(1)
+        while process.is_alive():
+            check_running(stages)
+            process.join(1)
 
-    if cfg.PROGRESS_BAR:
-        with i.get_lock():
-            i.value += 1
-            if i.value % two_percent_increment == 0:
-                print("#", end="", flush=True)
 
-    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
-    try:
-        with dest_conn:
-            with dest_conn.cursor() as dest_cur:
-                dest_cur.execute(
-                    """
-                    SELECT title_id
-                    FROM books
-                    WHERE isbn = %s
-                    FOR UPDATE;
-                    """,
-                    duplicate_isbn,
-                )
+def check_running(stages):
+    for name, processes in stages.items():
+        if not any(process.is_alive() for process in processes):
+            raise Exception(f"All the title {name} have exited")
 
-                # Lock the book and isbn enties in question so that
-                # concurrent processes don't try to work on the same data
-                dest_cur.execute(
-                    """
-                    SELECT b.title_id, b.title, b.authors, b.year, b.pages,
-                        b.alt_titles, b.cover_image,
-                        i.book_type, i.foreign_lang
-                    FROM books AS b
-                    JOIN isbns AS i
-                    ON b.title_id = i.title_id
-                    WHERE i.isbn = %s
-                    ORDER BY
-                        CASE
-                            WHEN i.book_type = 'NOVEL' THEN 1
-                            WHEN i.book_type = 'NOVELLA' THEN 2
-                            WHEN i.book_type = 'OMNIBUS' THEN 3
-                            WHEN i.book_type = 'ANTHOLOGY' THEN 4
-                            WHEN i.book_type = 'COLLECTION' THEN 5
-                        END,
-                        b.year DESC, b.pages DESC, b.title_id DESC
-                    FOR UPDATE;
-                    """,
-                    duplicate_isbn,
-                )
-                isbn_claimants = dest_cur.fetchall()
 
-                # TODO lock contents tables
+# After an error, the processes that are still running may be waiting on
+# a queue that nothing reads anymore
+def stop_title_processes(processes):
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
 
-                if len(isbn_claimants) == 0:
-                    e_str = (
-                        str(duplicate_isbn[0])
-                        + ": all records "
-                        + "for this ISBN were already deleted"
-                    )
-                elif len(isbn_claimants) == 1:
-                    # This title was already deduped
-                    return
-                else:
-                    e_str = None
 
-                if e_str:
-                    raise Exception(e_str)
+# A process that died, for example killed for running out of memory,
+# took the titles it was working on with it
+def check_exit_codes(processes):
+    failed = [process for process in processes if process.exitcode != 0]
+    if failed:
+        raise Exception(
+            f"{len(failed)} title processes exited with an error: "
+            + ", ".join(str(process.exitcode) for process in failed)
+        )
 
-                # There are two ways to resolve duplicate ISBNs:
-                # delete the ISBN from both titles (most common), or
-                # "winner takes all", which is reserved for cases where
-                # the book is more or less just a new edition with extra
-                # material and the book entries can be merged. The rest
-                # of the logic in this method tries to determine this.
-                (
-                    _,
-                    a_title,
-                    a_authors,
-                    _,
-                    _,
-                    _,
-                    _,
-                    a_book_type,
-                    a_foreign_lang,
-                ) = isbn_claimants[0]
 
-                (
-                    _,
-                    b_title,
-                    b_authors,
-                    _,
-                    _,
-                    _,
-                    _,
-                    b_book_type,
-                    b_foreign_lang,
-                ) = isbn_claimants[1]
-
-                # The tuple of book types is a key variable in determining
-                # which case this is, since certain changes
-                # (novel to collection) are typical of extra material
-                # being added to the new edition of a book, while others
-                # (novella to omnibus) aren't possible without making it
-                # a substantially different book.
-                a_b_book_types = (a_book_type, b_book_type)
-
-                if (
-                    len(isbn_claimants) > 2
-                    or a_foreign_lang
-                    or b_foreign_lang
-                    or a_b_book_types
-                    in [("NOVELLA", "OMNIBUS"), ("NOVEL", "NOVELLA")]
-                ):
-                    # Cases of more than two titles sharing an ISBN are
-                    # pactically always multi-volume series that are
-                    # sold under a common ISBN, which than is not useful
-                    # for identifying the book. It should be deleted.
-                    # Likewise, any case of foreign isbns causing
-                    # duplication are too likely to cause errors with
-                    # winner-take-all, and cases of book type
-                    # transformation considered impossible are also deleted
-
-                    delete_isbn(duplicate_isbn[0], dest_cur)
+def feed_title_queue(titles, title_queue, stages):
+    # Put the titles on the queue in batches. With titles set to None,
+    # they're streamed from the source instead. stages are the processes
+    # the titles go through, as for put_while_running.
+    source_conn = None
+    try:
+        if titles is None:
+            # Connect after the processes are forked, so they don't
+            # inherit the connection that is streaming the titles
+            source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+            title_batches = stream_all_titles(
+                source_conn, cfg.LOAD_BATCH_SIZE, limit=cfg.LIMIT
+            )
+        else:
+            title_batches = split_title_batches(titles)
+        # The queue blocks while it's full, so the titles are only read
+        # as fast as they're taken off it
+        for title_batch in title_batches:
+            put_while_running(title_queue, title_batch, stages)
+    finally:
+        if source_conn is not None:
+            source_conn.close()
+
+
+#       ASYNC TITLE LOOP
+# Instead of one process for each batch in flight, a few processes each
+# run an event loop with many batches in flight. The source queries of
+# a batch are sent together through a pool of async connections, and
+# its rows are loaded through another, so each process waits on the
+# databases for many batches at once rather than for one at a time.
+
+
+async def process_title_batch_async(
+    title_batch, source_pool, dest_pool, builder
+):
+    batch_data = None
+    if not cfg.SOURCE_SNAPSHOT:
+        # Whatever is missing will be looked up title by title, with the
+        # process's blocking connection, in the builder thread
+        batch_data = {}
+        title_requests = title_batch_requests(title_batch)
+        try:
+            if title_requests:
+                batch_data = await fetch_batch_data(
+                    title_requests,
+                    batch_note_ids(title_batch),
+                    batch_synopsis_ids(title_batch),
+                    source_pool,
+                )
+        except Exception:
+            logger.exception(
+                f"\nBatch starting at {title_batch[0][0]}\tPrefetch error"
+            )
+    try:
+        title_rows = await asyncio.get_running_loop().run_in_executor(
+            builder, build_title_batch, title_batch, batch_data
+        )
+    except Exception:
+        logger.exception(
+            f"\nBatch starting at {title_batch[0][0]}\tExtraction error"
+        )
+        with titles_errored.get_lock():
+            titles_errored.value += len(title_batch)
+        return
+    await load_title_batch_async(title_rows, dest_pool)
 
-                else:
-                    if a_b_book_types in [
-                        ("NOVEL", "ANTHOLOGY"),
-                        ("NOVEL", "COLLECTION"),
-                        ("NOVEL", "OMNIBUS"),
-                        ("NOVELLA", "ANTHOLOGY"),
-                        ("NOVELLA", "COLLECTION"),
-                    ]:
-                        # Book transformations that are technically possible
-                        # by adding or removing small amount of material
-                        # are considered for winner-takes-all only on an
-                        # exact title match
-
-                        titles_match = a_title.lower() == b_title.lower()
-
-                    else:
-                        # The most likely cases of book transformation,
-                        # included those were a and b are the same type,
-                        # have a less strict name match requirement. This
-                        # is allow cases like "Ghost Stories", and
-                        # "Ghost Stories: now with two bonus stories".
-
-                        a_simple_title = simplify_title(a_title)
-                        b_simple_title = simplify_title(b_title)
-                        titles_match = (
-                            a_simple_title in b_simple_title
-                            or b_simple_title in a_simple_title
-                        )
 
-                    if not titles_match:
-                        delete_isbn(duplicate_isbn[0], dest_cur)
-                    else:
-                        # The final requirement for winner-takes-all is
-                        # for the books to have the same author(s), or
-                        # to have some authors in common to account for
-                        # cases of stories being added or removed from
-                        # some editions.
-                        a_author_set = set(a_authors.lower().split(", "))
-                        b_author_set = set(b_authors.lower().split(", "))
-                        authors_in_common = a_author_set.intersection(
-                            b_author_set
-                        )
-                        if not authors_in_common:
-                            delete_isbn(duplicate_isbn[0], dest_cur)
-                        else:
-                            winner_takes_all(isbn_claimants, dest_cur)
+# Async version of load_title_batch
+async def load_title_batch_async(title_rows, dest_pool):
+    if not title_rows:
+        return
 
-    except:
-        logger.exception(f"\n{duplicate_isbn[0]}\tFailed to dedulpicate")
-        with isbns_errored.get_lock():
-            isbns_errored.value += 1
+    try:
+        await load_title_rows_async(
+            [rows for _, rows in title_rows], dest_pool
+        )
+    except Exception:
+        logger.warning(
+            f"Batch load of {len(title_rows)} titles failed. "
+            "Loading them one at a time instead.",
+            exc_info=True,
+        )
+    else:
+        with titles_added.get_lock():
+            titles_added.value += len(title_rows)
         return
-    finally:
-        dest_conn.close()
 
-    with isbns_deduped.get_lock():
-        isbns_deduped.value += 1
-    return
+    for title_data, rows in title_rows:
+        try:
+            await load_title_rows_async([rows], dest_pool)
+        except Exception:
+            logger.exception(
+                f"\n{title_data[0]}\t{title_data[1]}\tDestination db error"
+            )
+            with titles_errored.get_lock():
+                titles_errored.value += 1
+        else:
+            with titles_added.get_lock():
+                titles_added.value += 1
 
 
-if __name__ == "__main__":
+def run_async_titles(title_queue):
+    # Async title process. A None batch means there are no more titles.
+    init_worker(connections_opened)
+    asyncio.run(process_title_queue(title_queue))
 
-    start = datetime.now()
-    if cfg.DEBUG:
-        logging.basicConfig(level=logging.WARNING)
-    else:
-        log_path = f"/tmp/{str(start).split('.')[0]}.log"
-        logging.basicConfig(filename=log_path, level=logging.INFO)
-    logger = logging.getLogger(__name__)
-    logger.info(f"{start}\tStarting Logging")
-    # TODO: make this configurable script parameter
-    my_lang = cfg.ENGLISH
-    source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+
+async def process_title_queue(title_queue):
+    try:
+        source_pool, dest_pool = await create_pools()
+    except Exception:
+        logger.exception("\nAsync title process couldn't connect")
+        # Keep taking batches, so the parent isn't left waiting on a
+        # full queue
+        for title_batch in iter(title_queue.get, None):
+            with titles_errored.get_lock():
+                titles_errored.value += len(title_batch)
+        return
+    # The titles of each batch are built in a thread of its own, so the
+    # event loop keeps the queries and loads of the other batches going
+    # in the meantime. The blocking source connection of the process
+    # can't be shared between threads, so there's only the one, which
+    # costs little since building titles holds the GIL anyway.
+    builder = ThreadPoolExecutor(max_workers=1)
+    try:
+        await run_concurrently(
+            title_queue.get,
+            lambda title_batch: process_title_batch_async(
+                title_batch, source_pool, dest_pool, builder
+            ),
+            cfg.ASYNC_CONCURRENCY,
+        )
+    finally:
+        builder.shutdown()
+        await close_pools(source_pool, dest_pool)
+
+
+def run_async_title_loop(titles):
+    # Process the titles in async_processes async title processes. With
+    # titles set to None, they're streamed from the source instead.
+    check_async_drivers()
+    # Each process takes batches as it has room for them, so only a
+    # couple per process need to be read ahead
+    title_queue = Queue(cfg.ASYNC_PROCESSES * 2)
+    processes = [
+        Process(target=run_async_titles, args=(title_queue,))
+        for _ in range(cfg.ASYNC_PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    print(
+        f"{len(processes)} async processes with up to "
+        + f"{cfg.ASYNC_CONCURRENCY} batches in flight each"
+    )
+    stages = {"async processes": processes}
     try:
-        source_cur = source_conn.cursor()
-        language_dict = get_language_dict(source_cur)
+        feed_title_queue(titles, title_queue, stages)
+        for _ in processes:
+            put_while_running(title_queue, None, stages)
+        join_while_running(processes, {})
     finally:
-        source_conn.close()
+        stop_title_processes(processes)
+    check_exit_codes(processes)
 
-    # Try to delete and the table (with user interaction)
-    # and create them again from scratch
+
+#       TITLE WORK QUEUE
+# The batches are put in the title_batches table, and claimed from there
+# by queue workers: the ones this run starts, and any more started with
+# --worker while it runs, on this host or another. See
+# work_queue_functions.
+
+
+def run_title_queue(titles):
+    # Queue the titles and work through them. With titles set to None,
+    # they're streamed from the source instead. The workers start on
+    # the batches as soon as they're committed, while the rest are
+    # still being read.
+    source_conn = None
     dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
-    dest_conn.autocommit = True
     try:
         with dest_conn:
             with dest_conn.cursor() as dest_cur:
-                if cfg.CREATE_SEARCH_INDEXES:
-                    success = setup_custom_stop_words()
-                    if not success:
-                        sys.exit(1)
-                try:
-                    success = safe_drop_tables(
-                        [
-                            "isbns",
-                            "contents",
-                            "translations",
-                            "more_images",
-                            "books",
-                            "words",
-                            "isfdb_title_tsc",
-                            "isfdb_title_dict",
-                            "ttype",
-                        ],
-                        dest_cur,
-                    )
-                except psycopg2.errors.DependentObjectsStillExist:
-                    pass
-                finally:
-                    if not success:
-                        sys.exit(1)
-                if cfg.CREATE_SEARCH_INDEXES:
-                    language_used = create_custom_text_search_config(
-                        language_dict[my_lang], dest_cur
-                    )
-                    if language_used == "simple":
-                        warning_str = (
-                            "The specified language isn't doesn't have a "
-                            "snowball stemmer. Using simple configuration "
-                            "instead. Stemming isn't available for title "
-                            "search vectors"
+                open_title_queue(run_id, dest_cur)
+        workers = start_queue_workers(run_id)
+        print(f"Add workers with: {sys.argv[0]} --worker")
+        batch_count = 0
+        try:
+            if titles is None:
+                source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+                title_batches = stream_all_titles(
+                    source_conn, cfg.LOAD_BATCH_SIZE, limit=cfg.LIMIT
+                )
+            else:
+                title_batches = split_title_batches(titles)
+            for title_batch in title_batches:
+                with dest_conn:
+                    with dest_conn.cursor() as dest_cur:
+                        enqueue_title_batch(
+                            run_id, batch_count, title_batch, dest_cur
                         )
-                        print(warning_str)
-                        logger.warning(warning_str)
-                try:
-                    create_ttype_enum(dest_cur)
-                except psycopg2.errors.DuplicateObject:
-                    pass
-                prepare_books_tables(dest_cur)
-    except:
-        print(
-            "Problem with stop word file, "
-            + " or with deleting or creating the tables."
-        )
-        print("Exiting migration script.")
-        logger.exception("exception")
-        sys.exit(1)
+                batch_count += 1
+        finally:
+            # Even if reading the titles failed, so that the workers
+            # finish what was queued and stop. If the queue can't be
+            # closed, they would never stop.
+            try:
+                with dest_conn:
+                    with dest_conn.cursor() as dest_cur:
+                        close_title_queue(run_id, dest_cur)
+            except BaseException:
+                for process in workers:
+                    process.terminate()
+                raise
+            finally:
+                for process in workers:
+                    process.join()
     finally:
+        if source_conn is not None:
+            source_conn.close()
         dest_conn.close()
+    print(f"\n{batch_count} batches queued for run {run_id}")
 
-    source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+    # Every worker's titles are counted in the queue
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
     try:
-        source_cur = source_conn.cursor()
-        language_dict = get_language_dict(source_cur)
-        print("Main ISFDB title table query...")
-        titles = get_all_titles(source_cur, limit=cfg.LIMIT)
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                worker_totals = get_worker_totals(run_id, dest_cur)
     finally:
-        source_conn.close()
+        dest_conn.close()
+    titles_added.value = sum(row[2] for row in worker_totals)
+    titles_skipped.value = sum(row[3] for row in worker_totals)
+    titles_errored.value = sum(row[4] for row in worker_totals)
+    print("\nBatches by worker:")
+    for worker, batches, *_ in worker_totals:
+        print(f"  {worker}: {batches}")
 
-    alchemyEngine = create_engine(cfg.SOURCE_DB_ALCHEMY_CONN_STRING)
 
-    if cfg.N_PROC > 0:
-        pool_size = cfg.N_PROC
-    elif cfg.N_PROC < -1:
-        pool_size = cpu_count() + cfg.N_PROC + 1
-    else:
-        pool_size = cpu_count()
+def run_queue_workers(queue_run_id):
+    # Start a queue worker for each process, and wait until the queue
+    # is finished
+    for process in start_queue_workers(queue_run_id):
+        process.join()
+
+
+def start_queue_workers(queue_run_id):
+    workers = [
+        Process(target=work_title_queue, args=(queue_run_id,))
+        for _ in range(get_pool_size())
+    ]
+    for process in workers:
+        process.start()
+    return workers
+
 
+def work_title_queue(queue_run_id):
+    # Queue worker process. Each one counts its own titles, which are
+    # recorded with the batches it finishes.
+    global titles_added, titles_skipped, titles_errored
+    init_worker(connections_opened)
     titles_added = Value("i", 0)
     titles_skipped = Value("i", 0)
     titles_errored = Value("i", 0)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
 
-    #       MAIN TITLE PROCESSING LOOP
-    print("\nMain title loop...")
-    print(f"Processing {len(titles)} titles")
-    print(f"Start time: {datetime.now()}")
-    if cfg.PROGRESS_BAR:
-        i = Value("i", 0)
-        two_percent_increment = ceil(len(titles) / 50)
-        print(f"\n# = {two_percent_increment} titles processed")
-        print("1%[" + "    ." * 10 + "]100%")
-        print("  [", end="", flush=True)
-
-    # Process titles in parallel
-    with Pool(pool_size) as p:
-        p.map(process_title, titles)
+    while True:
+        try:
+            if work_title_batch(queue_run_id, worker):
+                continue
+            dest_conn = get_dest_conn()
+            with dest_conn:
+                with dest_conn.cursor() as dest_cur:
+                    finished = title_queue_finished(queue_run_id, dest_cur)
+        except Exception as e:
+            # The batch, if any, goes back to the queue with the
+            # transaction
+            logger.exception(f"\n{worker}\tQueue worker error")
+            if is_connection_error(e):
+                reset_dest_conn()
+                reset_source_conn()
+        else:
+            if finished:
+                return
+        # What's left is claimed by other workers, or hasn't been queued
+        # yet. Check again later, also in case a worker dies and its
+        # batch is released.
+        time.sleep(cfg.QUEUE_POLL_SECONDS)
+
+
+def work_title_batch(queue_run_id, worker):
+    # Claim a batch, load its rows and mark it done in one transaction.
+    # Returns False if there was no batch to claim.
+    dest_conn = get_dest_conn()
+    with dest_conn:
+        with dest_conn.cursor() as dest_cur:
+            claimed = claim_title_batch(queue_run_id, dest_cur)
+            if claimed is None:
+                return False
+            batch_id, title_batch = claimed
+            counts_before = (
+                titles_skipped.value,
+                titles_errored.value,
+            )
+            status = "done"
+            try:
+                title_rows = build_title_batch(title_batch)
+            except Exception:
+                logger.exception(
+                    f"\nBatch starting at {title_batch[0][0]}\t"
+                    + "Extraction error"
+                )
+                with titles_errored.get_lock():
+                    titles_errored.value += len(title_batch)
+                title_rows = []
+                status = "failed"
+            books_errored = load_book_rows(
+                [rows for _, rows in title_rows], dest_cur
+            )
+            counts = (
+                len(title_rows) - books_errored,
+                titles_skipped.value - counts_before[0],
+                titles_errored.value - counts_before[1] + books_errored,
+            )
+            finish_title_batch(
+                queue_run_id, batch_id, status, worker, counts, dest_cur
+            )
+    return True
 
-    if cfg.PROGRESS_BAR:
-        print("]")
 
-    end = datetime.now()
+def join_title_queue():
+    # --worker: add queue workers to the titles stage of a running
+    # migration. They have to build the books the same way it does.
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                queue_run = get_queue_run(dest_cur)
+                # The titles stage may be run again after the swap
+                swapped = queue_run is not None and "swap" in (
+                    get_stage_times(queue_run[0], dest_cur)
+                )
+    finally:
+        dest_conn.close()
+    if queue_run is None:
+        print("There is no running titles stage to join.")
+        sys.exit(1)
+    queue_run_id, parameters = queue_run
+    parameters = dict(parameters or {})
+    queue_plan = parameters.pop("stages", FULL_RUN)
+    if parameters != run_parameters():
+        print(
+            f"The configuration of run {queue_run_id} is different. "
+            + "Workers have to use the same one."
+        )
+        sys.exit(1)
+    use_run_schema(queue_run_id, queue_plan, swapped)
+
+    if cfg.SOURCE_SNAPSHOT:
+        load_source_snapshot()
+        prepare_title_workers(None)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            prepare_title_workers(source_conn.cursor())
+        finally:
+            source_conn.close()
+
+    # Wait for the run to queue its first batch
+    print(f"Joining run {queue_run_id}...")
+    while True:
+        dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+        try:
+            with dest_conn:
+                with dest_conn.cursor() as dest_cur:
+                    queue_run = get_queue_run(dest_cur)
+                    batch_count = count_title_batches(queue_run_id, dest_cur)
+        finally:
+            dest_conn.close()
+        if queue_run is None or queue_run[0] != queue_run_id:
+            print(f"The titles stage of run {queue_run_id} has ended.")
+            return
+        if batch_count:
+            break
+        time.sleep(cfg.QUEUE_POLL_SECONDS)
+
+    start = datetime.now()
+    run_queue_workers(queue_run_id)
+    print(f"Connections opened: {connections_opened.value}")
+    print(f"Total time: {datetime.now() - start}")
+
+
+def split_title_batches(titles):
+    return [
+        titles[ii : ii + cfg.LOAD_BATCH_SIZE]
+        for ii in range(0, len(titles), cfg.LOAD_BATCH_SIZE)
+    ]
+
+
+def throttle(items, slots, stop):
+    # Wait for a free slot before each item. The consumer releases a
+    # slot whenever it is done with an item. To stop early, the consumer
+    # sets stop and releases enough slots to wake the wait.
+    for item in items:
+        slots.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def get_book_types():
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                dest_cur.execute(
+                    """
+                    SELECT title_id, book_type
+                    FROM books;
+                    """
+                )
+                book_types = dict(dest_cur.fetchall())
+    except:
+        logger.exception("Destination db error in get_book_types")
+        return False
+    finally:
+        dest_conn.close()
+    return book_types
+
+
+# Split the title_ids of the books that can have contents into ranges
+# of about the same number of books
+def get_contents_ranges(book_types, n_ranges):
+    volume_ids = sorted(
+        title_id
+        for title_id, book_type in book_types.items()
+        if book_type != "NOVELLA"
+    )
+    range_size = max(1, ceil(len(volume_ids) / n_ranges))
+    return [
+        (volume_ids[ii], volume_ids[min(ii + range_size, len(volume_ids)) - 1])
+        for ii in range(0, len(volume_ids), range_size)
+    ]
+
+
+def populate_contents_range(id_range):
+    first_id, last_id = id_range
+    source_cur = None
+    try:
+        if not cfg.SOURCE_SNAPSHOT:
+            source_cur = get_source_conn().cursor(buffered=True)
+        contents = filter_contents(
+            get_contents(first_id, last_id, source_cur), book_types
+        )
+    except Exception as e:
+        logger.exception(
+            f"\n{first_id}-{last_id}\tSource db error in "
+            "populate_contents_range"
+        )
+        if is_connection_error(e):
+            reset_source_conn()
+        with content_ranges_errored.get_lock():
+            content_ranges_errored.value += 1
+        return
+    finally:
+        if source_cur is not None:
+            try:
+                source_cur.close()
+            except mysql.connector.Error:
+                pass
+
+    try:
+        dest_conn = get_dest_conn()
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                copy_rows("contents", CONTENTS_COLUMNS, contents, dest_cur)
+    except Exception as e:
+        logger.exception(
+            f"\n{first_id}-{last_id}\tDestination db error in "
+            "populate_contents_range"
+        )
+        if is_connection_error(e):
+            reset_dest_conn()
+        with content_ranges_errored.get_lock():
+            content_ranges_errored.value += 1
+        return
+
+    with contents_added.get_lock():
+        contents_added.value += len(contents)
+
+
+def convert_isbn_tuples(isbn_tuples):
+    # Convert every isbn at once. Returns the rows for the counterparts,
+    # and how many isbns were processed, couldn't be converted, and have
+    # a wrong check digit.
+    new_isbns, errors, bad_check_digits = convert_isbns(
+        [isbn_tuple[0] for isbn_tuple in isbn_tuples]
+    )
+    new_isbn_rows = []
+    for isbn_tuple, new_isbn, error in zip(isbn_tuples, new_isbns, errors):
+        isbn, title_id, book_type, foreign_lang = isbn_tuple
+        if error:
+            logger.error(
+                f"\n{isbn}\tFailed to process: ISBN for {title_id} "
+                "can't be converted"
+            )
+        elif new_isbn:
+            new_isbn_rows.append((new_isbn, title_id, book_type, foreign_lang))
+    return (
+        new_isbn_rows,
+        len(isbn_tuples) - int(errors.sum()),
+        int(errors.sum()),
+        int(bad_check_digits.sum()),
+    )
+
+
+def create_isbn_10_and_13(new_isbn_rows):
+    # Insert the missing counterparts in a single statement
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                merge_rows(
+                    "isbns",
+                    ISBN_COLUMNS,
+                    new_isbn_rows,
+                    "ON CONFLICT DO NOTHING",
+                    dest_cur,
+                )
+    except:
+        logger.exception("Failed to insert the converted isbns")
+        return False
+    finally:
+        dest_conn.close()
+    return True
+
+
+def deduplicate_isbns_in_memory(isbn_rows):
+    # Decide every deduplication in memory, then write the outcome in one
+    # transaction. isbn_rows includes the converted isbns, which haven't
+    # been inserted, so they are only ever written in their final form.
+    # Returns how many isbns were deduplicated and errored.
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                insert_virtual_books(dest_cur)
+                books = get_claimant_books(isbn_rows, dest_cur)
+                (
+                    plan,
+                    final_isbn_rows,
+                    isbns_deduped,
+                    isbns_errored,
+                ) = plan_isbn_deduplication(isbn_rows, books)
+                print(
+                    f"Planned {len(plan)} changes: "
+                    + f"{sum(step[0] == 'merge' for step in plan)} merges, "
+                    + f"{sum(step[0] == 'delete' for step in plan)} deletes"
+                )
+                row_counts = apply_isbn_deduplication_plan(
+                    plan, final_isbn_rows, dest_cur
+                )
+                for step, row_count in row_counts.items():
+                    print(f"  {step}: {row_count} rows")
+    except:
+        error_str = "Problem planning or applying the ISBN deduplication"
+        print(error_str)
+        logger.exception(error_str)
+        return 0, 0
+    finally:
+        dest_conn.close()
+    return isbns_deduped, isbns_errored
+
+
+def deduplicate_isbn_component(isbns):
+    # No other worker touches the books claiming these isbns, so they
+    # can be deduplicated in order without locking anything
+    for isbn in isbns:
+        logger.info(isbn)
+
+        if cfg.PROGRESS_BAR:
+            with i.get_lock():
+                i.value += 1
+                if i.value % two_percent_increment == 0:
+                    print("#", end="", flush=True)
+
+        try:
+            dest_conn = get_dest_conn()
+            with dest_conn:
+                with dest_conn.cursor() as dest_cur:
+                    deduplicate_isbn(isbn, dest_cur)
+        except Exception as e:
+            logger.exception(f"\n{isbn}\tFailed to dedulpicate")
+            if is_connection_error(e):
+                reset_dest_conn()
+            with isbns_errored.get_lock():
+                isbns_errored.value += 1
+        else:
+            with isbns_deduped.get_lock():
+                isbns_deduped.value += 1
+
+
+def get_pool_size():
+    if cfg.N_PROC > 0:
+        return cfg.N_PROC
+    elif cfg.N_PROC < -1:
+        return cpu_count() + cfg.N_PROC + 1
+    else:
+        return cpu_count()
+
+
+# TODO: make this configurable script parameter
+my_lang = cfg.ENGLISH
+
+
+#       MIGRATION STAGES
+# Each stage can be run again on its own against the tables the stages
+# before it left behind. Workers read the module globals that a stage
+# sets before its pool is forked.
+
+
+def load_source_snapshot():
+    # Load the snapshot before any pool is forked, so that the workers
+    # share it
+    load_snapshot(find_snapshot())
+
+
+def extract_stage():
+    if not cfg.SOURCE_SNAPSHOT:
+        print("The source is read from MySQL. Nothing to extract.")
+        return
+    snapshot_path = find_snapshot()
+    if snapshot_complete(snapshot_path):
+        print(f"Using the existing snapshot at {snapshot_path}")
+        return
+    start = datetime.now()
+    print(f"Taking a snapshot of the source at {snapshot_path}...")
+    print(f"Start time: {start}")
+    extract_snapshot(snapshot_path)
+    end = datetime.now()
+    print(f"Total time: {end - start}\n")
+
+
+def setup_stage():
+    if cfg.SOURCE_SNAPSHOT:
+        load_source_snapshot()
+        language_dict = get_language_dict(None)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            source_cur = source_conn.cursor()
+            language_dict = get_language_dict(source_cur)
+        finally:
+            source_conn.close()
+
+    # Try to delete and the table (with user interaction)
+    # and create them again from scratch
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    dest_conn.autocommit = True
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                if cfg.CREATE_SEARCH_INDEXES:
+                    success = setup_custom_stop_words()
+                    if not success:
+                        sys.exit(1)
+                if building_schema():
+                    # A full run builds into an empty schema of its own,
+                    # where there's nothing to drop
+                    create_build_schema(run_id, dest_cur)
+                else:
+                    if cfg.SCHEMA_BUILDS:
+                        create_schema(cfg.DEST_SCHEMA, dest_cur)
+                    try:
+                        success = safe_drop_tables(
+                            [
+                                "isbns",
+                                "contents",
+                                "translations",
+                                "more_images",
+                                "books",
+                                "words",
+                                "title_fingerprints",
+                                "raw_isbns",
+                                "merged_books",
+                                "isfdb_title_tsc",
+                                "isfdb_title_dict",
+                                "ttype",
+                            ],
+                            dest_cur,
+                        )
+                    except psycopg2.errors.DependentObjectsStillExist:
+                        pass
+                    finally:
+                        if not success:
+                            sys.exit(1)
+                if cfg.CREATE_SEARCH_INDEXES:
+                    language_used = create_custom_text_search_config(
+                        language_dict[my_lang], dest_cur
+                    )
+                    if language_used == "simple":
+                        warning_str = (
+                            "The specified language isn't doesn't have a "
+                            "snowball stemmer. Using simple configuration "
+                            "instead. Stemming isn't available for title "
+                            "search vectors"
+                        )
+                        print(warning_str)
+                        logger.warning(warning_str)
+                    # A generated general_search needs immutable_unaccent
+                    create_search_extensions(dest_cur)
+                try:
+                    create_ttype_enum(dest_cur)
+                except psycopg2.errors.DuplicateObject:
+                    pass
+                prepare_books_tables(dest_cur)
+    except:
+        print(
+            "Problem with stop word file, "
+            + " or with deleting or creating the tables."
+        )
+        print("Exiting migration script.")
+        logger.exception("exception")
+        sys.exit(1)
+    finally:
+        dest_conn.close()
+
+
+def start_progress_bar(total, unit):
+    global i, two_percent_increment
+    i = Value("i", 0)
+    two_percent_increment = max(1, ceil(total / 50))
+    print(f"\n# = {two_percent_increment} {unit} processed")
+    print("1%[" + "    ." * 10 + "]100%")
+    print("  [", end="", flush=True)
+
+
+# Look up what the title workers need from the source before they are
+# forked, and reset their counters. The workers of a snapshot always
+# get the series and translation groups, since they can't query them.
+def prepare_title_workers(source_cur):
+    global language_dict, series_dict, translation_groups
+    global titles_added, titles_skipped, titles_errored
+
+    language_dict = get_language_dict(source_cur)
+    if cfg.BULK_EXTRACTION or cfg.SOURCE_SNAPSHOT:
+        # Workers resolve series hierarchies from this copy of the
+        # series table instead of querying it for each title
+        series_dict = get_series_dict(source_cur)
+    else:
+        series_dict = None
+    if cfg.PREFILTER_TITLES or cfg.SOURCE_SNAPSHOT:
+        # get_all_titles only returns the preferred translation of
+        # each work. Workers get the rest of the work's translations
+        # from here.
+        translation_groups = get_translation_groups(source_cur)
+    else:
+        translation_groups = None
+    titles_added = Value("i", 0)
+    titles_skipped = Value("i", 0)
+    titles_errored = Value("i", 0)
+
+
+def titles_stage():
+    start = datetime.now()
+    if cfg.SOURCE_SNAPSHOT:
+        # The snapshot's titles are found in memory, so there's nothing
+        # to gain from streaming them
+        load_source_snapshot()
+        prepare_title_workers(None)
+        titles = get_all_titles(None, limit=cfg.LIMIT)
+        title_count = len(titles)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            source_cur = source_conn.cursor()
+            prepare_title_workers(source_cur)
+            print("Main ISFDB title table query...")
+            # Streamed titles are read once the workers have started
+            titles = None
+            if not cfg.STREAM_TITLES:
+                titles = get_all_titles(source_cur, limit=cfg.LIMIT)
+                title_count = len(titles)
+            elif cfg.PROGRESS_BAR:
+                title_count = count_all_titles(source_cur, limit=cfg.LIMIT)
+            else:
+                title_count = None
+        finally:
+            source_conn.close()
+
+    # Start from empty tables, in case an earlier attempt loaded some
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                dest_cur.execute(
+                    """
+                    TRUNCATE books, isbns, translations, more_images,
+                        contents, raw_isbns, merged_books
+                    RESTART IDENTITY;
+                    """
+                )
+    finally:
+        dest_conn.close()
+
+    pool_size = get_pool_size()
+
+    #       MAIN TITLE PROCESSING LOOP
+    print("\nMain title loop...")
+    if title_count is None:
+        print("Processing titles as they are read")
+    else:
+        print(f"Processing {title_count} titles")
+    print(f"Start time: {datetime.now()}")
+    if cfg.PROGRESS_BAR:
+        start_progress_bar(title_count, "titles")
+
+    # Process titles in parallel, in batches that are loaded together.
+    # Each worker keeps its own connections open for the whole loop
+    # rather than reconnecting for every title.
+    queue_depths = None
+    if cfg.WORK_QUEUE:
+        run_title_queue(titles)
+    elif cfg.ASYNC_TITLES:
+        run_async_title_loop(titles)
+    elif cfg.PIPELINE:
+        queue_depths = run_title_pipeline(titles)
+    else:
+        run_title_pool(titles, pool_size)
+
+    if cfg.PROGRESS_BAR:
+        print("]")
+
+    end = datetime.now()
     total_time = end - start
     print(f"\nTitles added: {titles_added.value}")
     print(f"Titles skipped: {titles_skipped.value}")
     print(f"Titles errored: {titles_errored.value}")
+    print(f"Connections opened: {connections_opened.value}")
+    if queue_depths is not None:
+        report_queue_depths(queue_depths)
     print(f"Total time: {total_time}\n")
 
-    #       POPULATE CONTENTS TABLE
-    start = datetime.now()
-    print("Populating contents table...")
-    print(f"Start time: {start}")
-    volumes = get_books_for_contents()
 
-    # populate books contents in parallel
-    with Pool(pool_size) as p:
-        p.map(populate_contents_for_volume, volumes)
+def run_title_pool(titles, pool_size):
+    if titles is not None:
+        with Pool(
+            pool_size, initializer=init_worker, initargs=(connections_opened,)
+        ) as p:
+            p.map(
+                process_title_batch, split_title_batches(titles), chunksize=1
+            )
+        return
+
+    # imap_unordered reads its input as fast as it can, so only let a
+    # couple of batches per worker be read ahead
+    read_ahead = pool_size * 2
+    batch_slots = Semaphore(read_ahead)
+    stop_reading = Event()
+    source_conn = None
+    try:
+        with Pool(
+            pool_size, initializer=init_worker, initargs=(connections_opened,)
+        ) as p:
+            # Connect after the workers are forked, so they don't inherit
+            # the connection that is streaming the titles
+            source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+            title_batches = throttle(
+                stream_all_titles(
+                    source_conn, cfg.LOAD_BATCH_SIZE, limit=cfg.LIMIT
+                ),
+                batch_slots,
+                stop_reading,
+            )
+            try:
+                for _ in p.imap_unordered(process_title_batch, title_batches):
+                    batch_slots.release()
+            finally:
+                # If a batch raised or the run was interrupted, the pool's
+                # task handler may be waiting for a slot, and the pool
+                # can't shut down until it stops reading the titles
+                stop_reading.set()
+                batch_slots.release(read_ahead)
+    finally:
+        # The task handler reads from the connection until the pool is
+        # shut down
+        if source_conn is not None:
+            source_conn.close()
+
+
+def contents_stage():
+    global book_types, contents_added, content_ranges_errored
+
+    #       POPULATE CONTENTS TABLE
+    start = datetime.now()
+    print("Populating contents table...")
+    print(f"Start time: {start}")
+    if cfg.SOURCE_SNAPSHOT:
+        load_source_snapshot()
+    # Workers check the contents they find against the loaded books
+    book_types = get_book_types()
+    if book_types is False:
+        raise Exception("Couldn't get the loaded books")
+    contents_added = Value("i", 0)
+    content_ranges_errored = Value("i", 0)
+
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                dest_cur.execute("TRUNCATE contents RESTART IDENTITY;")
+    finally:
+        dest_conn.close()
+
+    # Each worker finds the contents of a range of books with one query,
+    # and loads them with COPY
+    pool_size = get_pool_size()
+    if book_types:
+        with Pool(
+            pool_size,
+            initializer=init_worker,
+            initargs=(connections_opened,),
+        ) as p:
+            p.map(
+                populate_contents_range,
+                get_contents_ranges(book_types, pool_size * 8),
+                chunksize=1,
+            )
+    book_types = None
+
+    end = datetime.now()
+    total_time = end - start
+    print(f"Contents added: {contents_added.value}")
+    print(f"Book ranges errored: {content_ranges_errored.value}")
+    print(f"Total time: {total_time}\n")
+
+
+def constraints_stage():
+    # With unlogged_load, the tables are loaded without their foreign
+    # keys and most of their unique constraints, which are only added
+    # now. Each is checked against the whole table at once, instead of
+    # row by row as the rows were loaded.
+    if not cfg.UNLOGGED_LOAD:
+        return
+    start = datetime.now()
+    print("Adding the constraints of the book tables...")
+    print(f"Start time: {start}")
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                add_deferred_constraints(dest_cur)
+    finally:
+        dest_conn.close()
+    end = datetime.now()
+    print(f"Total time: {end - start}\n")
+
+
+def search_columns_stage():
+    global search_ranges_errored
+
+    if not cfg.CREATE_SEARCH_INDEXES:
+        return
+    if general_search_generated():
+        print("Search vectors were computed as the books were loaded")
+        return
+    start = datetime.now()
+    print("Populating search vector columns...")
+    print(f"Start time: {start}")
+    pool_size = get_pool_size()
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                id_ranges = get_title_id_ranges(pool_size * 4, dest_cur)
+    finally:
+        dest_conn.close()
+
+    # Each worker updates a range of books in its own transaction, so
+    # the vectors are computed on pool_size backends at once
+    search_ranges_errored = Value("i", 0)
+    with Pool(
+        pool_size, initializer=init_worker, initargs=(connections_opened,)
+    ) as p:
+        p.map(populate_search_range, id_ranges, chunksize=1)
+
+    end = datetime.now()
+    print(f"Book ranges errored: {search_ranges_errored.value}")
+    print(f"Total time: {end - start}\n")
+
+    # The books of a failed range would be left without a search vector
+    if search_ranges_errored.value > 0:
+        raise Exception(
+            f"Couldn't populate {search_ranges_errored.value} ranges of "
+            + "search vectors"
+        )
+
+
+def populate_search_range(id_range):
+    try:
+        dest_conn = get_dest_conn()
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                update_general_search(dest_cur, id_range=id_range)
+    except Exception as e:
+        logger.exception(
+            f"\n{id_range[0]}-{id_range[1]}\tDestination db error in "
+            "populate_search_range"
+        )
+        if is_connection_error(e):
+            reset_dest_conn()
+        with search_ranges_errored.get_lock():
+            search_ranges_errored.value += 1
+
+
+def search_indexes_stage():
+    if not cfg.CREATE_SEARCH_INDEXES:
+        return
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                create_search_extensions(dest_cur)
+    finally:
+        dest_conn.close()
+    print("Creating search indexes...")
+    build_indexes(SEARCH_INDEXES)
+
+
+def words_stage():
+    if not cfg.CREATE_SEARCH_INDEXES:
+        return
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                print("Creating words table...")
+                create_words_table(dest_cur)
+    finally:
+        dest_conn.close()
+
+
+def indexes_stage():
+    print("Creating Indexes...")
+    build_indexes(BOOK_TABLE_INDEXES)
+
+
+def build_indexes(indexes):
+    # Build the indexes on index_connections connections at once. Each
+    # build is timed, and the time and size of every index are reported.
+    start = datetime.now()
+    with Pool(
+        min(cfg.INDEX_CONNECTIONS, len(indexes)),
+        initializer=init_worker,
+        initargs=(connections_opened,),
+    ) as p:
+        results = p.map(build_index, indexes, chunksize=1)
+    end = datetime.now()
+
+    # Slowest first
+    print("Index build times and sizes:")
+    for name, build_time, size in sorted(
+        results, key=lambda result: result[1] or timedelta.max, reverse=True
+    ):
+        if build_time is None:
+            index_str = f"  {name}: failed"
+        else:
+            index_str = f"  {name}: {build_time}, {size / 2**20:.1f} MB"
+        print(index_str)
+        logger.info(index_str)
+    print(f"Total time: {end - start}\n")
+
+    failed = [name for name, build_time, _ in results if build_time is None]
+    if failed:
+        raise Exception("Couldn't build these indexes: " + ", ".join(failed))
+
+
+def build_index(index):
+    # Returns (name, build time, size in bytes), with None for the time
+    # and size if the build failed
+    name, definition = index
+    try:
+        dest_conn = get_dest_conn()
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                set_index_build_settings(dest_cur)
+                start = datetime.now()
+                create_index(name, definition, dest_cur)
+        build_time = datetime.now() - start
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                size = get_index_size(name, dest_cur)
+    except Exception as e:
+        logger.exception(f"\n{name}\tIndex build error")
+        if is_connection_error(e):
+            reset_dest_conn()
+        return name, None, None
+    return name, build_time, size
+
 
-    end = datetime.now()
-    total_time = end - start
-    print(f"Total time: {total_time}\n")
+def isbns_stage():
+    global isbns_deduped, isbns_errored
 
-    #       INDEX TABLES
     dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
     try:
         with dest_conn:
             with dest_conn.cursor() as dest_cur:
-                if cfg.CREATE_SEARCH_INDEXES:
-                    start = datetime.now()
-                    print("Populating search vector columns...")
-                    populate_search_columns(dest_cur)
-                    end = datetime.now()
-                    total_time = end - start
-                    print(f"Total time: {total_time}\n")
-                print("Creating Indexes...")
-                index_book_tables(dest_cur)
-
                 print("\nAdding ISBN 10 and 13 entries where they are missing")
                 start = datetime.now()
                 print(f"Start time: {start}")
                 isbn_tuples = get_all_isbn_tuples(dest_cur)
-    except:
-        error_str = "Problem indexing or getting ISBNs"
-        print(error_str)
-        logger.exception(error_str)
     finally:
         dest_conn.close()
 
-    #       MAIN ISBN 10 - 13 LOOP
-    isbns_processed = Value("i", 0)
-    isbns_errored = Value("i", 0)
+    #       ISBN 10 - 13 CONVERSION
     print(f"Processing {len(isbn_tuples)} isbns")
-    if cfg.PROGRESS_BAR:
-        i = Value("i", 0)
-        two_percent_increment = ceil(len(isbn_tuples) / 50)
-        print(f"\n# = {two_percent_increment} isbns processed")
-        print("1%[" + "    ." * 10 + "]100%")
-        print("  [", end="", flush=True)
-
-    # Process isbns in parallel
-    with Pool(pool_size) as p:
-        p.map(create_isbn_10_and_13, isbn_tuples)
-
-    if cfg.PROGRESS_BAR:
-        print("]")
+    (
+        new_isbn_rows,
+        isbns_processed,
+        isbns_errored,
+        isbns_bad_check_digit,
+    ) = convert_isbn_tuples(isbn_tuples)
+    if not cfg.PLAN_ISBN_DEDUPLICATION:
+        if not create_isbn_10_and_13(new_isbn_rows):
+            isbns_processed, isbns_errored = 0, len(isbn_tuples)
 
     end = datetime.now()
     total_time = end - start
-    print(f"\nisbns processed: {isbns_processed.value}")
-    print(f"isbns errored: {isbns_errored.value}")
+    print(f"\nisbns processed: {isbns_processed}")
+    print(f"isbns errored: {isbns_errored}")
+    print(f"isbns with an invalid check digit: {isbns_bad_check_digit}")
     print(f"Total time: {total_time}\n")
 
-    #       ISBN DEDUPLICATION
-    print("Depulicating ISBNs...")
-    start = datetime.now()
-    print(f"Start time: {start}")
-
+    # Delta runs need the isbns as they were before deduplication
     dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
     try:
         with dest_conn:
             with dest_conn.cursor() as dest_cur:
-                insert_virtual_books(dest_cur)
-                duplicate_isbns = get_duplicate_isbns(dest_cur)
-    except:
-        error_str = "Problem getting duplicate ISBNs"
-        print(error_str)
-        logger.exception(error_str)
+                record_raw_isbns(isbn_tuples + new_isbn_rows, dest_cur)
     finally:
         dest_conn.close()
 
-    isbns_deduped = Value("i", 0)
-    isbns_errored = Value("i", 0)
+    #       ISBN DEDUPLICATION
+    print("Depulicating ISBNs...")
+    start = datetime.now()
+    print(f"Start time: {start}")
 
-    print("\nMain isbn deduplication loop...")
-    print(f"Processing {len(duplicate_isbns)} isbns")
-    if cfg.PROGRESS_BAR:
-        i = Value("i", 0)
-        two_percent_increment = ceil(len(duplicate_isbns) / 50)
-        print(f"\n# = {two_percent_increment} isbns processed")
-        print("1%[" + "    ." * 10 + "]100%")
-        print("  [", end="", flush=True)
+    if cfg.PLAN_ISBN_DEDUPLICATION:
+        isbns_deduped, isbns_errored = deduplicate_isbns_in_memory(
+            isbn_tuples + new_isbn_rows
+        )
+    else:
+        dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+        try:
+            with dest_conn:
+                with dest_conn.cursor() as dest_cur:
+                    insert_virtual_books(dest_cur)
+                    duplicate_isbn_components = (
+                        get_duplicate_isbn_components(dest_cur)
+                    )
+        finally:
+            dest_conn.close()
 
-    # Process isbns in parallel
-    with Pool(pool_size) as p:
-        p.map(deduplicate_isbn, duplicate_isbns)
+        isbns_deduped = Value("i", 0)
+        isbns_errored = Value("i", 0)
 
-    if cfg.PROGRESS_BAR:
-        print("]")
+        print("\nMain isbn deduplication loop...")
+        duplicate_isbn_count = sum(map(len, duplicate_isbn_components))
+        print(
+            f"Processing {duplicate_isbn_count} isbns "
+            f"in {len(duplicate_isbn_components)} independent groups"
+        )
+        if cfg.PROGRESS_BAR:
+            start_progress_bar(duplicate_isbn_count, "isbns")
+
+        # Process groups of isbns in parallel, each group in one worker
+        with Pool(
+            get_pool_size(),
+            initializer=init_worker,
+            initargs=(connections_opened,),
+        ) as p:
+            p.map(
+                deduplicate_isbn_component,
+                duplicate_isbn_components,
+                chunksize=1,
+            )
+
+        if cfg.PROGRESS_BAR:
+            print("]")
+
+        isbns_deduped = isbns_deduped.value
+        isbns_errored = isbns_errored.value
 
     end = datetime.now()
     total_time = end - start
-    print(f"\nisbns depulicated: {isbns_deduped.value}")
-    print(f"isbns errored: {isbns_errored.value}")
+    print(f"\nisbns depulicated: {isbns_deduped}")
+    print(f"isbns errored: {isbns_errored}")
     print(f"Total time: {total_time}\n")
 
+
+def finalize_stage():
     #      FINAL DATABASE OPERATIONS
     dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
     dest_conn.autocommit = True
@@ -851,13 +1955,54 @@ if __name__ == "__main__":
         dest_cur = dest_conn.cursor()
         print("Constraining, Vacuuming, and Analyzing the database...")
         constrain_vacuum_analyze(dest_cur)
-    except:
-        error_str = "Problem constraining ISBN table, Vacuuming or Analyzing."
-        print(error_str)
-        logger.exception(error_str)
     finally:
         dest_conn.close()
 
+
+def swap_stage():
+    # With schema_builds, make the new build the serving schema, and
+    # drop the builds that are no longer kept for rollback
+    if not building_schema():
+        return
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                if get_serving_build(dest_cur) != run_id:
+                    print(f"Switching {cfg.SERVING_SCHEMA} to run {run_id}...")
+                    switch_build(run_id, dest_cur)
+                old_run_ids = get_old_builds(cfg.KEEP_BUILDS, run_id, dest_cur)
+        for old_run_id in old_run_ids:
+            with dest_conn:
+                with dest_conn.cursor() as dest_cur:
+                    print(f"Dropping the build of run {old_run_id}...")
+                    drop_build(old_run_id, dest_cur)
+    finally:
+        dest_conn.close()
+
+
+def rollback_build():
+    # --rollback: make the build that served before the current one the
+    # serving schema again
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                serving_run_id = get_serving_build(dest_cur)
+                previous_run_id = get_previous_build(dest_cur)
+                if previous_run_id is None:
+                    print("There is no earlier build to roll back to.")
+                    sys.exit(1)
+                print(
+                    f"Switching {cfg.SERVING_SCHEMA} from run "
+                    + f"{serving_run_id} back to run {previous_run_id}..."
+                )
+                switch_build(previous_run_id, dest_cur)
+    finally:
+        dest_conn.close()
+
+
+def export_stage():
     logger.info(f"Migration complete. Exporting to /tmp/{cfg.DEST_DB_NAME}...")
     sp = subprocess.Popen(["rm", "-rf", f"/tmp/{cfg.DEST_DB_NAME}"])
     sp.wait()
@@ -866,13 +2011,767 @@ if __name__ == "__main__":
         f"{cfg.DEST_DB_NAME}",
         f"--file=/tmp/{cfg.DEST_DB_NAME}",
         "--format=directory",
-        f"--jobs={pool_size}",
+        f"--jobs={get_pool_size()}",
         f"--port={cfg.DEST_DB_PORT}",
         f"--username={cfg.DEST_DB_USER}",
+        # Leave out the bookkeeping tables of the migration itself
+        "--exclude-table=migration_stages",
+        "--exclude-table=title_fingerprints",
+        "--exclude-table=raw_isbns",
+        "--exclude-table=merged_books",
+        "--exclude-table=title_batches",
+        "--exclude-table=title_queues",
     ]
+    if cfg.SCHEMA_BUILDS:
+        # Only the serving build
+        pg_dump_cmd.append(f"--exclude-schema={build_schema_name('*')}")
     sp = subprocess.Popen(pg_dump_cmd)
     return_code = sp.wait()
     if return_code != 0:
-        print(f"There was an error dumping {cfg.DEST_DB_NAME}")
+        raise Exception(f"There was an error dumping {cfg.DEST_DB_NAME}")
+    print("SUCCESS")
+
+
+def fingerprints_stage():
+    # Fingerprint the source the tables are built from, so that a later
+    # delta run can tell which titles changed
+    print("Fingerprinting source titles...")
+    if cfg.SOURCE_SNAPSHOT:
+        load_source_snapshot()
+        fingerprints = get_title_fingerprints(None)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            source_cur = source_conn.cursor(buffered=True)
+            fingerprints = get_title_fingerprints(source_cur)
+        finally:
+            source_conn.close()
+
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                store_title_fingerprints(fingerprints, dest_cur)
+    finally:
+        dest_conn.close()
+    print(f"Titles fingerprinted: {len(fingerprints)}")
+
+
+#       DELTA RUNS
+# A delta run rebuilds the books of the works with changed titles, along
+# with every book whose ISBN deduplication depends on them, and applies
+# the result to the tables of the last run in a single transaction.
+
+
+def rebuild_works(root_ids):
+    # The rows of the books built from these works' titles
+    if cfg.SOURCE_SNAPSHOT:
+        titles = get_titles_for_roots(root_ids, None)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            source_cur = source_conn.cursor()
+            titles = get_titles_for_roots(root_ids, source_cur)
+        finally:
+            source_conn.close()
+
+    title_batches = split_title_batches(titles)
+    if cfg.PROGRESS_BAR:
+        start_progress_bar(len(titles), "titles")
+    with Pool(
+        get_pool_size(),
+        initializer=init_worker,
+        initargs=(connections_opened,),
+    ) as p:
+        batch_rows = p.map(build_title_batch, title_batches, chunksize=1)
+    if cfg.PROGRESS_BAR:
+        print("]")
+    return [rows for title_rows in batch_rows for _, rows in title_rows]
+
+
+def find_delta_books(root_ids, work_titles, fingerprints, old_book_ids):
+    # Rebuild the works in root_ids, and then the works of any book
+    # sharing an isbn with a rebuilt book, old or new, until no more
+    # are found. Returns the rows of the rebuilt books, the title_ids
+    # of every book they replace or add, and the isbns those books had
+    # or have now. Connections are only opened between the pools, so
+    # their workers don't inherit any.
+    book_rows = []
+    book_ids = set()
+    isbns = set()
+    done_root_ids = set()
+    while root_ids:
+        print(f"Rebuilding {len(root_ids)} works...")
+        new_rows = rebuild_works(root_ids)
+        book_rows.extend(new_rows)
+        done_root_ids |= root_ids
+
+        new_book_ids = {rows[0][0] for rows in new_rows}
+        for root_id in root_ids:
+            new_book_ids |= work_titles.get(root_id, set()) & old_book_ids
+        book_ids |= new_book_ids
+
+        new_isbns = {row[0] for rows in new_rows for row in rows[1]}
+        counterparts, _, _ = convert_isbns(sorted(new_isbns))
+        new_isbns |= {isbn for isbn in counterparts if isbn}
+        dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+        try:
+            with dest_conn:
+                with dest_conn.cursor() as dest_cur:
+                    new_isbns |= {
+                        row[0] for row in get_raw_isbns(new_book_ids, dest_cur)
+                    }
+                    claimants = get_raw_claimants(new_isbns, dest_cur)
+        finally:
+            dest_conn.close()
+        isbns |= new_isbns
+
+        root_ids = (
+            get_work_roots(claimants - book_ids, *fingerprints) - done_root_ids
+        )
+    return book_rows, book_ids, isbns
+
+
+def delta_stage():
+    start = datetime.now()
+    print("Comparing the source with the last run...")
+    print(f"Start time: {start}")
+    if cfg.SOURCE_SNAPSHOT:
+        load_source_snapshot()
+        prepare_title_workers(None)
+        new_fingerprints = get_title_fingerprints(None)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            source_cur = source_conn.cursor(buffered=True)
+            prepare_title_workers(source_cur)
+            new_fingerprints = get_title_fingerprints(source_cur)
+        finally:
+            source_conn.close()
+
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                old_fingerprints = get_stored_fingerprints(dest_cur)
+                # Books merged into others are replaced like any other
+                dest_cur.execute(
+                    """
+                    SELECT title_id
+                    FROM books
+                    UNION
+                    SELECT loser_id
+                    FROM merged_books;
+                    """
+                )
+                old_book_ids = {row[0] for row in dest_cur.fetchall()}
+    finally:
+        dest_conn.close()
+    if not old_fingerprints:
+        raise Exception(
+            "There are no fingerprints from an earlier run to compare "
+            + "with. Run a full migration first."
+        )
+
+    fingerprints = (old_fingerprints, new_fingerprints)
+    changed_ids = find_changed_titles(*fingerprints)
+    print(f"Titles changed: {len(changed_ids)}")
+    book_rows, book_ids, isbns = find_delta_books(
+        get_work_roots(changed_ids, *fingerprints),
+        index_work_titles(*fingerprints),
+        fingerprints,
+        old_book_ids,
+    )
+    print(f"Books to replace: {len(book_ids)}")
+
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    if cfg.SOURCE_SNAPSHOT:
+        source_conn = source_cur = None
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+    try:
+        if source_conn is not None:
+            source_cur = source_conn.cursor(buffered=True)
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                # Books listing any of these books among their contents
+                # have to be worked out again after they are replaced
+                containers = get_dest_containers(
+                    book_ids | changed_ids, dest_cur
+                )
+                containers |= get_source_containers(
+                    book_ids | changed_ids, source_cur
+                )
+
+                #       REPLACE THE BOOKS
+                # The unique isbn constraint is added back by finalize
+                dest_cur.execute(
+                    """
+                    ALTER TABLE isbns
+                    DROP CONSTRAINT IF EXISTS injective_isbn_to_title_id;
+                    """
+                )
+                dest_cur.execute(
+                    """
+                    DELETE FROM books
+                    WHERE title_id = ANY(%s);
+                    DELETE FROM isbns
+                    WHERE title_id = %s
+                    AND isbn = ANY(%s);
+                    DELETE FROM raw_isbns
+                    WHERE title_id = ANY(%s);
+                    DELETE FROM merged_books
+                    WHERE loser_id = ANY(%s)
+                    OR winner_id = ANY(%s);
+                    """,
+                    (
+                        sorted(book_ids),
+                        cfg.INCONSISTENT_ISBN_VIRTUAL_TITLE,
+                        sorted(isbns),
+                        sorted(book_ids),
+                        sorted(book_ids),
+                        sorted(book_ids),
+                    ),
+                )
+                books_errored = load_book_rows(book_rows, dest_cur)
+                print(f"Books rebuilt: {len(book_rows) - books_errored}")
+                print(f"Books errored: {books_errored}")
+
+                #       ISBNS
+                # Convert and deduplicate the replaced books' isbns the
+                # way the isbns stage does. No other book claims them.
+                dest_cur.execute(
+                    """
+                    SELECT isbn, title_id, book_type, foreign_lang
+                    FROM isbns
+                    WHERE title_id = ANY(%s);
+                    """,
+                    (sorted(book_ids),),
+                )
+                isbn_tuples = dest_cur.fetchall()
+                new_isbn_rows, _, isbns_errored, _ = convert_isbn_tuples(
+                    isbn_tuples
+                )
+                isbn_rows = isbn_tuples + new_isbn_rows
+                copy_rows("raw_isbns", ISBN_COLUMNS, isbn_rows, dest_cur)
+                dest_cur.execute(
+                    """
+                    DELETE FROM isbns
+                    WHERE title_id = ANY(%s);
+                    """,
+                    (sorted(book_ids),),
+                )
+                insert_virtual_books(dest_cur)
+                (
+                    plan,
+                    final_isbn_rows,
+                    isbns_deduped,
+                    dedup_errored,
+                ) = plan_isbn_deduplication(
+                    isbn_rows, get_claimant_books(isbn_rows, dest_cur)
+                )
+                apply_isbn_deduplication_plan(
+                    plan, final_isbn_rows, dest_cur, replace_isbns=False
+                )
+                print(f"isbns errored: {isbns_errored}")
+                print(f"isbns depulicated: {isbns_deduped}")
+                print(f"isbns errored in deduplication: {dedup_errored}")
+
+                #       CONTENTS
+                merged_books = get_merged_books(dest_cur)
+                dest_cur.execute(
+                    """
+                    SELECT title_id
+                    FROM books
+                    WHERE title_id = ANY(%s);
+                    """,
+                    (
+                        sorted(
+                            {
+                                merged_books.get(title_id, title_id)
+                                for title_id in book_ids | containers
+                            }
+                        ),
+                    ),
+                )
+                contents_book_ids = {row[0] for row in dest_cur.fetchall()}
+                contents = get_book_contents(
+                    contents_book_ids,
+                    merged_books,
+                    get_premerge_book_types(merged_books, dest_cur),
+                    source_cur,
+                )
+                dest_cur.execute(
+                    """
+                    DELETE FROM contents
+                    WHERE book_title_id = ANY(%s);
+                    """,
+                    (sorted(contents_book_ids),),
+                )
+                copy_rows("contents", CONTENTS_COLUMNS, contents, dest_cur)
+                print(
+                    f"Contents of {len(contents_book_ids)} books replaced: "
+                    + f"{len(contents)} rows"
+                )
+
+                #       SEARCH COLUMNS
+                if cfg.CREATE_SEARCH_INDEXES:
+                    update_general_search(dest_cur, book_ids)
+                    create_words_table(dest_cur)
+
+                store_title_fingerprints(new_fingerprints, dest_cur)
+    finally:
+        if source_conn is not None:
+            source_conn.close()
+        dest_conn.close()
+
+    end = datetime.now()
+    print(f"Connections opened: {connections_opened.value}")
+    print(f"Total time: {end - start}\n")
+
+
+STAGES = {
+    "extract": extract_stage,
+    "setup": setup_stage,
+    "fingerprints": fingerprints_stage,
+    "titles": titles_stage,
+    "contents": contents_stage,
+    "constraints": constraints_stage,
+    "search_columns": search_columns_stage,
+    "search_indexes": search_indexes_stage,
+    "words": words_stage,
+    "indexes": indexes_stage,
+    "isbns": isbns_stage,
+    "delta": delta_stage,
+    "finalize": finalize_stage,
+    "swap": swap_stage,
+    "export": export_stage,
+}
+FULL_RUN = [
+    "extract",
+    "setup",
+    "fingerprints",
+    "titles",
+    "contents",
+    "constraints",
+    "search_columns",
+    "search_indexes",
+    "words",
+    "indexes",
+    "isbns",
+    "finalize",
+    "swap",
+    "export",
+]
+DELTA_RUN = ["extract", "delta", "finalize", "export"]
+
+# The tables each stage reads and writes, as (reads, writes), which the
+# stages are scheduled by with parallel_stages. See
+# stage_graph_functions. "source" is the source database or snapshot. A
+# column gets its own entry, so the stages that don't read it can run
+# while it's written. Building an index locks out writes to its table,
+# so the index stages read every column of their tables.
+STAGE_TABLES = {
+    "extract": (set(), {"source"}),
+    "setup": (set(), {"*"}),
+    "fingerprints": ({"source"}, {"title_fingerprints"}),
+    "titles": (
+        {"source"},
+        {
+            "books",
+            "isbns",
+            "translations",
+            "more_images",
+            "contents",
+            "raw_isbns",
+            "merged_books",
+            "title_batches",
+            "title_queues",
+        },
+    ),
+    "contents": ({"source", "books"}, {"contents"}),
+    "constraints": (
+        {
+            "books",
+            "books.general_search",
+            "isbns",
+            "translations",
+            "contents",
+            "more_images",
+        },
+        set(),
+    ),
+    "search_columns": ({"books"}, {"books.general_search"}),
+    "search_indexes": ({"books", "books.general_search"}, set()),
+    "words": ({"books"}, {"words"}),
+    "indexes": (
+        {
+            "books",
+            "books.general_search",
+            "isbns",
+            "translations",
+            "contents",
+            "more_images",
+        },
+        set(),
+    ),
+    "isbns": (
+        {"books", "isbns", "contents"},
+        {
+            "books",
+            "isbns",
+            "translations",
+            "more_images",
+            "contents",
+            "raw_isbns",
+            "merged_books",
+        },
+    ),
+    "delta": (set(), {"*"}),
+    "finalize": (set(), {"*"}),
+    "swap": (set(), {"*"}),
+    "export": ({"*"}, set()),
+}
+
+
+def run_parameters():
+    # The configuration recorded with each stage
+    return {
+        "limit": cfg.LIMIT,
+        "n_proc": cfg.N_PROC,
+        "my_lang": cfg.MY_LANG,
+        "load_batch_size": cfg.LOAD_BATCH_SIZE,
+        "bulk_extraction": cfg.BULK_EXTRACTION,
+        "prefilter_titles": cfg.PREFILTER_TITLES,
+        "stream_titles": cfg.STREAM_TITLES,
+        "plan_isbn_deduplication": cfg.PLAN_ISBN_DEDUPLICATION,
+        "create_search_indexes": cfg.CREATE_SEARCH_INDEXES,
+        "source_snapshot": cfg.SOURCE_SNAPSHOT,
+        "search_vector_at_load": cfg.SEARCH_VECTOR_AT_LOAD,
+        "unlogged_load": cfg.UNLOGGED_LOAD,
+        "schema_builds": cfg.SCHEMA_BUILDS,
+    }
+
+
+def use_run_schema(run_id, run_plan, swapped=False):
+    # With schema_builds, a full run builds its tables in a new schema
+    # until its swap stage makes that the serving schema, and every
+    # other run works on the serving schema
+    if not cfg.SCHEMA_BUILDS:
+        return
+    if run_plan == FULL_RUN and not swapped:
+        use_schema(build_schema_name(run_id))
+    else:
+        use_schema(cfg.SERVING_SCHEMA)
+
+
+def report_unlogged_load_savings(run_id):
+    # Compare the stages of this run with the last complete full run
+    # that had the same configuration but loaded the tables with all
+    # their constraints, as they are without unlogged_load
+    parameters = dict(run_parameters(), unlogged_load=False)
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                stage_times = get_stage_times(run_id, dest_cur)
+                other_runs = get_matching_stage_times(
+                    run_id, parameters, dest_cur
+                )
+    finally:
+        dest_conn.close()
+
+    # The stages unlogged_load changes. Runs from before a stage was
+    # added to FULL_RUN don't have a time for it.
+    compared = ["setup", "titles", "contents", "isbns", "finalize"]
+    other_run_id = max(
+        (
+            other_run_id
+            for other_run_id, other_times in other_runs.items()
+            if all(stage in other_times for stage in compared)
+        ),
+        default=None,
+    )
+    if other_run_id is None:
+        print(
+            "There is no complete full run without unlogged_load, but "
+            + "otherwise the same configuration, to compare with"
+        )
+        return
+    other_times = other_runs[other_run_id]
+
+    print(f"\nStage times compared with run {other_run_id}:")
+    time_saved = timedelta()
+    for stage in FULL_RUN:
+        other_time = other_times.get(stage, timedelta())
+        print(f"  {stage}: {stage_times[stage]} (was {other_time})")
+        time_saved += other_time - stage_times[stage]
+    if time_saved >= timedelta():
+        print(f"Time saved by unlogged_load: {time_saved}")
+    else:
+        print(f"Time lost by unlogged_load: {-time_saved}")
+
+
+def run_stages(run_id, stage_names, run_plan):
+    # Record each stage in migration_stages as it runs, along with the
+    # stages the whole run is meant to have. A failed stage ends the
+    # run, so that --resume can pick it up from there.
+    state_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    state_conn.autocommit = True
+    try:
+        state_cur = state_conn.cursor()
+        if cfg.PARALLEL_STAGES:
+            return run_stage_graph(run_id, stage_names, run_plan, state_cur)
+        for stage in stage_names:
+            if not run_stage(run_id, stage, run_plan, state_cur):
+                return False
+    finally:
+        state_conn.close()
+    return True
+
+
+def run_stage(run_id, stage, run_plan, state_cur):
+    print(f"\n[{stage}]")
+    start_stage(
+        run_id, stage, dict(run_parameters(), stages=run_plan), state_cur
+    )
+    try:
+        STAGES[stage]()
+    except BaseException:
+        finish_stage(run_id, stage, "failed", state_cur)
+        report_failed_stage(run_id, stage)
+        logger.exception(f"Stage {stage} of run {run_id} failed")
+        return False
+    finish_stage(run_id, stage, "complete", state_cur)
+    return True
+
+
+def report_failed_stage(run_id, stage):
+    print(f"Stage {stage} of run {run_id} failed")
+    print(f"Resume with: {sys.argv[0]} --resume")
+
+
+def run_stage_graph(run_id, stage_names, run_plan, state_cur):
+    # Start each stage once the stages it depends on have completed, so
+    # that stages that don't depend on each other run at the same time,
+    # each in its own process with its own connections. A stage that
+    # nothing else could run alongside runs in this process, where it
+    # can ask for input. After a stage fails, no more are started.
+    dependencies = stage_dependencies(stage_names, STAGE_TABLES)
+    waiting = list(stage_names)
+    running = {}
+    completed = set()
+    timings = {}
+    failed = False
+    while waiting or running:
+        ready = []
+        if not failed:
+            ready = [
+                stage for stage in waiting if dependencies[stage] <= completed
+            ]
+        if len(ready) == 1 and not running:
+            stage = ready[0]
+            waiting.remove(stage)
+            start = datetime.now()
+            if run_stage(run_id, stage, run_plan, state_cur):
+                completed.add(stage)
+            else:
+                failed = True
+            timings[stage] = (start, datetime.now())
+            continue
+
+        for stage in ready:
+            waiting.remove(stage)
+            print(f"\n[{stage}] starting")
+            start_stage(
+                run_id,
+                stage,
+                dict(run_parameters(), stages=run_plan),
+                state_cur,
+            )
+            process = Process(target=run_stage_process, args=(stage,))
+            process.start()
+            running[process.sentinel] = (stage, process, datetime.now())
+        if not running:
+            break
+
+        for sentinel in wait(list(running)):
+            stage, process, start = running.pop(sentinel)
+            process.join()
+            timings[stage] = (start, datetime.now())
+            if process.exitcode == 0:
+                finish_stage(run_id, stage, "complete", state_cur)
+                completed.add(stage)
+                print(f"\n[{stage}] complete")
+            else:
+                finish_stage(run_id, stage, "failed", state_cur)
+                report_failed_stage(run_id, stage)
+                failed = True
+
+    report_stage_timings(stage_names, dependencies, timings)
+    return not failed
+
+
+def run_stage_process(stage):
+    # Stage process of run_stage_graph. The exit code tells it whether
+    # the stage completed.
+    try:
+        STAGES[stage]()
+    except BaseException:
+        logger.exception(f"Stage {stage} failed")
+        sys.exit(1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Migrate the ISFDB from MySQL to Postgres."
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue the last run from its first incomplete stage",
+    )
+    mode.add_argument(
+        "--stage",
+        choices=FULL_RUN,
+        help="run just this stage against the existing destination tables",
+    )
+    mode.add_argument(
+        "--delta",
+        action="store_true",
+        help="only rebuild the books whose source data changed since the "
+        + "last run",
+    )
+    mode.add_argument(
+        "--rollback",
+        action="store_true",
+        help="switch the serving schema back to the build before it, "
+        + "when it's run with schema_builds",
+    )
+    mode.add_argument(
+        "--worker",
+        action="store_true",
+        help="add workers to the titles stage of a running migration, "
+        + "when it's run with work_queue",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    start = datetime.now()
+    if cfg.DEBUG:
+        logging.basicConfig(level=logging.WARNING)
+    else:
+        log_path = f"/tmp/{str(start).split('.')[0]}.log"
+        logging.basicConfig(filename=log_path, level=logging.INFO)
+    logger = logging.getLogger(__name__)
+    logger.info(f"{start}\tStarting Logging")
+
+    connections_opened = Value("i", 0)
+
+    dest_conn = psycopg2.connect(cfg.DEST_DB_CONN_STRING)
+    try:
+        with dest_conn:
+            with dest_conn.cursor() as dest_cur:
+                create_run_state_table(dest_cur)
+                create_title_batches_table(dest_cur)
+                create_schema_builds_table(dest_cur)
+                last_run = get_last_run(dest_cur)
+                run_id = new_run_id(dest_cur)
+    finally:
+        dest_conn.close()
+
+    if args.worker:
+        # The progress bar of the run is drawn by the run itself
+        cfg.PROGRESS_BAR = False
+        join_title_queue()
+        sys.exit(0)
+
+    if args.rollback:
+        rollback_build()
+        sys.exit(0)
+
+    if last_run is not None:
+        last_run_id, stage_states = last_run
+        # Every stage of a run records the same plan and configuration
+        last_parameters = dict(next(iter(stage_states.values()))[1] or {})
+        last_plan = last_parameters.pop("stages", FULL_RUN)
+        last_run_complete = all(
+            stage_states.get(stage, (None,))[0] == "complete"
+            for stage in last_plan
+        )
+        last_run_swapped = stage_states.get("swap", (None,))[0] == "complete"
+
+    if args.resume:
+        if last_run is None:
+            print("There is no earlier run to resume.")
+            sys.exit(1)
+        if last_run_complete:
+            print(f"Every stage of run {last_run_id} already completed.")
+            sys.exit(0)
+        run_id, run_plan = last_run_id, last_plan
+        first_incomplete = next(
+            stage
+            for stage in run_plan
+            if stage_states.get(stage, (None,))[0] != "complete"
+        )
+        # Stages can be redone, but not undone, so a stage after the
+        # first incomplete one is run again even if it completed
+        stage_names = run_plan[run_plan.index(first_incomplete) :]
+        if last_parameters != run_parameters():
+            print(
+                "Warning: the configuration has changed since "
+                + f"run {run_id} started"
+            )
+        print(f"Resuming run {run_id} from stage {stage_names[0]}")
+    elif args.delta:
+        # The tables have to be exactly what the last run left behind
+        if (
+            last_run is None
+            or last_plan not in (FULL_RUN, DELTA_RUN)
+            or not last_run_complete
+        ):
+            print(
+                "A delta run needs a complete full or delta run before "
+                + "it. Finish the last run with --resume, or do a full run."
+            )
+            sys.exit(1)
+        if last_parameters != run_parameters():
+            print(
+                "The configuration has changed since the last run. "
+                + "Do a full run instead."
+            )
+            sys.exit(1)
+        run_plan = stage_names = DELTA_RUN
+    elif args.stage and last_run is not None:
+        # The stage is run again as part of the last run, on the tables
+        # that run built, so the run can still be resumed or built on
+        run_id, run_plan = last_run_id, last_plan
+        stage_names = [args.stage]
+        if last_parameters != run_parameters():
+            print(
+                "Warning: the configuration has changed since "
+                + f"run {run_id} started"
+            )
+        print(f"Running stage {args.stage} of run {run_id}")
+    elif args.stage:
+        run_plan = stage_names = [args.stage]
     else:
-        print("SUCCESS")
+        run_plan = stage_names = FULL_RUN
+
+    # A stage of a full run after its swap works on the serving schema
+    swapped = (
+        last_run is not None and run_id == last_run_id and last_run_swapped
+    )
+    use_run_schema(run_id, run_plan, swapped)
+    success = run_stages(run_id, stage_names, run_plan)
+    if success and cfg.UNLOGGED_LOAD and run_plan == FULL_RUN:
+        report_unlogged_load_savings(run_id)
+
+    end = datetime.now()
+    print(f"\nRun {run_id} total time: {end - start}")
+    if not success:
+        sys.exit(1)
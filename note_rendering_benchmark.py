@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+# Compares fetching and rendering notes one at a time, the way get_note
+# used to, with the chunked fetch and single pass renderer used for
+# batches of titles. The rendered notes must be identical.
+
+import sys
+from html import unescape
+from timeit import default_timer as timer
+
+import mysql.connector
+
+import setup_configuration as cfg
+from migration_functions import (
+    get_note_texts,
+    render_note,
+    substitute_note_templates,
+)
+
+sample_size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+source_cur = source_conn.cursor(buffered=True)
+source_cur.execute(
+    """
+    SELECT note_id
+    FROM notes
+    ORDER BY RAND()
+    LIMIT %s;
+    """,
+    (sample_size,),
+)
+note_ids = [row[0] for row in source_cur.fetchall()]
+
+start = timer()
+single_texts = {}
+for note_id in note_ids:
+    source_cur.execute(
+        """
+        SELECT note_note
+        FROM notes
+        WHERE note_id = %s
+        LIMIT 1;
+        """,
+        (note_id,),
+    )
+    single_texts[note_id] = unescape(source_cur.fetchone()[0])
+single_fetch_time = timer() - start
+
+start = timer()
+texts = get_note_texts(note_ids, source_cur)
+chunked_fetch_time = timer() - start
+
+source_cur.close()
+source_conn.close()
+assert texts == single_texts
+
+# Repeat the sample so the rendering times are large enough to compare
+corpus = list(texts.values()) * max(1, 200000 // max(1, len(texts)))
+
+start = timer()
+regex_notes = [substitute_note_templates(note) for note in corpus]
+regex_time = timer() - start
+
+start = timer()
+rendered_notes = [render_note(note) for note in corpus]
+render_time = timer() - start
+
+mismatches = sum(a != b for a, b in zip(regex_notes, rendered_notes))
+templated = sum("{{" in note for note in texts.values())
+
+print(f"Notes sampled:\t\t{len(texts)} ({templated} with templates)")
+print(f"Fetch one at a time:\t{single_fetch_time:.3f} s")
+print(
+    f"Fetch in chunks:\t{chunked_fetch_time:.3f} s"
+    + f"\t({single_fetch_time / chunked_fetch_time:.1f}x)"
+)
+print(f"Notes rendered:\t\t{len(corpus)}")
+print(f"Regex chain:\t\t{regex_time:.3f} s")
+print(
+    f"Single pass:\t\t{render_time:.3f} s"
+    + f"\t({regex_time / render_time:.1f}x)"
+)
+print(f"Mismatches:\t\t{mismatches}")
+if mismatches:
+    sys.exit(1)
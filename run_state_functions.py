@@ -0,0 +1,129 @@
+import json
+
+# Each run of the migration gets a run_id, and each of its stages gets a
+# row in migration_stages recording the configuration it ran with, when
+# it started and finished, and whether it completed. A run can then be
+# resumed from its first stage that didn't complete.
+
+
+def create_run_state_table(dest_cur):
+    dest_cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS migration_stages (
+            run_id          integer NOT NULL,
+            stage           text NOT NULL,
+            parameters      jsonb,
+            started_at      timestamptz,
+            finished_at     timestamptz,
+            status          text NOT NULL
+                CHECK (status IN ('running', 'complete', 'failed')),
+            PRIMARY KEY (run_id, stage)
+        );
+        """
+    )
+
+
+def new_run_id(dest_cur):
+    dest_cur.execute(
+        """
+        SELECT COALESCE(MAX(run_id), 0) + 1
+        FROM migration_stages;
+        """
+    )
+    return dest_cur.fetchone()[0]
+
+
+# Get the most recent run as (run_id, {stage: (status, parameters)}), or
+# None if there hasn't been one. A --stage is run inside the last run,
+# so a run planned as a single stage only comes from a --stage before
+# there was any other run, and isn't one that can be resumed or built
+# on. Those runs are left out.
+def get_last_run(dest_cur):
+    dest_cur.execute(
+        """
+        SELECT run_id, stage, status, parameters
+        FROM migration_stages
+        WHERE run_id = (
+            SELECT MAX(run_id)
+            FROM migration_stages
+            WHERE NOT COALESCE(
+                jsonb_array_length(parameters -> 'stages') = 1, FALSE
+            )
+        );
+        """
+    )
+    rows = dest_cur.fetchall()
+    if not rows:
+        return None
+    return (
+        rows[0][0],
+        {stage: (status, parameters) for _, stage, status, parameters in rows},
+    )
+
+
+def start_stage(run_id, stage, parameters, dest_cur):
+    dest_cur.execute(
+        """
+        INSERT INTO migration_stages
+        (run_id, stage, parameters, started_at, finished_at, status)
+        VALUES (%s, %s, %s, now(), NULL, 'running')
+        ON CONFLICT (run_id, stage) DO UPDATE
+        SET parameters = EXCLUDED.parameters,
+            started_at = EXCLUDED.started_at,
+            finished_at = NULL,
+            status = 'running';
+        """,
+        (run_id, stage, json.dumps(parameters)),
+    )
+
+
+def finish_stage(run_id, stage, status, dest_cur):
+    dest_cur.execute(
+        """
+        UPDATE migration_stages
+        SET finished_at = now(),
+            status = %s
+        WHERE run_id = %s
+        AND stage = %s;
+        """,
+        (status, run_id, stage),
+    )
+
+
+# The time each completed stage took in the runs before run_id whose
+# parameters match, as {run_id: {stage: timedelta}}. The plan of stages
+# each run recorded isn't compared. Runs from before unlogged_load and
+# schema_builds were recorded ran without them.
+def get_matching_stage_times(run_id, parameters, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT run_id, stage, parameters, finished_at - started_at
+        FROM migration_stages
+        WHERE run_id < %s
+        AND status = 'complete';
+        """,
+        (run_id,),
+    )
+    rows = dest_cur.fetchall()
+    stage_times = {}
+    for other_run_id, stage, other_parameters, stage_time in rows:
+        other_parameters = dict(other_parameters or {})
+        other_parameters.pop("stages", None)
+        other_parameters.setdefault("unlogged_load", False)
+        other_parameters.setdefault("schema_builds", False)
+        if other_parameters == parameters:
+            stage_times.setdefault(other_run_id, {})[stage] = stage_time
+    return stage_times
+
+
+def get_stage_times(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT stage, finished_at - started_at
+        FROM migration_stages
+        WHERE run_id = %s
+        AND status = 'complete';
+        """,
+        (run_id,),
+    )
+    return dict(dest_cur.fetchall())
@@ -0,0 +1,193 @@
+from psycopg2.sql import SQL, Identifier
+
+import setup_configuration as cfg
+
+# With schema_builds, each full run builds its tables, text search
+# configuration, ttype enum and search functions in a new schema of its
+# own, while the app keeps reading the serving schema. The swap stage
+# then renames the new build to the serving schema in one transaction,
+# and the build it replaces back to its own name, where it's kept for
+# rollback. Indexes, generated columns and column defaults refer to the
+# objects they use by oid, so they still work after the renames. The
+# extensions are shared by every build, so they're kept in public,
+# where dropping an old build doesn't drop them along with it. Schema
+# names are always quoted with Identifier.
+
+
+def build_schema_name(run_id):
+    return f"{cfg.SERVING_SCHEMA}_build_{run_id}"
+
+
+# Point every destination connection opened from now on at schema,
+# with public after it for the extensions and the bookkeeping of the
+# runs. Pool workers and stage processes inherit the setting.
+def use_schema(schema):
+    cfg.DEST_SCHEMA = schema
+    search_path = f"{schema},public"
+    cfg.DEST_DB_CONN_STRING += f" options='-c search_path={search_path}'"
+    cfg.DEST_DB_PARAMS["server_settings"] = {"search_path": search_path}
+
+
+# Whether the connections are pointed at a new build, rather than the
+# serving schema or public
+def building_schema():
+    return cfg.SCHEMA_BUILDS and cfg.DEST_SCHEMA != cfg.SERVING_SCHEMA
+
+
+# Every build that hasn't been dropped. served_at is when the build last
+# became the serving schema, or NULL if it never has.
+def create_schema_builds_table(dest_cur):
+    dest_cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_builds (
+            run_id          integer NOT NULL,
+            serving         boolean NOT NULL DEFAULT FALSE,
+            served_at       timestamptz,
+            PRIMARY KEY (run_id)
+        );
+        """
+    )
+
+
+def create_schema(schema, dest_cur):
+    dest_cur.execute(
+        SQL("CREATE SCHEMA IF NOT EXISTS {};").format(Identifier(schema))
+    )
+
+
+# Start the build of run_id over from an empty schema
+def create_build_schema(run_id, dest_cur):
+    schema = Identifier(build_schema_name(run_id))
+    dest_cur.execute(
+        SQL(
+            """
+            DROP SCHEMA IF EXISTS {schema} CASCADE;
+            CREATE SCHEMA {schema};
+            """
+        ).format(schema=schema)
+    )
+    dest_cur.execute(
+        """
+        INSERT INTO schema_builds (run_id)
+        VALUES (%s)
+        ON CONFLICT (run_id) DO UPDATE
+        SET serving = FALSE,
+            served_at = NULL;
+        """,
+        (run_id,),
+    )
+
+
+# The run_id of the serving build, or None if there isn't one
+def get_serving_build(dest_cur):
+    dest_cur.execute(
+        """
+        SELECT run_id
+        FROM schema_builds
+        WHERE serving;
+        """
+    )
+    row = dest_cur.fetchone()
+    return None if row is None else row[0]
+
+
+# The newest build before the serving one that has served before, or
+# None if there isn't one
+def get_previous_build(dest_cur):
+    serving_run_id = get_serving_build(dest_cur)
+    if serving_run_id is None:
+        return None
+    dest_cur.execute(
+        """
+        SELECT MAX(run_id)
+        FROM schema_builds
+        WHERE run_id < %s
+        AND served_at IS NOT NULL;
+        """,
+        (serving_run_id,),
+    )
+    return dest_cur.fetchone()[0]
+
+
+# Make the build of run_id the serving schema. Both renames happen in
+# the caller's transaction, so the app sees either the old build or the
+# new one. A serving schema from before schema_builds is kept as build
+# 0.
+def switch_build(run_id, dest_cur):
+    serving_run_id = get_serving_build(dest_cur)
+    dest_cur.execute(
+        """
+        SELECT 1
+        FROM pg_namespace
+        WHERE nspname = %s;
+        """,
+        (cfg.SERVING_SCHEMA,),
+    )
+    if dest_cur.fetchone() is not None:
+        if serving_run_id is None:
+            serving_run_id = 0
+            dest_cur.execute(
+                """
+                INSERT INTO schema_builds (run_id, served_at)
+                VALUES (0, now())
+                ON CONFLICT (run_id) DO NOTHING;
+                """
+            )
+        rename_schema(
+            cfg.SERVING_SCHEMA, build_schema_name(serving_run_id), dest_cur
+        )
+    rename_schema(build_schema_name(run_id), cfg.SERVING_SCHEMA, dest_cur)
+    dest_cur.execute(
+        """
+        UPDATE schema_builds
+        SET serving = (run_id = %s),
+            served_at = CASE
+                WHEN run_id = %s THEN now()
+                ELSE served_at
+            END;
+        """,
+        (run_id, run_id),
+    )
+
+
+def rename_schema(schema, new_name, dest_cur):
+    dest_cur.execute(
+        SQL("ALTER SCHEMA {} RENAME TO {};").format(
+            Identifier(schema), Identifier(new_name)
+        )
+    )
+
+
+# The builds to drop, keeping the newest keep builds that have served
+# before. Builds older than run_id that never served are dropped too.
+def get_old_builds(keep, run_id, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT run_id, served_at IS NOT NULL
+        FROM schema_builds
+        WHERE NOT serving
+        ORDER BY run_id DESC;
+        """
+    )
+    rows = dest_cur.fetchall()
+    served = [build_id for build_id, has_served in rows if has_served]
+    return served[keep:] + [
+        build_id
+        for build_id, has_served in rows
+        if not has_served and build_id < run_id
+    ]
+
+
+def drop_build(run_id, dest_cur):
+    dest_cur.execute(
+        SQL("DROP SCHEMA IF EXISTS {} CASCADE;").format(
+            Identifier(build_schema_name(run_id))
+        )
+    )
+    dest_cur.execute(
+        """
+        DELETE FROM schema_builds
+        WHERE run_id = %s;
+        """,
+        (run_id,),
+    )
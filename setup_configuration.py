@@ -1,5 +1,6 @@
 import configparser
 import os
+import re
 from pathlib import Path
 
 # Get per-environment settings from the config files.
@@ -24,6 +25,46 @@ INCONSISTENT_ISBN_VIRTUAL_TITLE = config.getint(
     "inconsistent_isbn_virtual_title"
 )
 PROGRESS_BAR = config.getboolean("progress_bar")
+LOAD_BATCH_SIZE = config.getint("load_batch_size")
+BULK_EXTRACTION = config.getboolean("bulk_extraction")
+PREFILTER_TITLES = config.getboolean("prefilter_titles")
+STREAM_TITLES = config.getboolean("stream_titles")
+PLAN_ISBN_DEDUPLICATION = config.getboolean("plan_isbn_deduplication")
+SOURCE_SNAPSHOT = config.getboolean("source_snapshot")
+SNAPSHOT_DIR = config["snapshot_dir"]
+SOURCE_BACKUP = config["source_backup"] or None
+PIPELINE = config.getboolean("pipeline")
+PIPELINE_EXTRACTORS = config.getint("pipeline_extractors")
+PIPELINE_LOADERS = config.getint("pipeline_loaders")
+PIPELINE_QUEUE_SIZE = config.getint("pipeline_queue_size")
+ASYNC_TITLES = config.getboolean("async_titles")
+ASYNC_PROCESSES = config.getint("async_processes")
+ASYNC_CONCURRENCY = config.getint("async_concurrency")
+ASYNC_POOL_SIZE = config.getint("async_pool_size")
+WORK_QUEUE = config.getboolean("work_queue")
+QUEUE_POLL_SECONDS = config.getint("queue_poll_seconds")
+PARALLEL_STAGES = config.getboolean("parallel_stages")
+SEARCH_VECTOR_AT_LOAD = config.getboolean("search_vector_at_load")
+INDEX_CONNECTIONS = config.getint("index_connections")
+INDEX_MAINTENANCE_WORK_MEM = config["index_maintenance_work_mem"]
+INDEX_PARALLEL_WORKERS = config.getint("index_parallel_workers")
+UNLOGGED_LOAD = config.getboolean("unlogged_load")
+SCHEMA_BUILDS = config.getboolean("schema_builds")
+SERVING_SCHEMA = config["serving_schema"]
+# Builds are named <serving_schema>_build_<run_id>, which has to fit in
+# the 63 characters Postgres allows, and neither can be public or a
+# system schema
+if (
+    not re.fullmatch(r"[a-z_][a-z0-9_]{0,39}", SERVING_SCHEMA)
+    or SERVING_SCHEMA == "public"
+    or SERVING_SCHEMA.startswith("pg_")
+):
+    raise Exception(
+        f"serving_schema must be a lower case identifier of up to 40 "
+        f"letters, digits and underscores, other than public or pg_*, "
+        f"not {SERVING_SCHEMA!r}"
+    )
+KEEP_BUILDS = config.getint("keep_builds")
 if config["limit"] in ["", None, "None"]:
     LIMIT = None
 else:
@@ -56,3 +97,15 @@ DEST_DB_CONN_STRING = (
     f"host={DEST_DB_HOST} "
     f"port={DEST_DB_PORT}"
 )
+
+DEST_DB_PARAMS = dict(
+    host=DEST_DB_HOST,
+    port=DEST_DB_PORT,
+    user=DEST_DB_USER,
+    password=config["dest_db_password"] or None,
+    database=DEST_DB_NAME,
+)
+
+# The schema the tables are built in. With schema_builds, use_schema in
+# schema_functions sets it for each run.
+DEST_SCHEMA = "public"
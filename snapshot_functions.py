@@ -0,0 +1,684 @@
+import hashlib
+import os
+import re
+import shutil
+from datetime import datetime
+from itertools import groupby
+from pathlib import Path
+
+import mysql.connector
+import pandas as pd
+
+import setup_configuration as cfg
+from columnar_store import SOURCE_TABLES, column_kind, read_table, write_table
+from dump_parser import convert_dump
+
+# The source tables can be read from a snapshot on disk instead of from
+# MySQL. The extract stage takes the snapshot, from MySQL or straight
+# from a backup file, into a directory named after the source's
+# identity, so a snapshot is taken once per ISFDB backup. Each function
+# below returns what the MySQL query it stands in for would return, so
+# the extraction functions can use its rows the same way.
+
+# The columns the migration reads from each source table
+SNAPSHOT_COLUMNS = {
+    "titles": [
+        "title_id",
+        "title_title",
+        "title_synopsis",
+        "note_id",
+        "series_id",
+        "title_seriesnum",
+        "title_copyright",
+        "title_ttype",
+        "title_parent",
+        "title_rating",
+        "title_seriesnum_2",
+        "title_jvn",
+        "title_language",
+        "title_storylen",
+        "title_non_genre",
+        "title_graphic",
+    ],
+    "pubs": [
+        "pub_id",
+        "pub_year",
+        "pub_pages",
+        "pub_ptype",
+        "pub_ctype",
+        "pub_isbn",
+        "pub_frontimage",
+    ],
+    "pub_content": ["pub_id", "title_id"],
+    "authors": ["author_id", "author_canonical"],
+    "canonical_author": ["title_id", "author_id", "ca_status"],
+    "series": ["series_id", "series_title", "series_parent"],
+    "notes": ["note_id", "note_note"],
+    "webpages": ["title_id", "url"],
+    "awards": ["award_id", "award_level"],
+    "title_awards": ["title_id", "award_id"],
+    "languages": ["lang_id", "lang_name"],
+}
+
+# The columns of the main title query, with YEAR(title_copyright) as year
+TITLE_COLUMNS = [
+    "title_id",
+    "title_title",
+    "title_synopsis",
+    "note_id",
+    "series_id",
+    "title_seriesnum",
+    "year",
+    "title_ttype",
+    "title_parent",
+    "title_rating",
+    "title_seriesnum_2",
+    "title_jvn",
+]
+BOOK_TTYPES = ["ANTHOLOGY", "COLLECTION", "NOVEL", "OMNIBUS"]
+DATE_TYPES = ("date", "datetime", "timestamp", "time", "year")
+
+# The alternate titles query's REGEXP. MySQL matches it without regard
+# to case, like it compares strings.
+ALT_TITLE_EXCLUSION_REGEX = re.compile(
+    r"part [0-9]+ of |boxed set|abridged|complete novel", re.IGNORECASE
+)
+
+# Rows are read from MySQL this many at a time while extracting
+FETCH_SIZE = 10000
+
+# The tables of the snapshot that load_snapshot last loaded
+tables = {}
+loaded_snapshot = None
+
+
+# Where the snapshot of the configured source is, named after the
+# backup's file name, size and modification time, or after the creation
+# and update times MySQL keeps for the source tables
+def find_snapshot():
+    if cfg.SOURCE_BACKUP:
+        backup = Path(cfg.SOURCE_BACKUP)
+        backup_stat = backup.stat()
+        identity = "backup-" + fingerprint(
+            (backup.name, backup_stat.st_size, backup_stat.st_mtime_ns)
+        )
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            source_cur = source_conn.cursor()
+            in_list = ", ".join(["%s"] * len(SOURCE_TABLES))
+            source_cur.execute(
+                f"""
+                SELECT TABLE_NAME, CREATE_TIME, UPDATE_TIME
+                FROM information_schema.TABLES
+                WHERE TABLE_SCHEMA = DATABASE()
+                AND TABLE_NAME IN ({in_list})
+                ORDER BY TABLE_NAME;
+                """,
+                SOURCE_TABLES,
+            )
+            identity = "mysql-" + fingerprint(
+                (
+                    cfg.SOURCE_DB_PARAMS["host"],
+                    cfg.SOURCE_DB_PARAMS["database"],
+                    source_cur.fetchall(),
+                )
+            )
+        finally:
+            source_conn.close()
+    return Path(cfg.SNAPSHOT_DIR, identity)
+
+
+def fingerprint(value):
+    return hashlib.md5(repr(value).encode()).hexdigest()[:16]
+
+
+def snapshot_complete(snapshot_path):
+    return Path(snapshot_path, "complete").exists()
+
+
+# Take a snapshot of every source table. It's only marked complete once
+# all of them are written, so an interrupted extraction starts over.
+def extract_snapshot(snapshot_path):
+    shutil.rmtree(snapshot_path, ignore_errors=True)
+    os.makedirs(snapshot_path)
+    if cfg.SOURCE_BACKUP:
+        convert_dump(cfg.SOURCE_BACKUP, snapshot_path)
+    else:
+        source_conn = mysql.connector.connect(**cfg.SOURCE_DB_PARAMS)
+        try:
+            for table in SOURCE_TABLES:
+                start = datetime.now()
+                row_count = extract_table(table, snapshot_path, source_conn)
+                print(
+                    f"{table}: {row_count} rows "
+                    + f"in {datetime.now() - start}"
+                )
+        finally:
+            source_conn.close()
+    Path(snapshot_path, "complete").touch()
+
+
+def extract_table(table, snapshot_path, source_conn):
+    source_cur = source_conn.cursor()
+    source_cur.execute(
+        """
+        SELECT COLUMN_NAME, DATA_TYPE
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE()
+        AND TABLE_NAME = %s
+        ORDER BY ORDINAL_POSITION;
+        """,
+        (table,),
+    )
+    column_types = source_cur.fetchall()
+    source_cur.close()
+
+    # Dates are kept as the text MySQL shows for them, the same as in a
+    # backup, since ISFDB dates like 1999-00-00 aren't valid Python dates
+    select_list = ", ".join(
+        f"CAST(`{name}` AS CHAR)"
+        if data_type.lower() in DATE_TYPES
+        else f"`{name}`"
+        for name, data_type in column_types
+    )
+    source_cur = source_conn.cursor(buffered=False)
+    try:
+        source_cur.execute(f"SELECT {select_list} FROM `{table}`;")
+        return write_table(
+            Path(snapshot_path, table),
+            [
+                (name, column_kind(data_type))
+                for name, data_type in column_types
+            ],
+            fetch_rows(source_cur),
+        )
+    finally:
+        source_cur.close()
+
+
+def fetch_rows(source_cur):
+    while True:
+        rows = source_cur.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+# Read the columns the migration uses into the tables dict. Stages load
+# the snapshot before forking their pools, so the workers share it.
+def load_snapshot(snapshot_path):
+    global loaded_snapshot
+    if loaded_snapshot == snapshot_path:
+        return
+    if not snapshot_complete(snapshot_path):
+        raise Exception(
+            f"There is no complete snapshot at {snapshot_path}. "
+            + "Run the extract stage first."
+        )
+    start = datetime.now()
+    tables.clear()
+    for table, columns in SNAPSHOT_COLUMNS.items():
+        tables[table] = read_table(Path(snapshot_path, table), columns)
+    tables["titles"]["year"] = year_of(tables["titles"].title_copyright)
+    tables["pubs"]["p_year"] = year_of(tables["pubs"].pub_year)
+    loaded_snapshot = snapshot_path
+    print(
+        f"Loaded the snapshot at {snapshot_path} in {datetime.now() - start}"
+    )
+
+
+# YEAR() of dates stored as text
+def year_of(dates):
+    return pd.to_numeric(dates.str[:4], errors="coerce").astype("Int64")
+
+
+# The rows of a frame as tuples, with None for nulls, the way a MySQL
+# cursor returns them
+def frame_rows(frame):
+    columns = [
+        frame[name].astype(object).where(frame[name].notna(), None).tolist()
+        for name in frame.columns
+    ]
+    return list(zip(*columns))
+
+
+# pd.read_sql gives integer columns with nulls as floats, and columns
+# with nothing but nulls, or no rows at all, as objects
+def read_sql_dtypes(frame):
+    return frame.assign(
+        **{
+            name: read_sql_column(frame[name])
+            for name in frame.columns
+            if isinstance(frame[name].dtype, pd.Int64Dtype)
+        }
+    )
+
+
+def read_sql_column(column):
+    if column.isna().all():
+        return column.astype(object).where(column.notna(), None)
+    return column.astype("float64" if column.isna().any() else "int64")
+
+
+# Rows where the mask is true. Like in a WHERE clause, a null counts
+# as false.
+def where(frame, mask):
+    return frame[mask.fillna(False).astype(bool)]
+
+
+# Like SQL, a null isn't unequal to anything
+def not_equal(column, value):
+    return column.notna() & (column != value)
+
+
+# Strings as MySQL compares them with its default collation, without
+# regard to case or trailing spaces
+def same_text(text, other):
+    return text.rstrip(" ").lower() == other.rstrip(" ").lower()
+
+
+def book_title_mask(titles):
+    return (
+        (titles.title_ttype == "SHORTFICTION")
+        & (titles.title_storylen == "novella")
+    ) | titles.title_ttype.isin(BOOK_TTYPES)
+
+
+def genre_book_mask(titles):
+    return (
+        book_title_mask(titles)
+        & not_equal(titles.title_non_genre, "Yes")
+        & not_equal(titles.title_graphic, "Yes")
+    )
+
+
+def language_rows():
+    return frame_rows(tables["languages"][["lang_id", "lang_name"]])
+
+
+def series_rows():
+    return frame_rows(
+        tables["series"][["series_id", "series_title", "series_parent"]]
+    )
+
+
+# all_titles_query, in title_id order
+def all_title_rows(limit=None, root_ids=None):
+    titles = tables["titles"]
+    canonical_author = tables["canonical_author"]
+    excluded_authors = [
+        int(author_id) for author_id in cfg.EXCLUDED_AUTHORS.split(",")
+    ]
+    excluded_title_ids = [
+        int(title_id) for title_id in cfg.EXCLUDED_TITLE_IDS.split(",")
+    ]
+    mask = (
+        genre_book_mask(titles)
+        & (titles.title_language == cfg.ENGLISH)
+        & ~titles.title_id.isin(
+            canonical_author.title_id[
+                canonical_author.author_id.isin(excluded_authors)
+            ]
+        )
+        & ~titles.title_id.isin(excluded_title_ids)
+    )
+
+    if cfg.PREFILTER_TITLES:
+        original_language = titles.title_parent.map(
+            pd.Series(titles.title_language.array, index=titles.title_id)
+        )
+        translations = where(
+            titles,
+            genre_book_mask(titles)
+            & (titles.title_language == cfg.MY_LANG)
+            & not_equal(titles.title_parent, 0),
+        )
+        preferred_ids = translations.sort_values(
+            ["title_parent", "year", "title_id"],
+            ascending=[True, False, False],
+            na_position="last",
+        ).drop_duplicates("title_parent")
+        mask &= (titles.year.isna() | (titles.year != 8888)) & (
+            (titles.title_parent == 0)
+            | (
+                not_equal(original_language, cfg.MY_LANG)
+                & titles.title_id.isin(preferred_ids.title_id)
+            )
+        )
+
+    if root_ids is not None:
+        root_ids = list(root_ids)
+        mask &= titles.title_id.isin(root_ids) | titles.title_parent.isin(
+            root_ids
+        )
+
+    rows = where(titles, mask).sort_values("title_id")
+    if limit:
+        rows = rows.head(limit)
+    return frame_rows(rows[TITLE_COLUMNS])
+
+
+# The translation groups query
+def translation_rows():
+    titles = tables["titles"]
+    translations = where(
+        titles,
+        genre_book_mask(titles) & (titles.title_language == cfg.MY_LANG),
+    ).merge(
+        titles[["title_id", "title_title", "year", "title_language"]],
+        left_on="title_parent",
+        right_on="title_id",
+        suffixes=("", "_original"),
+    )
+    translations = where(
+        translations,
+        not_equal(translations.title_language_original, cfg.MY_LANG),
+    ).sort_values(
+        ["title_parent", "year", "title_id"],
+        ascending=[True, False, False],
+        na_position="last",
+    )
+    return frame_rows(
+        translations[
+            [
+                "title_parent",
+                "title_id",
+                "title_title",
+                "year",
+                "note_id",
+                "title_title_original",
+                "year_original",
+                "title_language_original",
+            ]
+        ]
+    )
+
+
+# The series fields of one title, or None if there isn't one
+def title_series_row(title_id):
+    titles = tables["titles"]
+    rows = frame_rows(
+        titles.loc[
+            titles.title_id == title_id,
+            ["series_id", "title_seriesnum", "title_seriesnum_2"],
+        ].head(1)
+    )
+    return rows[0] if rows else None
+
+
+# pub_rows_query, as the frame get_pub_rows reads from MySQL
+def pub_rows(root_ids):
+    titles = tables["titles"]
+    pub_content = tables["pub_content"]
+    pubs = tables["pubs"]
+    root_ids = list(root_ids)
+
+    own_titles = titles.loc[
+        titles.title_id.isin(root_ids), ["title_id", "title_language"]
+    ].assign(root_id=lambda frame: frame.title_id)
+    child_titles = where(
+        titles,
+        titles.title_parent.isin(root_ids)
+        & not_equal(titles.title_parent, titles.title_id),
+    )[["title_id", "title_language", "title_parent"]].rename(
+        columns={"title_parent": "root_id"}
+    )
+    root_titles = pd.concat([own_titles, child_titles])
+
+    contents = pub_content.loc[
+        pub_content.title_id.isin(root_titles.title_id),
+        ["pub_id", "title_id"],
+    ]
+    rows = (
+        root_titles.merge(contents, on="title_id")
+        .merge(
+            pubs.loc[
+                pubs.pub_id.isin(contents.pub_id),
+                [
+                    "pub_id",
+                    "p_year",
+                    "pub_pages",
+                    "pub_ptype",
+                    "pub_ctype",
+                    "pub_isbn",
+                    "pub_frontimage",
+                ],
+            ],
+            on="pub_id",
+        )
+        .sort_values(["root_id", "pub_id", "title_id"], kind="stable")
+    )
+    return read_sql_dtypes(
+        rows[
+            [
+                "root_id",
+                "title_id",
+                "title_language",
+                "pub_id",
+                "p_year",
+                "pub_pages",
+                "pub_ptype",
+                "pub_ctype",
+                "pub_isbn",
+                "pub_frontimage",
+            ]
+        ].reset_index(drop=True)
+    )
+
+
+# The rows of title_attribute_queries, by query name
+def title_attribute_rows(title_ids):
+    titles = tables["titles"]
+    canonical_author = tables["canonical_author"]
+    webpages = tables["webpages"]
+    title_awards = tables["title_awards"]
+    awards = tables["awards"]
+    title_ids = list(title_ids)
+    query_results = {}
+
+    # GROUP_CONCAT leaves out null names
+    title_authors = (
+        canonical_author.loc[
+            canonical_author.title_id.isin(title_ids),
+            ["title_id", "author_id"],
+        ]
+        .drop_duplicates()
+        .merge(tables["authors"], on="author_id")
+        .dropna(subset=["author_canonical"])
+        .sort_values(["title_id", "author_id"])
+    )
+    query_results["authors"] = [
+        (title_id, ", ".join(row[1] for row in rows))
+        for title_id, rows in groupby(
+            frame_rows(title_authors[["title_id", "author_canonical"]]),
+            key=lambda row: row[0],
+        )
+    ]
+
+    query_results["wikipedia"] = frame_rows(
+        where(
+            webpages,
+            webpages.title_id.isin(title_ids)
+            & webpages.url.str.contains(
+                "en.wikipedia.org", case=False, regex=False
+            ),
+        )[["title_id", "url"]]
+    )
+
+    winning_awards = awards.award_id[
+        pd.to_numeric(awards.award_level, errors="coerce") == 1
+    ]
+    query_results["award_winner"] = [
+        (title_id, True)
+        for title_id in sorted(
+            set(
+                title_awards.title_id[
+                    title_awards.title_id.isin(title_ids)
+                    & title_awards.award_id.isin(winning_awards)
+                ]
+            )
+        )
+    ]
+
+    parent_titles = dict(
+        frame_rows(
+            titles.loc[
+                titles.title_id.isin(title_ids), ["title_id", "title_title"]
+            ]
+        )
+    )
+    variants = titles.loc[
+        titles.title_parent.isin(title_ids)
+        & (titles.title_language == cfg.MY_LANG).fillna(False),
+        ["title_parent", "title_title"],
+    ]
+    alt_titles = {}
+    for parent_id, alt_title in frame_rows(variants):
+        parent_title = parent_titles.get(parent_id)
+        if (
+            alt_title is None
+            or parent_title is None
+            or same_text(alt_title, parent_title)
+            or ALT_TITLE_EXCLUSION_REGEX.search(alt_title)
+        ):
+            continue
+        alt_titles[parent_id, alt_title] = None
+    query_results["alt_titles"] = list(alt_titles)
+    return query_results
+
+
+def note_rows(note_ids):
+    notes = tables["notes"]
+    return frame_rows(
+        notes.loc[
+            notes.note_id.isin(list(note_ids)) & notes.note_note.notna(),
+            ["note_id", "note_note"],
+        ]
+    )
+
+
+# The rows of get_contents for the books with a title_id from first_id
+# to last_id
+def content_rows(first_id, last_id):
+    titles = tables["titles"]
+    pub_content = tables["pub_content"]
+    pubs = tables["pubs"]
+
+    own_pubs = where(
+        pub_content, pub_content.title_id.between(first_id, last_id)
+    ).rename(columns={"title_id": "book_title_id"})
+    variants = where(
+        titles,
+        titles.title_parent.between(first_id, last_id)
+        & not_equal(titles.title_parent, 0)
+        & (titles.title_language == cfg.MY_LANG),
+    )[["title_id", "title_parent"]]
+    variant_pubs = (
+        pub_content[pub_content.title_id.isin(variants.title_id)]
+        .merge(variants, on="title_id")[["pub_id", "title_parent"]]
+        .rename(columns={"title_parent": "book_title_id"})
+    )
+    book_pubs = pd.concat(
+        [own_pubs[["pub_id", "book_title_id"]], variant_pubs]
+    ).drop_duplicates()
+
+    content_titles = where(titles, book_title_mask(titles)).title_id
+    rows = book_pubs.merge(pubs[["pub_id", "pub_ctype"]], on="pub_id").merge(
+        pub_content.loc[
+            pub_content.pub_id.isin(book_pubs.pub_id)
+            & pub_content.title_id.isin(content_titles),
+            ["pub_id", "title_id"],
+        ],
+        on="pub_id",
+    )
+    rows = where(rows, not_equal(rows.title_id, rows.book_title_id))
+    return frame_rows(
+        rows[["book_title_id", "pub_ctype", "title_id"]].drop_duplicates()
+    )
+
+
+# The rows of get_source_containers' query for the title_ids
+def container_rows(title_ids):
+    titles = tables["titles"]
+    pub_content = tables["pub_content"]
+    pub_ids = pub_content.pub_id[pub_content.title_id.isin(list(title_ids))]
+    containers = (
+        pub_content.loc[pub_content.pub_id.isin(pub_ids), ["title_id"]]
+        .drop_duplicates()
+        .merge(
+            titles[["title_id", "title_parent", "title_language"]],
+            on="title_id",
+        )
+    )
+    return frame_rows(containers)
+
+
+# (title_id, title_parent, series_id, digest) for every title, digesting
+# the same fields as get_title_fingerprints' query. The digests aren't
+# the ones MySQL would compute, so fingerprints from a snapshot are only
+# comparable with other fingerprints from a snapshot.
+def fingerprint_title_rows():
+    titles = tables["titles"]
+    note_texts = pd.Series(
+        tables["notes"].note_note.array, index=tables["notes"].note_id
+    )
+    fields = titles[SNAPSHOT_COLUMNS["titles"]].assign(
+        note_text=titles.note_id.map(note_texts),
+        synopsis_text=titles.title_synopsis.map(note_texts),
+    )
+    return [
+        (row[0], row[8], row[4], fingerprint(row[1:]))
+        for row in frame_rows(fields)
+    ]
+
+
+# (name, rows) pairs like fingerprint_queries, with (title_id, digest)
+# rows
+def fingerprint_part_rows():
+    titles = tables["titles"]
+    pub_content = tables["pub_content"]
+    parts = [
+        (
+            "authors",
+            tables["canonical_author"].merge(
+                tables["authors"], on="author_id"
+            )[["title_id", "author_id", "ca_status", "author_canonical"]],
+        ),
+        (
+            "pubs",
+            pub_content[["title_id", "pub_id"]].merge(
+                tables["pubs"].drop(columns="p_year"), on="pub_id"
+            ),
+        ),
+        (
+            "webpages",
+            where(tables["webpages"], tables["webpages"].title_id.notna())[
+                ["title_id", "url"]
+            ],
+        ),
+        (
+            "awards",
+            tables["title_awards"].merge(tables["awards"], on="award_id")[
+                ["title_id", "award_id", "award_level"]
+            ],
+        ),
+    ]
+    part_rows = []
+    for name, frame in parts:
+        frame = where(frame, frame.title_id.isin(titles.title_id))
+        rows = frame_rows(
+            frame.sort_values(list(frame.columns), na_position="last")
+        )
+        part_rows.append(
+            (
+                name,
+                [
+                    (title_id, fingerprint([row[1:] for row in title_rows]))
+                    for title_id, title_rows in groupby(
+                        rows, key=lambda row: row[0]
+                    )
+                ],
+            )
+        )
+    return part_rows
@@ -0,0 +1,112 @@
+from datetime import timedelta
+
+# With parallel_stages, the stages of a run are scheduled by the tables
+# they read and write, given as (reads, writes) pairs of sets. A stage
+# depends on every earlier stage of the run that writes something it
+# reads or writes, or reads something it writes, so the stages can run
+# in any order the dependencies allow with the same result as running
+# them one after another. "*" stands for every table.
+
+
+def tables_overlap(first, second):
+    if "*" in first:
+        return bool(second)
+    if "*" in second:
+        return bool(first)
+    return bool(first & second)
+
+
+def stages_conflict(first, second):
+    first_reads, first_writes = first
+    second_reads, second_writes = second
+    if tables_overlap(first_writes, second_reads | second_writes):
+        return True
+    return tables_overlap(first_reads, second_writes)
+
+
+# The earlier stages each stage depends on, by stage name
+def stage_dependencies(stage_names, stage_tables):
+    return {
+        stage: {
+            earlier
+            for earlier in stage_names[:ii]
+            if stages_conflict(stage_tables[earlier], stage_tables[stage])
+        }
+        for ii, stage in enumerate(stage_names)
+    }
+
+
+# The dependencies that don't come through another dependency
+def direct_dependencies(stage_names, dependencies):
+    ancestors = {}
+    for stage in stage_names:
+        ancestors[stage] = set(dependencies[stage]).union(
+            *(ancestors[dep] for dep in dependencies[stage])
+        )
+    return {
+        stage: {
+            dep
+            for dep in dependencies[stage]
+            if not any(
+                dep in ancestors[other] for other in dependencies[stage]
+            )
+        }
+        for stage in stage_names
+    }
+
+
+# The chain of dependent stages that took the longest, as a list of
+# stage names, and how long it took. No schedule of these stages could
+# have finished sooner. Durations are timedeltas by stage name.
+def critical_path(stage_names, dependencies, durations):
+    path_times = {}
+    previous = {}
+    for stage in stage_names:
+        slowest = max(
+            dependencies[stage], key=lambda dep: path_times[dep], default=None
+        )
+        previous[stage] = slowest
+        path_times[stage] = durations[stage]
+        if slowest is not None:
+            path_times[stage] += path_times[slowest]
+
+    stage = max(stage_names, key=lambda stage: path_times[stage])
+    path_time = path_times[stage]
+    path = []
+    while stage is not None:
+        path.append(stage)
+        stage = previous[stage]
+    return path[::-1], path_time
+
+
+# timings holds the (start, end) datetimes of each stage that ran
+def report_stage_timings(stage_names, dependencies, timings):
+    stage_names = [stage for stage in stage_names if stage in timings]
+    if not stage_names:
+        return
+    run_start = min(start for start, _ in timings.values())
+    run_end = max(end for _, end in timings.values())
+    durations = {
+        stage: timings[stage][1] - timings[stage][0] for stage in stage_names
+    }
+    dependencies = {
+        stage: dependencies[stage] & set(stage_names) for stage in stage_names
+    }
+
+    direct = direct_dependencies(stage_names, dependencies)
+
+    print("\nStage timings:")
+    for stage in stage_names:
+        start = timings[stage][0]
+        after = ", ".join(sorted(direct[stage]))
+        print(
+            f"  {stage}: started at +{start - run_start}, "
+            + f"took {durations[stage]}"
+            + (f", after {after}" if after else "")
+        )
+
+    path, path_time = critical_path(stage_names, dependencies, durations)
+    print(f"Critical path: {' -> '.join(path)}")
+    print(f"Critical path time: {path_time}")
+    print(f"Sum of stage times: {sum(durations.values(), timedelta())}")
+    print(f"Wall time: {run_end - run_start}")
@@ -0,0 +1,16 @@
+import json
+from pathlib import Path
+
+import pytest
+
+DATA_DIR = Path(Path(__file__).resolve().parent, "data")
+
+
+# Read one of the checked-in datasets in tests/data by name
+@pytest.fixture
+def load_dataset():
+    def load(name):
+        with open(Path(DATA_DIR, f"{name}.json")) as f:
+            return json.load(f)
+
+    return load
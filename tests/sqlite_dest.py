@@ -0,0 +1,268 @@
+import re
+import sqlite3
+
+import setup_configuration as cfg
+from isbn_deduplication_functions import insert_virtual_books
+
+# A stand-in for the destination database, so the functions that write
+# the books tables can be tested without Postgres. SqliteCursor takes
+# the SQL those functions send to psycopg2 and rewrites the few parts
+# SQLite doesn't understand, and the tables are declared with the same
+# keys, unique constraints and cascading deletes as the real ones.
+
+BOOKS_TABLES = """
+    CREATE TABLE books (
+        title_id            integer NOT NULL,
+        title               text NOT NULL CHECK (title <> ''),
+        year                integer default NULL,
+        authors             text default NULL,
+        book_type           text NOT NULL CHECK (
+            book_type IN (
+                'NOVEL', 'NOVELLA', 'ANTHOLOGY', 'COLLECTION', 'OMNIBUS'
+            )
+        ),
+        isbn                varchar(13) default NULL CHECK (isbn <> ''),
+        pages               int default NULL,
+        alt_titles          text default NULL,
+        inconsistent        boolean default FALSE,
+        virtual             boolean default FALSE,
+        cover_image         text default NULL CHECK (cover_image <> ''),
+        note                text default NULL,
+        PRIMARY KEY (title_id)
+    );
+
+    CREATE TABLE isbns (
+        id          integer PRIMARY KEY,
+        isbn        varchar(13) NOT NULL CHECK (isbn <> ''),
+        title_id    integer NOT NULL
+            REFERENCES books (title_id) ON DELETE CASCADE,
+        book_type   text NOT NULL,
+        foreign_lang     boolean default FALSE,
+        UNIQUE (isbn, title_id)
+    );
+
+    CREATE TABLE translations (
+        title_id            integer NOT NULL,
+        lowest_title_id     integer NOT NULL
+            REFERENCES books (title_id) ON DELETE CASCADE,
+        title               text NOT NULL CHECK (title <> ''),
+        year                integer default NULL,
+        note                text default NULL,
+        PRIMARY KEY (title_id),
+        UNIQUE (title_id, lowest_title_id)
+    );
+
+    CREATE TABLE contents (
+        id                  integer PRIMARY KEY,
+        book_title_id       integer NOT NULL
+            REFERENCES books (title_id) ON DELETE CASCADE,
+        content_title_id    integer NOT NULL
+            REFERENCES books (title_id) ON DELETE CASCADE
+            CONSTRAINT content_of_self
+                CHECK (content_title_id != book_title_id),
+        UNIQUE (book_title_id, content_title_id)
+    );
+
+    CREATE TABLE more_images (
+        id          integer PRIMARY KEY,
+        title_id    integer NOT NULL
+            REFERENCES books (title_id) ON DELETE CASCADE,
+        image       text default NULL CHECK (image <> ''),
+        UNIQUE (title_id, image)
+    );
+
+    CREATE TABLE merged_books (
+        loser_id        integer NOT NULL,
+        winner_id       integer NOT NULL,
+        PRIMARY KEY (loser_id)
+    );
+"""
+
+PLACEHOLDER_REGEX = re.compile(r"= ANY\(%s\)|%s")
+COPY_REGEX = re.compile(r"COPY (\w+) \(([^)]*)\) FROM STDIN")
+COPY_ESCAPES = {"\\\\": "\\", "\\t": "\t", "\\n": "\n", "\\r": "\r"}
+COPY_ESCAPE_REGEX = re.compile(r"\\[\\tnr]")
+
+
+class SqliteCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+        self.rowcount = -1
+
+    # Run each statement of sql in turn, like psycopg2 does, leaving
+    # rowcount and the rows of the last one
+    def execute(self, sql, params=()):
+        params = list(params)
+        sql = sql.replace("ON COMMIT DELETE ROWS", "")
+        sql = re.sub(r"TRUNCATE (\w+)", r"DELETE FROM \1", sql)
+        for statement in sql.split(";"):
+            if not statement.strip():
+                continue
+            n_params = statement.count("%s")
+            statement, statement_params = bind_params(
+                statement, params[:n_params]
+            )
+            del params[:n_params]
+            self.cur.execute(sqlite_statement(statement), statement_params)
+            self.rowcount = self.cur.rowcount
+
+    def copy_expert(self, sql, file):
+        table, columns = COPY_REGEX.match(sql).groups()
+        columns = [column.strip() for column in columns.split(",")]
+        self.cur.execute(f"PRAGMA table_info({table});")
+        types = {row[1]: row[2].lower() for row in self.cur.fetchall()}
+        rows = [
+            [
+                copy_field(field, types[column])
+                for field, column in zip(line.split("\t"), columns)
+            ]
+            for line in file.read().splitlines()
+        ]
+        self.cur.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            + f"VALUES ({', '.join('?' * len(columns))});",
+            rows,
+        )
+        self.rowcount = len(rows)
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+
+# Swap psycopg2's placeholders for SQLite's, expanding = ANY(%s) into an
+# IN list of the values
+def bind_params(statement, params):
+    params = iter(params)
+    bound_params = []
+
+    def bind(match):
+        value = next(params)
+        if match.group(0) == "%s":
+            bound_params.append(value)
+            return "?"
+        bound_params.extend(value)
+        return f"IN ({', '.join('?' * len(value))})"
+
+    return PLACEHOLDER_REGEX.sub(bind, statement), bound_params
+
+
+def sqlite_statement(statement):
+    # Postgres sorts NULLs first in descending order, SQLite last
+    statement = re.sub(r"\bDESC\b", "DESC NULLS FIRST", statement)
+
+    # SQLite can't tell an ON CONFLICT after an INSERT's SELECT from a
+    # join constraint unless the SELECT has a WHERE clause
+    head, conflict, tail = statement.partition("ON CONFLICT")
+    if conflict and "SELECT" in head and "WHERE" not in head:
+        if "ORDER BY" in head:
+            head = head.replace("ORDER BY", "WHERE TRUE ORDER BY")
+        else:
+            head += " WHERE TRUE "
+        statement = head + conflict + tail
+    return statement
+
+
+def copy_field(field, column_type):
+    if field == "\\N":
+        return None
+    if column_type == "boolean" and field in ("t", "f"):
+        return field == "t"
+    return COPY_ESCAPE_REGEX.sub(lambda m: COPY_ESCAPES[m.group(0)], field)
+
+
+# A destination cursor on a new in-memory database with empty books
+# tables. The connection is in autocommit mode, so callers can use
+# savepoints for the transactions of the real connections.
+def connect_dest():
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    conn.execute("PRAGMA foreign_keys = ON;")
+    conn.executescript(BOOKS_TABLES)
+    return SqliteCursor(conn)
+
+
+# Fill the books tables from a dict of lists of rows, keyed by table.
+# books rows are (title_id, title, authors, year, pages, book_type,
+# cover_image), with each book's isbn set to the first isbns row that
+# claims it. The virtual title for ambiguous isbns is added as well.
+def load_books_tables(data, dest_cur):
+    dest_cur.cur.executemany(
+        """
+        INSERT INTO books
+        (title_id, title, authors, year, pages, book_type, cover_image)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
+        """,
+        data["books"],
+    )
+    insert_virtual_books(dest_cur)
+    table_columns = {
+        "isbns": ("isbn", "title_id", "book_type", "foreign_lang"),
+        "contents": ("book_title_id", "content_title_id"),
+        "translations": ("title_id", "lowest_title_id", "title"),
+        "more_images": ("title_id", "image"),
+    }
+    for table, columns in table_columns.items():
+        dest_cur.cur.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) "
+            + f"VALUES ({', '.join('?' * len(columns))});",
+            data.get(table, []),
+        )
+    dest_cur.cur.execute(
+        """
+        UPDATE books
+        SET isbn = (
+            SELECT isbn
+            FROM isbns
+            WHERE isbns.title_id = books.title_id
+            ORDER BY id
+            LIMIT 1
+        )
+        WHERE title_id != ?;
+        """,
+        (cfg.INCONSISTENT_ISBN_VIRTUAL_TITLE,),
+    )
+
+
+# Everything the deduplication and merges can change, in a form that
+# doesn't depend on the order rows were written in
+def snapshot_books_tables(dest_cur):
+    queries = {
+        "books": "SELECT title_id, title, isbn, inconsistent FROM books",
+        "isbns": "SELECT isbn, title_id, book_type, foreign_lang FROM isbns",
+        "contents": "SELECT book_title_id, content_title_id FROM contents",
+        "translations": "SELECT title_id, lowest_title_id FROM translations",
+        "more_images": "SELECT title_id, image FROM more_images",
+        "merged_books": "SELECT loser_id, winner_id FROM merged_books",
+    }
+    snapshot = {}
+    for table, query in queries.items():
+        dest_cur.cur.execute(query)
+        snapshot[table] = sorted(dest_cur.cur.fetchall())
+    return snapshot
+
+
+# Random contents, translations and more_images rows for books with
+# these title_ids, with up to max_rows contents and images
+def random_books_tables(rng, title_ids, max_rows):
+    pairs = [(a, b) for a in title_ids for b in title_ids if a != b]
+    images = ["a.jpg", "b.jpg"] + [
+        f"c{title_id}.jpg" for title_id in title_ids
+    ]
+    return {
+        "contents": rng.sample(
+            pairs, min(len(pairs), rng.randint(0, max_rows))
+        ),
+        "translations": [
+            (900 + n, rng.choice(title_ids), f"Translation {n}")
+            for n in range(rng.randint(0, 4))
+        ],
+        "more_images": list(
+            {
+                (rng.choice(title_ids), rng.choice(images))
+                for _ in range(rng.randint(0, max_rows))
+            }
+        ),
+    }
@@ -0,0 +1,175 @@
+import re
+import sqlite3
+from pathlib import Path
+
+from columnar_store import column_kind, write_table
+from snapshot_functions import SNAPSHOT_COLUMNS
+
+# A stand-in for the ISFDB source database, so the snapshot functions
+# can be compared with the MySQL queries they replace. MysqlCursor
+# rewrites the parts of those queries SQLite doesn't understand, and
+# text columns compare the way MySQL's default collation does. The same
+# rows can be written as a snapshot for snapshot_functions to load.
+
+# The ISFDB types of the columns in SNAPSHOT_COLUMNS
+SOURCE_COLUMN_TYPES = {
+    "titles": {
+        "title_id": "int",
+        "title_title": "mediumtext",
+        "title_synopsis": "int",
+        "note_id": "int",
+        "series_id": "int",
+        "title_seriesnum": "int",
+        "title_copyright": "date",
+        "title_ttype": "enum",
+        "title_parent": "int",
+        "title_rating": "float",
+        "title_seriesnum_2": "varchar",
+        "title_jvn": "enum",
+        "title_language": "int",
+        "title_storylen": "mediumtext",
+        "title_non_genre": "enum",
+        "title_graphic": "enum",
+    },
+    "pubs": {
+        "pub_id": "int",
+        "pub_year": "date",
+        "pub_pages": "varchar",
+        "pub_ptype": "tinytext",
+        "pub_ctype": "enum",
+        "pub_isbn": "varchar",
+        "pub_frontimage": "tinytext",
+    },
+    "pub_content": {"pub_id": "int", "title_id": "int"},
+    "authors": {"author_id": "int", "author_canonical": "mediumtext"},
+    "canonical_author": {
+        "title_id": "int",
+        "author_id": "int",
+        "ca_status": "int",
+    },
+    "series": {
+        "series_id": "int",
+        "series_title": "mediumtext",
+        "series_parent": "int",
+    },
+    "notes": {"note_id": "int", "note_note": "mediumtext"},
+    "webpages": {"title_id": "int", "url": "mediumtext"},
+    "awards": {"award_id": "int", "award_level": "mediumtext"},
+    "title_awards": {"title_id": "int", "award_id": "int"},
+    "languages": {"lang_id": "int", "lang_name": "mediumtext"},
+}
+SQLITE_TYPES = {"int": "integer", "float": "real", "text": "text"}
+
+DATE_REGEX = re.compile(r"(\d{4})-\d\d-\d\d")
+GROUP_CONCAT_REGEX = re.compile(
+    r"GROUP_CONCAT\(\s*(.*?)\s+ORDER BY\s+(.*?)\s+SEPARATOR\s+('[^']*')\s*\)",
+    re.DOTALL,
+)
+
+
+class MysqlCursor:
+    def __init__(self, conn):
+        self.conn = conn
+        self.cur = conn.cursor()
+
+    # Session settings like group_concat_max_len don't apply to SQLite
+    def execute(self, sql, params=()):
+        if sql.strip().startswith("SET "):
+            return
+        self.cur.execute(sqlite_statement(sql), tuple(params))
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+
+def sqlite_statement(sql):
+    sql = sql.replace("%s", "?")
+    # SQLite 3.40 can't order the values of group_concat
+    return GROUP_CONCAT_REGEX.sub(r"ordered_group_concat(\1, \2, \3)", sql)
+
+
+# Strings compare without regard to case or trailing spaces
+def mysql_collation(text, other):
+    text = text.rstrip(" ").lower()
+    other = other.rstrip(" ").lower()
+    return (text > other) - (text < other)
+
+
+def mysql_year(date):
+    if date is None:
+        return None
+    match = DATE_REGEX.match(date)
+    return int(match.group(1)) if match else None
+
+
+# MySQL's REGEXP matches without regard to case for text columns, and
+# knows the POSIX character classes Python's re doesn't
+def mysql_regexp(pattern, text):
+    if text is None:
+        return None
+    pattern = pattern.replace("[:digit:]", "0-9")
+    return re.search(pattern, text, re.IGNORECASE) is not None
+
+
+# GROUP_CONCAT(value ORDER BY key SEPARATOR separator), which leaves out
+# null values and is null when they all are
+class OrderedGroupConcat:
+    def __init__(self):
+        self.values = []
+        self.separator = ","
+
+    def step(self, value, key, separator):
+        self.separator = separator
+        if value is not None:
+            self.values.append((key, value))
+
+    def finalize(self):
+        if not self.values:
+            return None
+        return self.separator.join(
+            value for _, value in sorted(self.values, key=lambda v: v[0])
+        )
+
+
+def source_columns(table):
+    return [
+        (name, column_kind(SOURCE_COLUMN_TYPES[table][name]))
+        for name in SNAPSHOT_COLUMNS[table]
+    ]
+
+
+# A source cursor on a new in-memory database holding data, a dict of
+# lists of rows keyed by table, in the column order of SNAPSHOT_COLUMNS
+def connect_source(data):
+    conn = sqlite3.connect(":memory:")
+    conn.create_collation("MYSQL", mysql_collation)
+    conn.create_function("YEAR", 1, mysql_year, deterministic=True)
+    conn.create_function("REGEXP", 2, mysql_regexp, deterministic=True)
+    conn.create_aggregate("ordered_group_concat", 3, OrderedGroupConcat)
+    for table in SNAPSHOT_COLUMNS:
+        column_defs = [
+            f"{name} {SQLITE_TYPES[kind]}"
+            + (" COLLATE MYSQL" if kind == "text" else "")
+            for name, kind in source_columns(table)
+        ]
+        conn.execute(f"CREATE TABLE {table} ({', '.join(column_defs)});")
+        conn.executemany(
+            f"INSERT INTO {table} "
+            + f"VALUES ({', '.join('?' * len(column_defs))});",
+            data.get(table, []),
+        )
+    return MysqlCursor(conn)
+
+
+# Write the same rows as a complete snapshot at snapshot_path
+def write_snapshot(data, snapshot_path):
+    for table in SNAPSHOT_COLUMNS:
+        write_table(
+            Path(snapshot_path, table),
+            source_columns(table),
+            data.get(table, []),
+        )
+    Path(snapshot_path, "complete").touch()
@@ -0,0 +1,256 @@
+import gzip
+import zipfile
+from io import BytesIO
+
+import pytest
+
+from dump_parser import iter_dump_tables, open_dump, parse_values
+
+# The parser is tested on dumps laid out the way mysqldump writes them,
+# with each table's structure followed by its extended INSERTs
+
+
+def table_dump(table, columns, inserts, charset="utf8mb4"):
+    lines = [
+        "--",
+        f"-- Table structure for table `{table}`",
+        "--",
+        "",
+        f"DROP TABLE IF EXISTS `{table}`;",
+        "/*!40101 SET @saved_cs_client     = @@character_set_client */;",
+        f"CREATE TABLE `{table}` (",
+    ]
+    lines += [
+        f"  `{name}` {sql_type} DEFAULT NULL," for name, sql_type in columns
+    ]
+    lines += [
+        f"  PRIMARY KEY (`{columns[0][0]}`)",
+        f") ENGINE=MyISAM DEFAULT CHARSET={charset};",
+        "/*!40101 SET character_set_client = @saved_cs_client */;",
+        "",
+        f"LOCK TABLES `{table}` WRITE;",
+        f"/*!40000 ALTER TABLE `{table}` DISABLE KEYS */;",
+    ]
+    lines += inserts
+    lines += [
+        f"/*!40000 ALTER TABLE `{table}` ENABLE KEYS */;",
+        "UNLOCK TABLES;",
+        "",
+    ]
+    return lines
+
+
+# A dump as the binary stream open_dump returns. Each part is a list of
+# lines, and lines that are bytes are already in their table's charset.
+def dump_file(parts, set_names="utf8mb4"):
+    header = [
+        "-- MySQL dump 10.13  Distrib 8.0.36, for Linux (x86_64)",
+        "/*!40101 SET @OLD_CHARACTER_SET_CLIENT=@@CHARACTER_SET_CLIENT */;",
+    ]
+    if set_names:
+        header.append(f"/*!40101 SET NAMES {set_names} */;")
+    data = b"".join(
+        (line if isinstance(line, bytes) else line.encode()) + b"\n"
+        for part in [header] + parts
+        for line in part
+    )
+    return BytesIO(data)
+
+
+def read_dump(dump, tables):
+    return {
+        table: (columns, list(rows))
+        for table, columns, rows in iter_dump_tables(dump, tables)
+    }
+
+
+def test_values_escapes():
+    values = (
+        r"(1,'It\'s','a\\b','line\nbreak\ttab','nul\0\Z',"
+        + r"'Don''t','\"quoted\"','\%\_')"
+    )
+    assert list(parse_values(values + ";")) == [
+        (
+            1,
+            "It's",
+            "a\\b",
+            "line\nbreak\ttab",
+            "nul\0\x1a",
+            "Don't",
+            '"quoted"',
+            "%_",
+        )
+    ]
+
+
+def test_values_separators_in_strings():
+    values = "(1,'a),(b',NULL),(2,'(c, d)',''),(3,''',''','\\'),(\\'')"
+    assert list(parse_values(values + ";")) == [
+        (1, "a),(b", None),
+        (2, "(c, d)", ""),
+        (3, "','", "'),('"),
+    ]
+
+
+def test_values_numbers():
+    values = "(-5,0,3.25,-1.5e3,1E-2,12345678901)"
+    assert list(parse_values(values + ";")) == [
+        (-5, 0, 3.25, -1500.0, 0.01, 12345678901)
+    ]
+
+
+def test_values_hex_and_binary():
+    values = "(0x414243,0x,_binary 'raw\\0bytes')"
+    assert list(parse_values(values + ";")) == [
+        (b"ABC", b"", "raw\0bytes"),
+    ]
+
+
+def test_column_list_insert():
+    dump = dump_file(
+        [
+            table_dump(
+                "authors",
+                [
+                    ("author_id", "int"),
+                    ("author_canonical", "mediumtext"),
+                    ("author_birthdate", "date"),
+                ],
+                [
+                    "INSERT INTO `authors` (`author_birthdate`, `author_id`) "
+                    + "VALUES ('1920-01-02',1),(NULL,2);",
+                    "INSERT INTO `authors` VALUES (3,'Asimov','1920-01-02');",
+                ],
+            )
+        ]
+    )
+    columns, rows = read_dump(dump, ["authors"])["authors"]
+    assert columns == [
+        ("author_id", "int"),
+        ("author_canonical", "text"),
+        ("author_birthdate", "text"),
+    ]
+    assert rows == [
+        (1, None, "1920-01-02"),
+        (2, None, None),
+        (3, "Asimov", "1920-01-02"),
+    ]
+
+
+def test_latin1_table():
+    # With SET NAMES binary, the table's own charset applies. MySQL's
+    # latin1 is cp1252, except for the bytes cp1252 doesn't define.
+    dump = dump_file(
+        [
+            table_dump(
+                "notes",
+                [("note_id", "int"), ("note_note", "mediumtext")],
+                [b"INSERT INTO `notes` VALUES (1,'caf\xe9 \x80 \x81 \x9d');"],
+                charset="latin1",
+            )
+        ],
+        set_names="binary",
+    )
+    _, rows = read_dump(dump, ["notes"])["notes"]
+    assert rows == [(1, "café € \x81 \x9d")]
+
+
+def test_set_names_overrides_table_charset():
+    # mysqldump converts every table to the charset of SET NAMES
+    dump = dump_file(
+        [
+            table_dump(
+                "notes",
+                [("note_id", "int"), ("note_note", "mediumtext")],
+                ["INSERT INTO `notes` VALUES (1,'café');"],
+                charset="latin1",
+            )
+        ],
+        set_names="utf8mb4",
+    )
+    _, rows = read_dump(dump, ["notes"])["notes"]
+    assert rows == [(1, "café")]
+
+
+def test_invalid_text_raises():
+    dump = dump_file(
+        [
+            table_dump(
+                "notes",
+                [("note_id", "int"), ("note_note", "mediumtext")],
+                [b"INSERT INTO `notes` VALUES (1,'caf\xe9');"],
+            )
+        ]
+    )
+    with pytest.raises(Exception, match="isn't valid utf8mb4"):
+        read_dump(dump, ["notes"])
+
+
+def test_tables_are_skipped():
+    # The skipped latin1 table comes after a utf8 one, and its rows have
+    # to be decoded as latin1 even though nothing reads them
+    latin1_table = table_dump(
+        "skipped",
+        [("id", "int"), ("name", "mediumtext")],
+        [b"INSERT INTO `skipped` VALUES (1,'\xe9');"],
+        charset="latin1",
+    )
+    dump = dump_file(
+        [
+            table_dump(
+                "languages",
+                [("lang_id", "int"), ("lang_name", "mediumtext")],
+                [
+                    "INSERT INTO `languages` VALUES (1,'English'),"
+                    + "(2,'Français');",
+                    "INSERT INTO `languages` VALUES (3,'Deutsch');",
+                ],
+            ),
+            latin1_table,
+            table_dump(
+                "series",
+                [("series_id", "int"), ("series_title", "mediumtext")],
+                ["INSERT INTO `series` VALUES (7,'Foundation');"],
+            ),
+            table_dump(
+                "webpages",
+                [("webpage_id", "int"), ("url", "mediumtext")],
+                ["INSERT INTO `webpages` VALUES (9,'http://a.b/');"],
+            ),
+        ],
+        set_names="binary",
+    )
+
+    # The rows of languages are skipped by the caller, and series by the
+    # parser, since it isn't one of the tables asked for
+    tables = []
+    for table, _, rows in iter_dump_tables(dump, ["languages", "webpages"]):
+        tables.append(table)
+        if table == "webpages":
+            assert list(rows) == [(9, "http://a.b/")]
+    assert tables == ["languages", "webpages"]
+
+
+@pytest.mark.parametrize("suffix", [".sql", ".gz", ".zip"])
+def test_open_dump(suffix, tmp_path):
+    data = dump_file(
+        [
+            table_dump(
+                "languages",
+                [("lang_id", "int"), ("lang_name", "mediumtext")],
+                ["INSERT INTO `languages` VALUES (1,'English');"],
+            )
+        ]
+    ).getvalue()
+    path = tmp_path / f"backup{suffix}"
+    if suffix == ".gz":
+        path.write_bytes(gzip.compress(data))
+    elif suffix == ".zip":
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("backup.sql", data)
+    else:
+        path.write_bytes(data)
+
+    with open_dump(path) as dump:
+        _, rows = read_dump(dump, ["languages"])["languages"]
+    assert rows == [(1, "English")]
@@ -0,0 +1,189 @@
+import random
+
+import pytest
+from sqlite_dest import (
+    connect_dest,
+    load_books_tables,
+    random_books_tables,
+    snapshot_books_tables,
+)
+
+import isbn_deduplication_functions
+import setup_configuration as cfg
+from isbn_deduplication_functions import (
+    apply_isbn_deduplication_plan,
+    deduplicate_isbn,
+    get_all_isbn_tuples,
+    get_claimant_books,
+    get_duplicate_isbn_components,
+    plan_isbn_deduplication,
+)
+
+# plan_isbn_deduplication has to make the same decisions as running
+# deduplicate_isbn on each duplicate isbn, and leave the tables the same
+# way once apply_isbn_deduplication_plan has written them. Both paths
+# are run on the checked-in dataset, which has a case for each way an
+# isbn can be resolved, and on small random datasets with many more
+# collisions between them.
+
+# Mostly titles, authors and book types that can merge, so the random
+# datasets have chains of merges as well as deletes
+TITLES = [
+    "Ghost Stories",
+    "Ghost Stories: Now With Two Bonus Tales",
+    "The Ghost Stories",
+    "Star Road",
+]
+AUTHORS = ["Ann Lee", "Ann Lee", "Ann Lee, Bo Ray", "Bo Ray"]
+BOOK_TYPES = ["NOVEL"] * 4 + [
+    "NOVELLA",
+    "ANTHOLOGY",
+    "COLLECTION",
+    "OMNIBUS",
+]
+
+
+def random_dataset(seed):
+    rng = random.Random(seed)
+    title_ids = list(range(100, 100 + rng.randint(3, 12)))
+    isbns = [
+        f"97800000000{n:02}" for n in range(rng.randint(1, len(title_ids) + 1))
+    ]
+
+    books = [
+        (
+            title_id,
+            rng.choice(TITLES),
+            rng.choice(AUTHORS),
+            rng.choice([None, 1990, 2000, 2010]),
+            rng.choice([None, 100, 200]),
+            rng.choice(BOOK_TYPES),
+            rng.choice([None, f"c{title_id}.jpg"]),
+        )
+        for title_id in title_ids
+    ]
+    isbn_rows = []
+    for isbn in isbns:
+        claimants = rng.sample(title_ids, rng.choice([1, 2, 2, 2, 3]))
+        # The virtual title only sometimes claims an isbn already
+        if rng.random() < 0.05:
+            claimants.append(cfg.INCONSISTENT_ISBN_VIRTUAL_TITLE)
+        for title_id in claimants:
+            isbn_rows.append(
+                (isbn, title_id, rng.choice(BOOK_TYPES), rng.random() < 0.05)
+            )
+    return {
+        "books": books,
+        "isbns": isbn_rows,
+        **random_books_tables(rng, title_ids, 6),
+    }
+
+
+# The SQL path, the way deduplicate_isbn_component runs it: each isbn in
+# a transaction of its own, with an error only rolling back that isbn.
+# Returns the resolution of each isbn that had one, and the number of
+# isbns deduplicated and errored.
+def deduplicate_in_sql(data, monkeypatch):
+    dest_cur = connect_dest()
+    load_books_tables(data, dest_cur)
+
+    resolutions = []
+    choose_isbn_resolution = (
+        isbn_deduplication_functions.choose_isbn_resolution
+    )
+
+    def record_resolution(isbn, isbn_claimants):
+        resolution = choose_isbn_resolution(isbn, isbn_claimants)
+        resolutions.append((resolution, isbn, isbn_claimants))
+        return resolution
+
+    isbns_deduped = 0
+    isbns_errored = 0
+    with monkeypatch.context() as m:
+        m.setattr(
+            isbn_deduplication_functions,
+            "choose_isbn_resolution",
+            record_resolution,
+        )
+        for component in get_duplicate_isbn_components(dest_cur):
+            for isbn in component:
+                dest_cur.execute("SAVEPOINT isbn;")
+                n_resolutions = len(resolutions)
+                try:
+                    deduplicate_isbn(isbn, dest_cur)
+                except Exception:
+                    dest_cur.execute("ROLLBACK TO SAVEPOINT isbn;")
+                    del resolutions[n_resolutions:]
+                    isbns_errored += 1
+                else:
+                    isbns_deduped += 1
+                dest_cur.execute("RELEASE SAVEPOINT isbn;")
+
+    plan = [step for step in resolutions if step[0] is not None]
+    return plan, isbns_deduped, isbns_errored, snapshot_books_tables(dest_cur)
+
+
+# The planned path, the way deduplicate_isbns_in_memory runs it
+def deduplicate_in_memory(data):
+    dest_cur = connect_dest()
+    load_books_tables(data, dest_cur)
+
+    isbn_rows = get_all_isbn_tuples(dest_cur)
+    books = get_claimant_books(isbn_rows, dest_cur)
+    plan, final_isbn_rows, isbns_deduped, isbns_errored = (
+        plan_isbn_deduplication(isbn_rows, books)
+    )
+    apply_isbn_deduplication_plan(plan, final_isbn_rows, dest_cur)
+    return plan, isbns_deduped, isbns_errored, snapshot_books_tables(dest_cur)
+
+
+def sort_plan(plan):
+    return sorted(plan, key=lambda step: step[1])
+
+
+def test_dataset_matches_sql_path(load_dataset, monkeypatch):
+    data = load_dataset("isbn_deduplication")
+    sql_plan, sql_deduped, sql_errored, sql_tables = deduplicate_in_sql(
+        data, monkeypatch
+    )
+    plan, isbns_deduped, isbns_errored, tables = deduplicate_in_memory(data)
+
+    # The virtual title's claim makes 0123456789 error. Books with NULL
+    # years or pages come first, like in Postgres, so 181 and 162 win.
+    # 9000000000 is left with one claimant by the merge before it.
+    assert [
+        (resolution, isbn, [claimant[0] for claimant in isbn_claimants])
+        for resolution, isbn, isbn_claimants in sort_plan(plan)
+    ] == [
+        ("merge", "1111111111", [101, 100]),
+        ("merge", "1212121212", [181, 180]),
+        ("merge", "1212121214", [181, 182]),
+        ("merge", "1313131313", [191, 190]),
+        ("delete", "2222222222", [102, 101]),
+        ("delete", "3333333333", [112, 111, 110]),
+        ("delete", "4444444444", [121, 120]),
+        ("delete", "5555555555", [130, 131]),
+        ("merge", "6666666666", [140, 141]),
+        ("delete", "7777777777", [146, 145]),
+        ("delete", "7777777778", [151, 150]),
+        ("merge", "8888888888", [160, 161]),
+        ("delete", "9100000000", [160, 163]),
+        ("merge", "9999999999", [162, 160]),
+    ]
+    assert (isbns_deduped, isbns_errored) == (15, 1)
+    assert sort_plan(plan) == sort_plan(sql_plan)
+    assert (isbns_deduped, isbns_errored) == (sql_deduped, sql_errored)
+    assert tables == sql_tables
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_dataset_matches_sql_path(seed, monkeypatch):
+    data = random_dataset(seed)
+    sql_plan, sql_deduped, sql_errored, sql_tables = deduplicate_in_sql(
+        data, monkeypatch
+    )
+    plan, isbns_deduped, isbns_errored, tables = deduplicate_in_memory(data)
+
+    assert sort_plan(plan) == sort_plan(sql_plan)
+    assert (isbns_deduped, isbns_errored) == (sql_deduped, sql_errored)
+    assert tables == sql_tables
@@ -0,0 +1,186 @@
+import random
+
+import pytest
+from sqlite_dest import (
+    connect_dest,
+    load_books_tables,
+    random_books_tables,
+    snapshot_books_tables,
+)
+
+from isbn_deduplication_functions import merge_books
+
+# merge_books has to leave the books tables the same as merging each
+# loser into its winner one at a time, in the order given, the way
+# winner_takes_all used to. The subtle parts are the order the losers'
+# isbns reach a winner, which decides the book_type kept when two of
+# them have the same isbn, and whether a loser's cover is added, which
+# depends on the images it had inherited by the time it was merged.
+
+BOOK_TYPES = ["NOVEL", "NOVELLA", "ANTHOLOGY", "COLLECTION", "OMNIBUS"]
+
+
+# Books merged in a random order, with winners that later lose to
+# another book and losers that already had others merged into them
+def random_dataset(seed):
+    rng = random.Random(seed)
+    title_ids = list(range(100, 100 + rng.randint(2, 12)))
+    isbns = [f"97800000000{n:02}" for n in range(rng.randint(1, 6))]
+
+    merges = []
+    remaining_ids = list(title_ids)
+    for _ in range(rng.randint(1, len(title_ids) - 1)):
+        loser_id, winner_id = rng.sample(remaining_ids, 2)
+        remaining_ids.remove(loser_id)
+        merges.append(
+            (winner_id, loser_id, rng.choice([None, f"c{loser_id}.jpg"]))
+        )
+
+    isbn_rows = [
+        (isbn, title_id, rng.choice(BOOK_TYPES), rng.random() < 0.2)
+        for title_id in title_ids
+        for isbn in rng.sample(isbns, rng.randint(0, len(isbns)))
+    ]
+    return {
+        "books": [
+            (title_id, "Star Road", "Cy Dee", 2000, 300, "NOVEL", None)
+            for title_id in title_ids
+        ],
+        "merges": merges,
+        "isbns": isbn_rows,
+        **random_books_tables(rng, title_ids, 8),
+    }
+
+
+# The statements winner_takes_all ran for each loser before merge_books
+def merge_one_at_a_time(merges, dest_cur):
+    for winner_id, loser_id, loser_cover_image in merges:
+        dest_cur.execute(
+            """
+            INSERT INTO contents (book_title_id, content_title_id)
+            SELECT %s, content_title_id
+            FROM contents
+            WHERE (
+                book_title_id = %s
+                AND content_title_id != %s
+            )
+            ON CONFLICT DO NOTHING;
+            """,
+            (winner_id, loser_id, winner_id),
+        )
+
+        dest_cur.execute(
+            """
+            INSERT INTO contents (book_title_id, content_title_id)
+            SELECT book_title_id, %s
+            FROM contents
+            WHERE (
+                content_title_id = %s
+                AND book_title_id != %s
+            )
+            ON CONFLICT DO NOTHING;
+            """,
+            (winner_id, loser_id, winner_id),
+        )
+
+        dest_cur.execute(
+            """
+            INSERT INTO isbns (isbn, title_id, book_type)
+            SELECT isbn, %s, book_type
+            FROM isbns
+            WHERE title_id = %s
+            ON CONFLICT DO NOTHING;
+            """,
+            (winner_id, loser_id),
+        )
+
+        dest_cur.execute(
+            """
+            UPDATE translations
+            SET lowest_title_id = %s
+            WHERE lowest_title_id = %s;
+            """,
+            (winner_id, loser_id),
+        )
+
+        dest_cur.execute(
+            """
+            INSERT INTO more_images (title_id, image)
+            SELECT %s, image
+            FROM more_images
+            WHERE title_id = %s
+            ON CONFLICT DO NOTHING;
+            """,
+            (winner_id, loser_id),
+        )
+
+        if loser_cover_image:
+            dest_cur.execute(
+                """
+                INSERT INTO more_images (title_id, image)
+                SELECT %s, %s
+                FROM more_images
+                WHERE title_id = %s
+                ON CONFLICT DO NOTHING;
+                """,
+                (winner_id, loser_cover_image, loser_id),
+            )
+
+        dest_cur.execute(
+            """
+            DELETE FROM books
+            WHERE title_id = %s;
+            """,
+            (loser_id,),
+        )
+
+        dest_cur.execute(
+            """
+            UPDATE books
+            SET inconsistent = TRUE
+            WHERE title_id = %s
+            """,
+            (winner_id,),
+        )
+
+
+# The books tables after merging data["merges"] both ways, leaving out
+# merged_books, which winner_takes_all didn't keep
+def merge_both_ways(data):
+    tables = []
+    for merge in [merge_books, merge_one_at_a_time]:
+        dest_cur = connect_dest()
+        load_books_tables(data, dest_cur)
+        merge([tuple(m) for m in data["merges"]], dest_cur)
+        snapshot = snapshot_books_tables(dest_cur)
+        del snapshot["merged_books"]
+        tables.append(snapshot)
+    return tables
+
+
+def test_dataset_matches_one_at_a_time(load_dataset):
+    tables, sequential_tables = merge_both_ways(load_dataset("merge_books"))
+
+    # 203's NOVELLA reaches 201, and then 200, before 204's OMNIBUS. 202
+    # and 201 only have the images they inherited, so their covers are
+    # kept, while 204 and 205 never had any, so theirs aren't.
+    assert [row for row in tables["isbns"] if row[1] == 200] == [
+        ("0000000001", 200, "NOVELLA", 0),
+        ("0000000002", 200, "COLLECTION", 0),
+        ("0000000003", 200, "NOVEL", 0),
+    ]
+    assert tables["more_images"] == [
+        (200, "c201.jpg"),
+        (200, "c202.jpg"),
+        (200, "c203.jpg"),
+        (200, "m203.jpg"),
+        (208, "c209.jpg"),
+        (208, "m209.jpg"),
+    ]
+    assert tables == sequential_tables
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_merges_match_one_at_a_time(seed):
+    tables, sequential_tables = merge_both_ways(random_dataset(seed))
+    assert tables == sequential_tables
@@ -0,0 +1,258 @@
+import random
+from pathlib import Path
+
+import pandas as pd
+import pytest
+from sqlite_source import connect_source, write_snapshot
+
+import setup_configuration as cfg
+import snapshot_functions as snapshot
+from migration_functions import (
+    get_all_titles,
+    get_contents,
+    get_pub_rows,
+    get_title_attributes,
+    get_titles_for_roots,
+    pub_rows_query,
+)
+
+# Each snapshot function has to return what the MySQL query it stands
+# in for would return on the same source tables. The queries are run on
+# a SQLite copy of the tables that compares text like MySQL does, and
+# the snapshot functions on a snapshot written from the same rows. Rows
+# of queries without an ORDER BY are compared in any order.
+
+EXCLUDED_AUTHOR = int(cfg.EXCLUDED_AUTHORS.split(",")[0])
+EXCLUDED_TITLE_ID = int(cfg.EXCLUDED_TITLE_IDS.split(",")[0])
+
+# Titles that differ only in case, trailing spaces or the words the
+# alternate titles query leaves out
+TITLES = [
+    "Star Road",
+    "star road",
+    "Star Road  ",
+    "Star Road II",
+    "Star Road, Part 2 of 3",
+    "Star Road Boxed Set",
+]
+TTYPES = ["NOVEL"] * 3 + [
+    "SHORTFICTION",
+    "SHORTFICTION",
+    "ANTHOLOGY",
+    "COLLECTION",
+    "OMNIBUS",
+    "CHAPBOOK",
+    "ESSAY",
+]
+CTYPES = ["NOVEL", "CHAPBOOK", "COLLECTION", "ANTHOLOGY", "OMNIBUS"]
+DATES = [None, "0000-00-00", "1999-00-00", "2001-05-06", "8888-00-00"]
+LANGUAGES = [cfg.ENGLISH] * 4 + [22, None]
+URLS = [
+    "http://en.wikipedia.org/wiki/A",
+    "https://EN.Wikipedia.org/wiki/B",
+    "http://fr.wikipedia.org/wiki/C",
+    "http://www.isfdb.org/",
+]
+
+
+def random_dataset(seed):
+    rng = random.Random(seed)
+    title_ids = list(range(1, rng.randint(3, 25)))
+    if rng.random() < 0.2:
+        title_ids.append(EXCLUDED_TITLE_ID)
+    author_ids = [1, 2, 3, EXCLUDED_AUTHOR]
+    pub_ids = list(range(1, rng.randint(2, 12)))
+
+    titles = []
+    for title_id in title_ids:
+        # Parents are mostly earlier titles, but can be missing or the
+        # title itself
+        title_parent = rng.choice([0, 0, rng.choice(title_ids), title_id, 999])
+        titles.append(
+            (
+                title_id,
+                rng.choice(TITLES),
+                rng.choice([None, 1]),
+                rng.choice([None, 2]),
+                rng.choice([None, 3]),
+                rng.choice([None, 1, 2]),
+                rng.choice(DATES),
+                rng.choice(TTYPES),
+                title_parent,
+                rng.choice([None, 7.5]),
+                rng.choice([None, "1a"]),
+                rng.choice(["Yes", "No"]),
+                rng.choice(LANGUAGES),
+                rng.choice([None, "novella", "short story"]),
+                rng.choice(["No", "No", "Yes", None]),
+                rng.choice(["No", "No", "Yes", None]),
+            )
+        )
+    return {
+        "titles": titles,
+        "pubs": [
+            (
+                pub_id,
+                rng.choice(DATES),
+                rng.choice([None, "300", "viii+200"]),
+                rng.choice([None, "pb", "audio CD"]),
+                rng.choice(CTYPES),
+                rng.choice([None, "", f"00000000{pub_id:02}"]),
+                rng.choice([None, f"http://a.b/{pub_id}.jpg"]),
+            )
+            for pub_id in pub_ids
+        ],
+        "pub_content": sorted(
+            {
+                (rng.choice(pub_ids), rng.choice(title_ids))
+                for _ in range(rng.randint(0, 3 * len(title_ids)))
+            }
+        ),
+        "authors": [
+            (author_id, rng.choice(["Ann Lee", "Bo Ray"]))
+            for author_id in author_ids
+        ],
+        "canonical_author": [
+            (rng.choice(title_ids), rng.choice(author_ids), rng.randint(1, 2))
+            for _ in range(rng.randint(0, 2 * len(title_ids)))
+        ],
+        "webpages": [
+            (rng.choice(title_ids + [None]), rng.choice(URLS))
+            for _ in range(rng.randint(0, len(title_ids)))
+        ],
+        "awards": [(1, "1"), (2, "2"), (3, None)],
+        "title_awards": [
+            (rng.choice(title_ids), rng.randint(1, 3))
+            for _ in range(rng.randint(0, len(title_ids)))
+        ],
+        "languages": [(cfg.ENGLISH, "English"), (22, "French")],
+    }
+
+
+# A source cursor on data, with the snapshot functions reading the same
+# rows
+@pytest.fixture
+def load_source(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshot, "tables", {})
+    monkeypatch.setattr(snapshot, "loaded_snapshot", None)
+
+    def load(data):
+        snapshot_path = Path(tmp_path, "snapshot")
+        write_snapshot(data, snapshot_path)
+        snapshot.load_snapshot(snapshot_path)
+        return connect_source(data)
+
+    return load
+
+
+def title_ids_of(data):
+    return [row[0] for row in data["titles"]]
+
+
+def check_all_titles(data, source_cur):
+    titles = sorted(get_all_titles(source_cur))
+    assert get_all_titles(None) == titles
+    assert get_all_titles(None, limit=2) == titles[:2]
+
+    root_ids = title_ids_of(data)[1::2] + [999]
+    assert sorted(get_titles_for_roots(root_ids, None)) == sorted(
+        get_titles_for_roots(root_ids, source_cur, chunk_size=2)
+    )
+    return titles
+
+
+def check_pub_rows(data, source_cur):
+    root_ids = title_ids_of(data)[::2] + [999]
+    sql, params = pub_rows_query(root_ids)
+    pub_rows = pd.read_sql(
+        sql.replace("%s", "?"), source_cur.conn, params=params
+    )
+    pd.testing.assert_frame_equal(get_pub_rows(root_ids, None), pub_rows)
+    return pub_rows
+
+
+# The alternate titles query has no ORDER BY
+def sorted_title_attributes(title_ids, source_cur):
+    attributes = get_title_attributes(title_ids, source_cur)
+    for alt_titles in attributes["alt_titles"].values():
+        alt_titles.sort()
+    return attributes
+
+
+def check_title_attributes(data, source_cur):
+    title_ids = title_ids_of(data) + [999]
+    attributes = sorted_title_attributes(title_ids, source_cur)
+    assert sorted_title_attributes(title_ids, None) == attributes
+    return attributes
+
+
+def check_contents(data, source_cur):
+    title_ids = title_ids_of(data)
+    ranges = [(min(title_ids), max(title_ids)), (2, 5), (4, 4)]
+    contents = [sorted(get_contents(*r, source_cur)) for r in ranges]
+    assert [sorted(get_contents(*r, None)) for r in ranges] == contents
+    return contents[0]
+
+
+@pytest.mark.parametrize("prefilter", [True, False])
+def test_dataset_matches_mysql(
+    prefilter, load_dataset, load_source, monkeypatch
+):
+    monkeypatch.setattr(cfg, "PREFILTER_TITLES", prefilter)
+    data = load_dataset("snapshot_functions")
+    source_cur = load_source(data)
+
+    # 2 to 4 are variants of an English work, and 7 is the most recent
+    # English translation of 5. 15 has a null title_non_genre, which
+    # isn't != 'Yes'.
+    titles = check_all_titles(data, source_cur)
+    if prefilter:
+        assert [row[0] for row in titles] == [1, 7, 8]
+    else:
+        assert [row[0] for row in titles] == [1, 2, 3, 4, 6, 7, 8, 12]
+
+    # The pubs of a work include its variants' and translations'
+    pub_rows = check_pub_rows(data, source_cur)
+    assert pub_rows[["root_id", "pub_id", "title_id"]].values.tolist() == [
+        [1, 1, 1],
+        [1, 2, 2],
+        [1, 2, 3],
+        [1, 3, 1],
+        [3, 2, 3],
+        [5, 4, 7],
+        [7, 4, 7],
+        [9, 3, 9],
+    ]
+
+    # A case or trailing space difference isn't an alternate title, and
+    # GROUP_CONCAT leaves out the author without a name
+    attributes = check_title_attributes(data, source_cur)
+    assert attributes["alt_titles"][1] == ["Star Road Redux"]
+    assert attributes["authors"][1] == "Ann Lee, Bo Ray"
+    assert attributes["authors"][15] == "Ann Lee"
+    assert attributes["wikipedia"][1] == (
+        "https://en.wikipedia.org/wiki/Star_Road"
+    )
+    assert attributes["wikipedia"][5] is None
+    assert attributes["award_winner"][1] is True
+    assert attributes["award_winner"][8] is False
+
+    # 5's contents are found through the pub of its translation 7
+    contents = check_contents(data, source_cur)
+    assert (5, "COLLECTION", 8) in contents
+    assert (1, "OMNIBUS", 9) not in contents
+
+
+@pytest.mark.parametrize("prefilter", [True, False])
+@pytest.mark.parametrize("seed", range(50))
+def test_random_dataset_matches_mysql(
+    seed, prefilter, load_source, monkeypatch
+):
+    monkeypatch.setattr(cfg, "PREFILTER_TITLES", prefilter)
+    data = random_dataset(seed)
+    source_cur = load_source(data)
+
+    check_all_titles(data, source_cur)
+    check_pub_rows(data, source_cur)
+    check_title_attributes(data, source_cur)
+    check_contents(data, source_cur)
@@ -0,0 +1,186 @@
+import json
+
+from bulk_load_functions import copy_rows
+
+# In work queue mode, the batches of the title loop are put in the
+# title_batches table, where any number of worker processes, on this
+# host or any other that can reach the destination, claim them. A
+# batch is claimed with FOR UPDATE SKIP LOCKED and loaded and marked
+# done in the same transaction, so a worker that dies loses its
+# transaction along with the claim, and the batch goes back to the
+# queue for another worker. Batches are committed one at a time as the
+# titles are read, so the workers start on them right away, and the
+# queue of each run is closed in title_queues once no more are coming.
+
+TITLE_BATCH_COLUMNS = ("run_id", "batch_id", "titles")
+
+
+def create_title_batches_table(dest_cur):
+    dest_cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS title_batches (
+            run_id          integer NOT NULL,
+            batch_id        integer NOT NULL,
+            titles          jsonb NOT NULL,
+            status          text NOT NULL DEFAULT 'pending'
+                CHECK (status IN ('pending', 'done', 'failed')),
+            worker          text,
+            finished_at     timestamptz,
+            titles_added    integer,
+            titles_skipped  integer,
+            titles_errored  integer,
+            PRIMARY KEY (run_id, batch_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS title_queues (
+            run_id          integer NOT NULL,
+            closed          boolean NOT NULL DEFAULT FALSE,
+            PRIMARY KEY (run_id)
+        );
+        """
+    )
+
+
+# Start the queue of the run over, without any batches
+def open_title_queue(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        DELETE FROM title_batches
+        WHERE run_id = %s;
+        INSERT INTO title_queues (run_id)
+        VALUES (%s)
+        ON CONFLICT (run_id) DO UPDATE
+        SET closed = FALSE;
+        """,
+        (run_id, run_id),
+    )
+
+
+# title_batch is a list of title rows
+def enqueue_title_batch(run_id, batch_id, title_batch, dest_cur):
+    copy_rows(
+        "title_batches",
+        TITLE_BATCH_COLUMNS,
+        [(run_id, batch_id, json.dumps(title_batch))],
+        dest_cur,
+    )
+
+
+# No more batches will be added to the queue
+def close_title_queue(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        UPDATE title_queues
+        SET closed = TRUE
+        WHERE run_id = %s;
+        """,
+        (run_id,),
+    )
+
+
+# Lock the first pending batch no other worker has locked, and return
+# (batch_id, title rows), or None if there isn't one. The lock is held
+# until the transaction ends.
+def claim_title_batch(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT batch_id, titles
+        FROM title_batches
+        WHERE run_id = %s
+        AND status = 'pending'
+        ORDER BY batch_id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED;
+        """,
+        (run_id,),
+    )
+    row = dest_cur.fetchone()
+    if row is None:
+        return None
+    batch_id, titles = row
+    return batch_id, [tuple(title_data) for title_data in titles]
+
+
+# counts is (titles_added, titles_skipped, titles_errored)
+def finish_title_batch(run_id, batch_id, status, worker, counts, dest_cur):
+    dest_cur.execute(
+        """
+        UPDATE title_batches
+        SET status = %s,
+            worker = %s,
+            finished_at = now(),
+            titles_added = %s,
+            titles_skipped = %s,
+            titles_errored = %s
+        WHERE run_id = %s
+        AND batch_id = %s;
+        """,
+        (status, worker, *counts, run_id, batch_id),
+    )
+
+
+# Whether the queue is closed and every batch in it is finished. A
+# batch that a worker has claimed isn't finished until it's committed.
+# A run without a queue has nothing left to do.
+def title_queue_finished(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT closed AND NOT EXISTS (
+            SELECT 1
+            FROM title_batches
+            WHERE run_id = %s
+            AND status = 'pending'
+        )
+        FROM title_queues
+        WHERE run_id = %s;
+        """,
+        (run_id, run_id),
+    )
+    row = dest_cur.fetchone()
+    return row is None or row[0]
+
+
+def count_title_batches(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT COUNT(*)
+        FROM title_batches
+        WHERE run_id = %s;
+        """,
+        (run_id,),
+    )
+    return dest_cur.fetchone()[0]
+
+
+# The titles added, skipped and errored by each worker, and how many
+# batches each one finished or failed
+def get_worker_totals(run_id, dest_cur):
+    dest_cur.execute(
+        """
+        SELECT worker, COUNT(*), SUM(titles_added), SUM(titles_skipped),
+            SUM(titles_errored)
+        FROM title_batches
+        WHERE run_id = %s
+        AND status != 'pending'
+        GROUP BY worker
+        ORDER BY worker;
+        """,
+        (run_id,),
+    )
+    return dest_cur.fetchall()
+
+
+# The run whose titles stage is running, as (run_id, parameters), or
+# None if no titles stage is running
+def get_queue_run(dest_cur):
+    dest_cur.execute(
+        """
+        SELECT run_id, parameters
+        FROM migration_stages
+        WHERE stage = 'titles'
+        AND status = 'running'
+        ORDER BY run_id DESC
+        LIMIT 1;
+        """
+    )
+    return dest_cur.fetchone()